@@ -0,0 +1,211 @@
+import asyncio
+import copy
+import logging
+import time
+
+
+class EmbedTemplates:
+    """Embeds built once and reused.
+
+    ``get(key, build)`` calls ``build()`` the first time ``key`` is asked for
+    and hands out that same embed afterwards, so it must only be sent, never
+    changed; that suits help pages and other static embeds. ``copy`` returns a
+    copy of the template instead, for embeds that get a description or a
+    field filled in per use. ``clear`` drops everything, for example once the
+    bot's avatar, which the footers show, is known or has changed.
+    """
+
+    def __init__(self, copy=copy.deepcopy):
+        self._copy = copy
+        self._embeds = {}
+
+    def get(self, key, build):
+        embed = self._embeds.get(key)
+        if embed is None:
+            embed = self._embeds[key] = build()
+        return embed
+
+    def copy(self, key, build):
+        return self._copy(self.get(key, build))
+
+    def clear(self):
+        self._embeds.clear()
+
+
+class _Thread:
+    # One coalesced run of alerts and the message that shows it
+    __slots__ = ("guild_id", "channel_id", "kind", "render", "count", "sent", "message_id", "last", "next_edit",
+                 "queued", "busy")
+
+    def __init__(self, guild_id, channel_id, kind):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.kind = kind
+        self.render = None
+        self.count = 0
+        self.sent = 0
+        self.message_id = None
+        self.last = 0.0
+        self.next_edit = 0.0
+        self.queued = False
+        self.busy = False
+
+
+class AlertDispatcher:
+    """Sends alerts from background tasks, one updating message per burst.
+
+    ``alert`` records an alert and returns at once, so handlers never wait
+    on Discord. Alerts with the same ``(guild_id, channel_id, kind)`` less
+    than ``window`` seconds apart are coalesced: the first is sent and the
+    later ones edit that message, at most once every ``edit_interval``
+    seconds, with ``render(count)`` building the embed for the count so far.
+
+    ``route(guild_id, channel_id)`` picks where an alert goes, normally the
+    guild's log channel when one is set, so alerts do not land in a channel
+    that is being nuked; None drops the alert. Notices meant for the channel
+    they happened in pass ``route=False``. ``send(channel_id, embed)``
+    returns the new message's id and ``edit(channel_id, message_id, embed)``
+    updates it; ``workers`` tasks make those calls, paced under ``rate`` a
+    second in total.
+    """
+
+    def __init__(self, send, edit, route=None, window=60.0, edit_interval=5.0, rate=10.0, workers=2,
+                 clock=time.monotonic):
+        self.send = send
+        self.edit = edit
+        self.route = route
+        self.window = window
+        self.edit_interval = edit_interval
+        self.rate = rate
+        self.workers = workers
+        self.clock = clock
+        self.alerts = 0
+        self.sent = 0
+        self.edited = 0
+        self.failed = 0
+        self._threads = {}
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._next_request = 0.0
+
+    def alert(self, guild_id, channel_id, kind, render, route=True):
+        """Queue an alert without blocking."""
+        if route and self.route is not None:
+            channel_id = self.route(guild_id, channel_id)
+        if channel_id is None:
+            logging.warning(f"No channel to send {kind} alert to in guild {guild_id}")
+            return
+        self.alerts += 1
+        now = self.clock()
+        key = (guild_id, channel_id, kind)
+        thread = self._threads.get(key)
+        if thread is None or now - thread.last >= self.window:
+            if len(self._threads) > 4096:
+                self._threads = {key: thread for key, thread in self._threads.items()
+                                 if thread.queued or thread.busy or now - thread.last < self.window}
+            thread = self._threads[key] = _Thread(guild_id, channel_id, kind)
+        thread.count += 1
+        thread.last = now
+        thread.render = render
+        self._enqueue(thread)
+
+    async def drain(self):
+        """Wait until every alert so far has been sent or edited in."""
+        while any(thread.queued or thread.busy for thread in self._threads.values()):
+            await asyncio.sleep(0.05)
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def _enqueue(self, thread):
+        if thread.queued or thread.busy:
+            # Picked up again once the call in progress finishes
+            return
+        thread.queued = True
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        loop = asyncio.get_running_loop()
+        delay = thread.next_edit - loop.time()
+        if delay > 0:
+            loop.call_later(delay, self._queue.put_nowait, thread)
+        else:
+            self._queue.put_nowait(thread)
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            thread = await self._queue.get()
+            thread.queued = False
+            thread.busy = True
+            count = thread.count
+            try:
+                await self._pace(loop)
+                embed = thread.render(count)
+                if thread.message_id is None:
+                    thread.message_id = await self.send(thread.channel_id, embed)
+                    self.sent += 1
+                else:
+                    await self.edit(thread.channel_id, thread.message_id, embed)
+                    self.edited += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Error sending {thread.kind} alert in guild {thread.guild_id}: {e}")
+            thread.sent = count
+            thread.next_edit = loop.time() + self.edit_interval
+            thread.busy = False
+            if thread.count > thread.sent:
+                self._enqueue(thread)
+
+    async def _pace(self, loop):
+        now = loop.time()
+        wait = self._next_request - now
+        self._next_request = max(now, self._next_request) + 1 / self.rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def _benchmark(guilds=10, alerts_per_guild=50, latency=0.02):
+    # A raid in every guild: a burst of detections in each, against a fake
+    # REST API with per-call latency
+    async def run(coalesce):
+        calls = []
+
+        async def send(channel_id, embed):
+            await asyncio.sleep(latency)
+            calls.append(("send", channel_id))
+            return len(calls)
+
+        async def edit(channel_id, message_id, embed):
+            await asyncio.sleep(latency)
+            calls.append(("edit", channel_id))
+
+        dispatcher = AlertDispatcher(send, edit, rate=50.0)
+        blocked = 0.0
+        started = time.perf_counter()
+        for i in range(alerts_per_guild):
+            for guild_id in range(guilds):
+                if coalesce:
+                    before = time.perf_counter()
+                    dispatcher.alert(guild_id, guild_id, "role_creates", lambda count: {"count": count})
+                    blocked += time.perf_counter() - before
+                else:
+                    # What the handlers did: await the send before carrying on
+                    before = time.perf_counter()
+                    await send(guild_id, {"count": 1})
+                    blocked += time.perf_counter() - before
+            await asyncio.sleep(0.01)
+        await dispatcher.drain()
+        dispatcher.close()
+        return len(calls), blocked, time.perf_counter() - started
+
+    total = guilds * alerts_per_guild
+    for name, coalesce in (("awaited inline", False), ("AlertDispatcher", True)):
+        calls, blocked, elapsed = asyncio.run(run(coalesce))
+        print(f"{name:16} {total:,} alerts: {calls:,} REST calls, handlers blocked {blocked:.2f}s in total, "
+              f"done after {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    _benchmark()
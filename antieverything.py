@@ -3,15 +3,46 @@ from discord.ext import commands
 import datetime
 import json
 import os
-from collections import defaultdict, deque
 import logging
+import time
+import asyncio
+import typing
+from auditlog import AuditLogTailer
+from remediation import RemediationExecutor
+from detector import RateDetector, CHANNEL_CREATES, CHANNEL_DELETES, ROLE_CREATES, ROLE_DELETES
+from lockdown import LockdownManager, DiscordGuildAPI, CHANNEL_CREATE, CHANNEL_DELETE, ROLE_CREATE, ROLE_DELETE
+from contentfilter import ContentFilter, invite_code
+from correlation import CrossGuildCorrelator, ACTOR
+from fingerprint import NearDuplicateDetector
+from spamtracker import SpamTracker
+from metrics import Registry, RateLimitCounter, monitor_loop_lag, serve as serve_metrics
+from gatewayprofile import discord_profile, check_discord_listeners
+from trustlist import TrustList, GLOBAL, USER, ROLE
+from scheduler import Scheduler
+from alerts import AlertDispatcher, EmbedTemplates
+from dispatch import EventDispatcher, CRITICAL, NORMAL, LOW
+from guildconfig import (GuildConfigStore, DEFAULT_SETTINGS, ANTI_CHANNEL_CREATE, ANTI_CHANNEL_DELETE,
+                         ANTI_ROLE_CREATE, ANTI_ROLE_DELETE, ANTI_BAN, ANTI_KICK, ANTI_INVITE_LINKS, ANTI_MASS_MESSAGES,
+                         ANTI_DUPLICATE_MESSAGES)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-intents = discord.Intents.all()
-
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Event handlers defined below; the intents and caches follow from them
+GATEWAY_LISTENERS = (
+    "on_ready",
+    "on_audit_log_entry_create",
+    "on_guild_channel_create",
+    "on_guild_channel_delete",
+    "on_guild_role_create",
+    "on_guild_role_delete",
+    "on_member_ban",
+    "on_member_remove",
+    "on_member_update",
+    "on_message",
+)
+
+bot = commands.Bot(command_prefix='!', help_command=None, **discord_profile(GATEWAY_LISTENERS))
 
 # Create a folder for storing JSON files
 DATA_FOLDER = "data"
@@ -20,81 +51,209 @@ os.makedirs(DATA_FOLDER, exist_ok=True)
 # File paths for JSON files
 WHITELIST_FILE = os.path.join(DATA_FOLDER, "whitelist.json")
 SETTINGS_FILE = os.path.join(DATA_FOLDER, "settings.json")
-
-# Store whitelist and settings
-class Config:
-    def __init__(self):
-        self.whitelist = set(self.load_json(WHITELIST_FILE, []))
-        self.settings = self.load_json(SETTINGS_FILE, {
-            "anti_channel_create": True,
-            "anti_channel_delete": True,
-            "anti_role_create": True,
-            "anti_role_delete": True,
-            "anti_ban": True,
-            "anti_kick": True,
-            "punishment": "timeout",  # can be "timeout" or "kick"
-            "timeout_duration": 600,  # duration in seconds
-            "anti_invite_links": True,
-            "anti_mass_messages": True,
-            "mass_message_threshold": 5,
-            "mass_message_timeframe": 10  # seconds
-        })
-
-    def load_json(self, file_path, default):
-        if os.path.exists(file_path):
-            with open(file_path, "r") as file:
-                return json.load(file)
-        return default
-
-    def save_json(self, file_path, data):
-        with open(file_path, "w") as file:
-            json.dump(data, file, default=str, indent=4)
-
-    def save(self):
-        self.save_json(WHITELIST_FILE, list(self.whitelist))
-        self.save_json(SETTINGS_FILE, self.settings)
-
-
-config = Config()
-
-# Dictionary to track recent messages for anti-mass messaging
-recent_messages = defaultdict(lambda: deque(maxlen=config.settings["mass_message_threshold"]))
+GUILDS_FOLDER = os.path.join(DATA_FOLDER, "guilds")
+TRUST_DB = os.path.join(DATA_FOLDER, "trust.sqlite3")
+METRICS_FILE = os.path.join(DATA_FOLDER, "metrics.json")
+LOCKDOWN_FILE = os.path.join(DATA_FOLDER, "lockdowns.json")
+SCHEDULE_FILE = os.path.join(DATA_FOLDER, "schedule.json")
+
+# Local port for the Prometheus endpoint, 0 to disable it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))
+
+
+def load_json(file_path, default):
+    if os.path.exists(file_path):
+        with open(file_path, "r") as file:
+            return json.load(file)
+    return default
+
+
+# Invite and blocked-word matcher, compiled per guild
+content_filter = ContentFilter()
+
+def role_members(guild_id, role_id):
+    # From the member cache, so a newly whitelisted role applies at once
+    guild = bot.get_guild(guild_id)
+    role = guild.get_role(role_id) if guild else None
+    return [(member.id, [r.id for r in member.roles]) for member in role.members] if role else ()
+
+
+# Per-guild whitelisted users and roles, shared with cracker.py. The old
+# global whitelist.json, if present, keeps applying in every guild.
+trust = TrustList(TRUST_DB, resolve_role=role_members)
+legacy_whitelist = load_json(WHITELIST_FILE, None)
+if legacy_whitelist is not None:
+    trust.import_entries("antieverything:whitelist.json", [(GLOBAL, USER, user_id) for user_id in legacy_whitelist])
+
+
+def on_config_load(guild_id, settings):
+    content_filter.set_guild_words(guild_id, settings.blocklist)
+    if settings.whitelist:
+        trust.import_entries(f"antieverything:guilds/{guild_id}",
+                             [(guild_id, USER, user_id) for user_id in settings.whitelist])
+
+
+# Per-guild settings. The old global settings.json, if present, becomes the
+# defaults for every guild.
+config = GuildConfigStore(
+    GUILDS_FOLDER,
+    defaults=dict(DEFAULT_SETTINGS, **load_json(SETTINGS_FILE, {})),
+    on_load=on_config_load,
+    on_evict=content_filter.forget
+)
+
+# Index of recent audit-log entries used to attribute actions to their author
+audit_logs = AuditLogTailer()
+
+# Per-(guild, user) message rates for anti-mass messaging, idle users expire
+recent_messages = SpamTracker()
+# Many accounts posting the same or slightly altered text
+duplicates = NearDuplicateDetector()
+
+# Metrics, served on METRICS_PORT and written to METRICS_FILE on shutdown
+registry = Registry()
+listener_seconds = registry.histogram("antieverything_listener_seconds", "Time spent in each event handler.",
+                                      ("listener",))
+command_seconds = registry.histogram("antieverything_command_seconds", "Time spent in each command.", ("command",))
+detections = registry.counter("antieverything_detections_total", "Actions flagged by the anti-nuke checks.",
+                              ("action",))
+deletions = registry.counter("antieverything_message_deletions_total", "Messages deleted by the bot.", ("reason",))
+punishments = registry.counter("antieverything_punishments_total", "Punishments applied.", ("kind",))
+lockdown_reverts = registry.counter("antieverything_lockdown_reverts_total", "Changes rolled back by lockdowns.",
+                                    ("kind",))
+lockdown_recovery = registry.histogram("antieverything_lockdown_recovery_seconds",
+                                       "Time from the first change of a raid until it was rolled back.",
+                                       buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600))
+rest_calls = registry.counter("antieverything_rest_calls_total", "REST calls made from the event handlers.",
+                              ("route",))
+ratelimits = registry.counter("antieverything_ratelimits_total", "Rate-limited REST responses.", ("logger",))
+RateLimitCounter(ratelimits, "discord.http")
+loop_lag = registry.histogram("antieverything_event_loop_lag_seconds", "How late the event loop runs scheduled work.")
+# Gateway events are handled from per-guild queues taken in turn, so a raid in
+# one guild cannot starve the rest; bans and deletions never wait behind
+# message scans, which are dropped first when a guild falls behind
+dispatcher = EventDispatcher()
+registry.collector("antieverything_event_queue_depth", "Events waiting to be handled per guild.", ("guild",),
+                   dispatcher.depths, replace=True)
+registry.collector("antieverything_events_total", "Events handled, failed or shed per priority.",
+                   ("priority", "outcome"), dispatcher.outcomes, kind="counter")
+loop_lag_task = None
+metrics_server = None
+trust_watch_task = None
+
+
+# Embed footer; the avatar is filled in once the bot is logged in
+footer = {"text": "AntiEverything Bot"}
+# Embeds built once, such as the help page
+embeds = EmbedTemplates(discord.Embed.copy)
+
+
+def alert_channel(guild_id, channel_id):
+    return config.get(guild_id).log_channel or channel_id
+
+
+async def send_message(channel_id, embed):
+    rest_calls.inc("create_message")
+    message = await bot.get_partial_messageable(channel_id).send(embed=embed)
+    return message.id
+
+
+async def edit_message(channel_id, message_id, embed):
+    rest_calls.inc("edit_message")
+    await bot.get_partial_messageable(channel_id).get_partial_message(message_id).edit(embed=embed)
+
+
+# Alerts and notices are sent by background tasks; repeats within a minute in
+# the same channel update one message with a count instead of posting another
+alerts = AlertDispatcher(send_message, edit_message, route=alert_channel)
+registry.collector("antieverything_alerts_total", "Alerts raised, and the messages sent or edited for them.",
+                   ("outcome",), lambda: {"raised": alerts.alerts, "sent": alerts.sent, "edited": alerts.edited,
+                                          "failed": alerts.failed}, kind="counter")
+
+
+def notice(key, title, text):
+    """Render function for a notice in the channel where it happened, from a template per ``key``."""
+    def render(count):
+        embed = embeds.copy(key, lambda: discord.Embed(title=title, color=discord.Color.red()).set_footer(**footer))
+        embed.description = text if count == 1 else f"{text} ({count} times)"
+        return embed
+
+    return render
+
+
+def is_trusted(guild, user):
+    # The bot's own cleanup shows up in the audit log like anyone else's
+    if user.id == bot.user.id:
+        return True
+    # The owner is never on the trust list, as only they can edit it
+    if user.id == guild.owner_id:
+        return True
+    # Audit-log entries carry a Member when it is cached, which brings its roles
+    if isinstance(user, discord.Member):
+        trust.observe_member(guild.id, user.id, [role.id for role in user.roles])
+    return trust.is_trusted(guild.id, user.id)
 
 
 @bot.event
 async def on_ready():
+    global loop_lag_task, metrics_server, trust_watch_task
+    # on_ready fires again after every reconnect
+    if loop_lag_task is None:
+        check_discord_listeners(bot, GATEWAY_LISTENERS)
+        footer["icon_url"] = bot.user.display_avatar.url
+        embeds.clear()
+        loop_lag_task = asyncio.create_task(monitor_loop_lag(loop_lag))
+        trust_watch_task = asyncio.create_task(trust.watch())
+        # Guilds still frozen from before a restart
+        asyncio.create_task(lockdowns.thaw_stale())
+        asyncio.create_task(scheduler.load())
+        if METRICS_PORT:
+            try:
+                metrics_server = await serve_metrics(registry, port=METRICS_PORT)
+            except OSError as e:
+                logging.error(f"Could not serve metrics on port {METRICS_PORT}: {e}")
     logging.info(f'Bot is ready as {bot.user}')
 
 
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started = time.perf_counter()
+
+
+@bot.after_invoke
+async def observe_command_time(ctx):
+    command_seconds.observe(time.perf_counter() - ctx.started, ctx.command.qualified_name)
+
+
 @bot.command()
 @commands.has_permissions(administrator=True)
-async def whitelist(ctx, member: discord.Member):
-    """Whitelist a user from anti-nuke checks"""
-    config.whitelist.add(member.id)
-    config.save()
+async def whitelist(ctx, member: typing.Union[discord.Member, discord.Role]):
+    """Whitelist a user, or everyone with a role, from anti-nuke checks"""
+    trust.add(ctx.guild.id, ROLE if isinstance(member, discord.Role) else USER, member.id)
     embed = discord.Embed(
         title="Whitelist",
         description=f"{member.mention} has been whitelisted.",
         color=discord.Color.green()
     )
-    embed.set_thumbnail(url=member.avatar.url)
-    embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
+    if isinstance(member, discord.Member):
+        embed.set_thumbnail(url=member.display_avatar.url)
+    embed.set_footer(**footer)
     await ctx.send(embed=embed)
 
 
 @bot.command()
 @commands.has_permissions(administrator=True)
-async def unwhitelist(ctx, member: discord.Member):
-    """Remove a user from whitelist"""
-    config.whitelist.discard(member.id)
-    config.save()
+async def unwhitelist(ctx, member: typing.Union[discord.Member, discord.Role]):
+    """Remove a user or role from whitelist"""
+    trust.remove(ctx.guild.id, ROLE if isinstance(member, discord.Role) else USER, member.id)
     embed = discord.Embed(
         title="Unwhitelist",
         description=f"{member.mention} has been removed from the whitelist.",
         color=discord.Color.red()
     )
-    embed.set_thumbnail(url=member.avatar.url)
-    embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
+    if isinstance(member, discord.Member):
+        embed.set_thumbnail(url=member.display_avatar.url)
+    embed.set_footer(**footer)
     await ctx.send(embed=embed)
 
 
@@ -102,8 +261,9 @@ async def unwhitelist(ctx, member: discord.Member):
 @commands.has_permissions(administrator=True)
 async def viewwhitelist(ctx):
     """View the current whitelist"""
-    if config.whitelist:
-        members = [f"<@{member_id}>" for member_id in config.whitelist]
+    users, roles = trust.entries(ctx.guild.id)
+    if users or roles:
+        members = [f"<@{member_id}>" for member_id in users] + [f"<@&{role_id}>" for role_id in roles]
         embed = discord.Embed(
             title="Whitelisted Members",
             description="\n".join(members),
@@ -115,7 +275,7 @@ async def viewwhitelist(ctx):
             description="The whitelist is currently empty.",
             color=discord.Color.blue()
         )
-    embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
+    embed.set_footer(**footer)
     await ctx.send(embed=embed)
 
 
@@ -123,103 +283,366 @@ async def viewwhitelist(ctx):
 @commands.has_permissions(administrator=True)
 async def viewsettings(ctx):
     """View the current anti-nuke settings"""
-    settings = "\n".join([f"{key}: {value}" for key, value in config.settings.items()])
-    embed = discord.Embed(
-        title="Current Settings",
-        description=settings,
-        color=discord.Color.blue()
-    )
-    embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
+    settings = config.get(ctx.guild.id).merged(config.defaults)
+    embed = embeds.copy("settings", lambda: discord.Embed(title="Current Settings", color=discord.Color.blue())
+                        .set_footer(**footer))
+    embed.description = "\n".join([f"{key}: {value}" for key, value in settings.items()])
     await ctx.send(embed=embed)
 
 
+# A member punished again before this long has passed since their timeout
+# ended is kicked instead
+ESCALATION_WINDOW = 24 * 3600
+
+
+async def expire_escalation(guild_id, member_id, reason):
+    # Nothing to undo; the member's next offence starts over with a timeout
+    pass
+
+
+# Pending escalations, kept across restarts
+scheduler = Scheduler(SCHEDULE_FILE, {"escalation": expire_escalation})
+
+
 async def handle_punishment(guild: discord.Guild, member: discord.Member):
-    if config.settings["punishment"] == "timeout":
-        duration = config.settings["timeout_duration"]
+    # Audit-log entries may carry a plain User when the member is not cached
+    if not isinstance(member, discord.Member):
+        member = guild.get_member(member.id) or await guild.fetch_member(member.id)
+    settings = config.get(guild.id)
+    if not settings.kick and scheduler.due("escalation", guild.id, member.id) is None:
+        duration = settings.timeout_duration
         await member.timeout_for(datetime.timedelta(seconds=duration), reason="Anti-nuke: Suspicious activity")
+        punishments.inc("timeout")
+        scheduler.schedule("escalation", guild.id, member.id, time.time() + duration + ESCALATION_WINDOW)
     else:
         await guild.kick(member, reason="Anti-nuke: Suspicious activity")
+        scheduler.cancel("escalation", guild.id, member.id)
+        punishments.inc("kick")
+
+
+# Punishments and cleanup run off the event handlers, coalesced per actor
+remediation = RemediationExecutor(handle_punishment)
+registry.collector("antieverything_remediation_queue_depth", "Punishments and cleanups waiting per route.",
+                   ("route",), lambda: {route: stats["depth"] for route, stats in remediation.stats().items()})
+registry.collector("antieverything_remediation_completed_total", "Punishment and cleanup REST calls that succeeded.",
+                   ("route",), lambda: dict(remediation.completed), kind="counter")
+registry.collector("antieverything_remediation_failed_total", "Punishment and cleanup REST calls that failed.",
+                   ("route",), lambda: dict(remediation.failed), kind="counter")
 
 
+def lockdown_embed(report):
+    reverted = report.reverted
+    embed = discord.Embed(
+        title="Lockdown Lifted",
+        description=(f"{report.reason}\nRecovered {report.time_to_recover:.1f}s after the first change; "
+                     f"the lockdown lasted {report.duration:.0f}s."),
+        color=discord.Color.orange() if report.failed else discord.Color.green()
+    )
+    embed.add_field(name="Channels", value=f"{reverted[CHANNEL_CREATE]} deleted, {reverted[CHANNEL_DELETE]} restored")
+    embed.add_field(name="Roles", value=f"{reverted[ROLE_CREATE]} deleted, {reverted[ROLE_DELETE]} restored")
+    embed.add_field(name="Permissions", value=f"{report.restored} overwrites and roles put back")
+    if report.failed:
+        embed.add_field(name="Failed", value=", ".join(f"{kind} {count}" for kind, count in report.failed.items()),
+                        inline=False)
+    embed.set_footer(**footer)
+    return embed
+
+
+async def report_lockdown(report):
+    lockdown_recovery.observe(report.time_to_recover)
+    for kind, count in report.reverted.items():
+        lockdown_reverts.inc(kind, amount=count)
+    guild = bot.get_guild(report.guild_id)
+    channel = guild.system_channel if guild is not None else None
+    embed = lockdown_embed(report)
+    alerts.alert(report.guild_id, channel.id if channel else None, "lockdown", lambda count: embed)
+
+
+# Mass channel and role changes by untrusted or unknown actors lock the guild
+# down, which rolls back the whole raid as one batch
+detector = RateDetector()
+# Raiders, invites and spam seen across guilds; when one spreads, every
+# guild's lockdown thresholds are lowered for a while
+correlator = CrossGuildCorrelator(detector.boost)
+registry.collector("antieverything_correlated_keys", "Distinct actors, invites and messages, and guilds, seen lately.",
+                   ("kind",), correlator.distinct)
+registry.collector("antieverything_correlation_trends_total", "Keys seen spreading across guilds.", ("kind",),
+                   lambda: correlator.trends, kind="counter")
+registry.collector("antieverything_fingerprinted_messages", "Recent messages indexed for near-duplicate detection.",
+                   (), lambda: {(): len(duplicates)})
+lockdowns = LockdownManager(DiscordGuildAPI(bot), on_end=report_lockdown, state_path=LOCKDOWN_FILE)
+LOCKDOWN_REASONS = {
+    CHANNEL_CREATES: "Mass channel creation detected!",
+    CHANNEL_DELETES: "Mass channel deletion detected!",
+    ROLE_CREATES: "Mass role creation detected!",
+    ROLE_DELETES: "Mass role deletion detected!",
+}
+
+
+def suspicious(guild, change, entry, action):
+    # Changes by trusted actors are never undone, not even by a lockdown;
+    # unattributed ones only count towards one and are rolled back by it
+    if entry is not None and is_trusted(guild, entry.user):
+        change.resolve(False)
+        return False
+    if entry is not None:
+        correlator.observe(ACTOR, entry.user.id, guild.id)
+    if detector.hit(guild.id, action):
+        lockdowns.trigger(guild.id, LOCKDOWN_REASONS[action])
+    if entry is None:
+        change.resolve(True)
+        return False
+    return True
+
+
+def guild_of(obj):
+    return obj.guild.id
+
+
+# Inline rather than queued: the queued handlers below wait for these entries
 @bot.event
+@listener_seconds.time("on_audit_log_entry_create")
+async def on_audit_log_entry_create(entry):
+    audit_logs.feed(entry)
+
+
+@bot.event
+@dispatcher.queued(NORMAL, guild_of)
+@listener_seconds.time("on_guild_channel_create")
 async def on_guild_channel_create(channel):
-    async for entry in channel.guild.audit_logs(limit=1, action=discord.AuditLogAction.channel_create):
-        if entry.user.id not in config.whitelist and config.settings["anti_channel_create"]:
-            await channel.delete()
-            await handle_punishment(channel.guild, entry.user)
+    settings = config.get(channel.guild.id)
+    if not settings.flags & ANTI_CHANNEL_CREATE:
+        return
+    # Journaled before anything is awaited, so a lockdown sees it straight away
+    change = lockdowns.record(channel.guild.id, CHANNEL_CREATE, {"id": channel.id}, attributed=True)
+    if change is None:
+        return
+    entry = await audit_logs.resolve(channel.guild, discord.AuditLogAction.channel_create, channel.id)
+    if suspicious(channel.guild, change, entry, CHANNEL_CREATES):
+        detections.inc("channel_create")
+        remediation.punish(channel.guild, entry.user)
+        if lockdowns.active(channel.guild.id):
+            change.resolve(True)
+        else:
+            lockdowns.expect(channel.guild.id, channel.id)
+            remediation.cleanup("channel_delete", channel.guild, entry.user, channel, channel.delete)
+            change.resolve(False)
 
 
 @bot.event
+@dispatcher.queued(CRITICAL, guild_of)
+@listener_seconds.time("on_guild_channel_delete")
 async def on_guild_channel_delete(channel):
-    async for entry in channel.guild.audit_logs(limit=1, action=discord.AuditLogAction.channel_delete):
-        if entry.user.id not in config.whitelist and config.settings["anti_channel_delete"]:
-            await handle_punishment(channel.guild, entry.user)
+    settings = config.get(channel.guild.id)
+    if not settings.flags & ANTI_CHANNEL_DELETE:
+        return
+    change = lockdowns.record(channel.guild.id, CHANNEL_DELETE, lockdowns.api.channel_spec(channel), attributed=True)
+    if change is None:
+        return
+    entry = await audit_logs.resolve(channel.guild, discord.AuditLogAction.channel_delete, channel.id)
+    if suspicious(channel.guild, change, entry, CHANNEL_DELETES):
+        detections.inc("channel_delete")
+        remediation.punish(channel.guild, entry.user)
+        change.resolve(True)
 
 
 @bot.event
+@dispatcher.queued(NORMAL, guild_of)
+@listener_seconds.time("on_guild_role_create")
 async def on_guild_role_create(role):
-    async for entry in role.guild.audit_logs(limit=1, action=discord.AuditLogAction.role_create):
-        if entry.user.id not in config.whitelist and config.settings["anti_role_create"]:
-            await role.delete()
-            await handle_punishment(role.guild, entry.user)
+    settings = config.get(role.guild.id)
+    if not settings.flags & ANTI_ROLE_CREATE:
+        return
+    change = lockdowns.record(role.guild.id, ROLE_CREATE, {"id": role.id}, attributed=True)
+    if change is None:
+        return
+    entry = await audit_logs.resolve(role.guild, discord.AuditLogAction.role_create, role.id)
+    if suspicious(role.guild, change, entry, ROLE_CREATES):
+        detections.inc("role_create")
+        remediation.punish(role.guild, entry.user)
+        if lockdowns.active(role.guild.id):
+            change.resolve(True)
+        else:
+            lockdowns.expect(role.guild.id, role.id)
+            remediation.cleanup("role_delete", role.guild, entry.user, role, role.delete)
+            change.resolve(False)
 
 
 @bot.event
+@dispatcher.queued(CRITICAL, guild_of)
+@listener_seconds.time("on_guild_role_delete")
 async def on_guild_role_delete(role):
-    async for entry in role.guild.audit_logs(limit=1, action=discord.AuditLogAction.role_delete):
-        if entry.user.id not in config.whitelist and config.settings["anti_role_delete"]:
-            await handle_punishment(role.guild, entry.user)
+    settings = config.get(role.guild.id)
+    if not settings.flags & ANTI_ROLE_DELETE:
+        return
+    change = lockdowns.record(role.guild.id, ROLE_DELETE, lockdowns.api.role_spec(role), attributed=True)
+    if change is None:
+        return
+    entry = await audit_logs.resolve(role.guild, discord.AuditLogAction.role_delete, role.id)
+    if suspicious(role.guild, change, entry, ROLE_DELETES):
+        detections.inc("role_delete")
+        remediation.punish(role.guild, entry.user)
+        change.resolve(True)
 
 
 @bot.event
+@dispatcher.queued(CRITICAL, lambda guild, user: guild.id)
+@listener_seconds.time("on_member_ban")
 async def on_member_ban(guild, user):
-    async for entry in guild.audit_logs(limit=1, action=discord.AuditLogAction.ban):
-        if entry.user.id not in config.whitelist and config.settings["anti_ban"]:
-            await guild.unban(user)
-            await handle_punishment(guild, entry.user)
+    settings = config.get(guild.id)
+    if not settings.flags & ANTI_BAN:
+        return
+    entry = await audit_logs.resolve(guild, discord.AuditLogAction.ban, user.id)
+    if entry and not is_trusted(guild, entry.user):
+        correlator.observe(ACTOR, entry.user.id, guild.id)
+        detections.inc("ban")
+        remediation.punish(guild, entry.user)
+        remediation.cleanup("unban", guild, entry.user, user, guild.unban, user)
 
 
 @bot.event
+@dispatcher.queued(CRITICAL, guild_of)
+@listener_seconds.time("on_member_remove")
 async def on_member_remove(member):
-    async for entry in member.guild.audit_logs(limit=1, action=discord.AuditLogAction.kick):
-        if entry.user.id not in config.whitelist and config.settings["anti_kick"]:
-            await handle_punishment(member.guild, entry.user)
+    trust.forget_member(member.guild.id, member.id)
+    settings = config.get(member.guild.id)
+    if not settings.flags & ANTI_KICK:
+        return
+    entry = await audit_logs.resolve(member.guild, discord.AuditLogAction.kick, member.id)
+    if entry and not is_trusted(member.guild, entry.user):
+        correlator.observe(ACTOR, entry.user.id, member.guild.id)
+        detections.inc("kick")
+        remediation.punish(member.guild, entry.user)
+
+
+@bot.event
+@listener_seconds.time("on_member_update")
+async def on_member_update(before, after):
+    if before.roles != after.roles:
+        trust.observe_member(after.guild.id, after.id, [role.id for role in after.roles])
 
 
 @bot.event
 async def on_message(message):
-    if message.author.bot:
+    if message.author.bot or not message.guild:
         return
-
-    # Anti-invite links
-    if config.settings["anti_invite_links"] and "discord.gg/" in message.content:
+    # Commands are not shed along with the plain message scans
+    priority = NORMAL if message.content.startswith(bot.command_prefix) else LOW
+    dispatcher.submit(message.guild.id, priority, handle_message, message)
+
+
+def is_exempt(message):
+    # Trusted members and administrators are not filtered, not least so that
+    # !blockword remove, which names the blocked word, can reach the command
+    author = message.author
+    return is_trusted(message.guild, author) or (isinstance(author, discord.Member) and
+                                                 author.guild_permissions.administrator)
+
+
+@listener_seconds.time("on_message")
+async def handle_message(message):
+    settings = config.get(message.guild.id)
+    exempt = is_exempt(message)
+
+    # Anti-invite links and blocked words
+    match = not exempt and content_filter.scan(message.guild.id, message.content,
+                                               invites=bool(settings.flags & ANTI_INVITE_LINKS))
+    if match:
+        # Blocked words are each guild's own choice and say nothing about a
+        # raid, so only invites are correlated across guilds
+        if match[0] == "invite":
+            correlator.observe_message(message.guild.id, message.author.id, message.content,
+                                       invite_code(message.content, match[1]))
+        detections.inc(match[0])
+        deletions.inc(match[0])
+        rest_calls.inc("delete_message")
         await message.delete()
-        embed = discord.Embed(
-            title="Invite Link Detected",
-            description=f"{message.author.mention}, invite links are not allowed.",
-            color=discord.Color.red()
-        )
-        embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
-        await message.channel.send(embed=embed)
+        if match[0] == "invite":
+            render = notice("invite", "Invite Link Detected", f"{message.author.mention}, invite links are not allowed.")
+        else:
+            render = notice("blocked_word", "Blocked Word Detected",
+                            f"{message.author.mention}, that word is not allowed here.")
+        alerts.alert(message.guild.id, message.channel.id, match[0], render, route=False)
         return
 
+    # Anti-coordinated spam
+    if settings.flags & ANTI_DUPLICATE_MESSAGES and not exempt:
+        cluster = duplicates.check(message.guild.id, message.author.id, message.content,
+                                   (message.channel.id, message.id))
+        if cluster is not None:
+            remove_duplicates(message.guild, message.channel.id, cluster)
+            return
+
     # Anti-mass messages
-    if config.settings["anti_mass_messages"]:
-        now = datetime.datetime.now()
-        recent_messages[message.author.id].append(now)
-
-        if len(recent_messages[message.author.id]) == config.settings["mass_message_threshold"]:
-            first_message_time = recent_messages[message.author.id][0]
-            if (now - first_message_time).total_seconds() < config.settings["mass_message_timeframe"]:
-                embed = discord.Embed(
-                    title="Mass Messaging Detected",
-                    description=f"{message.author.mention}, you are sending messages too quickly.",
-                    color=discord.Color.red()
-                )
-                embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
-                await message.channel.send(embed=embed)
-                await handle_punishment(message.guild, message.author)
-                recent_messages[message.author.id].clear()
+    if settings.flags & ANTI_MASS_MESSAGES:
+        if recent_messages.hit(message.guild.id, message.author.id,
+                               settings.mass_message_threshold, settings.mass_message_timeframe):
+            correlator.observe_message(message.guild.id, message.author.id, message.content)
+            detections.inc("mass_messages")
+            alerts.alert(message.guild.id, message.channel.id, "mass_messages",
+                         notice("mass_messages", "Mass Messaging Detected",
+                                f"{message.author.mention}, you are sending messages too quickly."), route=False)
+            remediation.punish(message.guild, message.author)
+            recent_messages.reset(message.guild.id, message.author.id)
+
+    # Overriding on_message replaces the handler that runs prefix commands
+    await bot.process_commands(message)
+
+
+def remove_duplicates(guild, channel_id, cluster):
+    # The cluster's accounts are punished and everything they posted is
+    # deleted, including what came before it was flagged
+    for author_id, (message_channel_id, message_id) in cluster.take():
+        correlator.observe_message(guild.id, author_id, cluster.text)
+        author = discord.Object(id=author_id)
+        remediation.punish(guild, author)
+        message = bot.get_partial_messageable(message_channel_id).get_partial_message(message_id)
+        deletions.inc("duplicate_messages")
+        rest_calls.inc("delete_message")
+        remediation.cleanup("message_delete", guild, author, message, message.delete)
+    if cluster.flagged == 1:
+        detections.inc("duplicate_messages")
+        alerts.alert(guild.id, channel_id, "duplicate_messages",
+                     notice("duplicate_messages", "Coordinated Spam Detected",
+                            f"{len(cluster.authors)} accounts posted near-identical messages; they have been "
+                            f"punished and their messages removed."))
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def blockword(ctx, action: str, *, word: str):
+    """Add or remove a blocked word for this server"""
+    action = action.lower()
+    words = set(config.get(ctx.guild.id).blocklist)
+    if action == "add":
+        words.add(word.lower())
+    elif action == "remove":
+        words.discard(word.lower())
+    else:
+        return
+    config.set_blocklist(ctx.guild.id, words)
+    content_filter.set_guild_words(ctx.guild.id, words)
+    embed = discord.Embed(
+        title="Blocklist Updated",
+        description=f"`{word}` has been {'added to' if action == 'add' else 'removed from'} the blocklist.",
+        color=discord.Color.green()
+    )
+    embed.set_footer(**footer)
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def blockwords(ctx):
+    """View the blocked words for this server"""
+    words = config.get(ctx.guild.id).blocklist
+    embed = discord.Embed(
+        title="Blocked Words",
+        description="\n".join(f"`{word}`" for word in words) if words else "The blocklist is currently empty.",
+        color=discord.Color.blue()
+    )
+    embed.set_footer(**footer)
+    await ctx.send(embed=embed)
 
 
 @bot.command()
@@ -235,43 +658,40 @@ async def antinuke(ctx, setting: str, value: str):
         "bans": ["anti_ban"],
         "kicks": ["anti_kick"],
         "invite_links": ["anti_invite_links"],
-        "mass_messages": ["anti_mass_messages"]
+        "mass_messages": ["anti_mass_messages"],
+        "duplicate_messages": ["anti_duplicate_messages"]
     }
 
     if setting in valid_settings:
         if value in ["on", "off"]:
-            for key in valid_settings[setting]:
-                config.settings[key] = (value == "on")
-            config.save()
+            config.update(ctx.guild.id, **{key: value == "on" for key in valid_settings[setting]})
             embed = discord.Embed(
                 title="Anti-Nuke Setting Updated",
                 description=f"Anti-{setting} has been turned {value}.",
                 color=discord.Color.green()
             )
-            embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
+            embed.set_footer(**footer)
             await ctx.send(embed=embed)
     elif setting == "punishment":
         if value in ["timeout", "kick"]:
-            config.settings["punishment"] = value
-            config.save()
+            config.update(ctx.guild.id, punishment=value)
             embed = discord.Embed(
                 title="Punishment Setting Updated",
                 description=f"Punishment has been set to {value}.",
                 color=discord.Color.green()
             )
-            embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
+            embed.set_footer(**footer)
             await ctx.send(embed=embed)
     elif setting == "timeout_duration":
         try:
             duration = int(value)
-            config.settings["timeout_duration"] = duration
-            config.save()
+            config.update(ctx.guild.id, timeout_duration=duration)
             embed = discord.Embed(
                 title="Timeout Duration Updated",
                 description=f"Timeout duration has been set to {duration} seconds.",
                 color=discord.Color.green()
             )
-            embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
+            embed.set_footer(**footer)
             await ctx.send(embed=embed)
         except ValueError:
             embed = discord.Embed(
@@ -279,26 +699,144 @@ async def antinuke(ctx, setting: str, value: str):
                 description="Please provide a valid number for timeout duration.",
                 color=discord.Color.red()
             )
-            embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
+            embed.set_footer(**footer)
+            await ctx.send(embed=embed)
+    elif setting in ["mass_message_threshold", "mass_message_timeframe"]:
+        try:
+            number = int(value)
+            if number < 1:
+                raise ValueError
+            # Read by the spam tracker on every message, so this applies immediately
+            config.update(ctx.guild.id, **{setting: number})
+            embed = discord.Embed(
+                title="Mass Messaging Updated",
+                description=f"{setting.replace('_', ' ').capitalize()} has been set to {number}.",
+                color=discord.Color.green()
+            )
+            embed.set_footer(**footer)
+            await ctx.send(embed=embed)
+        except ValueError:
+            embed = discord.Embed(
+                title="Invalid Value",
+                description=f"Please provide a positive whole number for {setting.replace('_', ' ')}.",
+                color=discord.Color.red()
+            )
+            embed.set_footer(**footer)
             await ctx.send(embed=embed)
+    elif setting == "log_channel":
+        # A channel mention or id, or "off" for the system channel
+        channel_id = None if value == "off" else value.strip("<#>")
+        if channel_id is None or channel_id.isdigit() and ctx.guild.get_channel(int(channel_id)):
+            config.update(ctx.guild.id, log_channel=channel_id and int(channel_id))
+            embed = discord.Embed(
+                title="Log Channel Updated",
+                description=(f"Anti-nuke alerts will be sent to <#{channel_id}>." if channel_id else
+                             "Anti-nuke alerts will be sent to the system channel."),
+                color=discord.Color.green()
+            )
+        else:
+            embed = discord.Embed(
+                title="Invalid Channel",
+                description="Please mention a channel in this server, or use off.",
+                color=discord.Color.red()
+            )
+        embed.set_footer(**footer)
+        await ctx.send(embed=embed)
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def queues(ctx):
+    """View punishment, cleanup and event queue metrics"""
+    embed = discord.Embed(
+        title="Queues",
+        description=f"Events waiting in this server: {dispatcher.depth(ctx.guild.id)}",
+        color=discord.Color.blue()
+    )
+    for priority, stats in dispatcher.stats().items():
+        embed.add_field(
+            name=f"{priority} events",
+            value=(f"depth {stats['depth']}, done {stats['completed']}, failed {stats['failed']}, "
+                   f"shed {stats['shed']}\nwaited p50 {stats['p50'] * 1000:.0f} ms, p99 {stats['p99'] * 1000:.0f} ms"),
+            inline=False
+        )
+    for route, stats in remediation.stats().items():
+        embed.add_field(
+            name=route,
+            value=(f"depth {stats['depth']}, done {stats['completed']}, failed {stats['failed']}, "
+                   f"coalesced {stats['coalesced']}\np50 {stats['p50'] * 1000:.0f} ms, p99 {stats['p99'] * 1000:.0f} ms"),
+            inline=False
+        )
+    embed.set_footer(**footer)
+    await ctx.send(embed=embed)
+
+
+@bot.command(name="lockdown")
+@commands.has_permissions(administrator=True)
+async def start_lockdown(ctx):
+    """Freeze the server and roll back recent channel and role changes"""
+    lockdowns.trigger(ctx.guild.id, f"Lockdown started by {ctx.author}.")
+    embed = discord.Embed(
+        title="Lockdown",
+        description=(f"@everyone has been frozen and channel and role changes from the last "
+                     f"{lockdowns.lookback:.0f} seconds are being rolled back. Use `!unlock` to lift it."),
+        color=discord.Color.red()
+    )
+    embed.set_footer(**footer)
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def unlock(ctx):
+    """Finish rolling back and lift the lockdown"""
+    report = await lockdowns.end(ctx.guild.id)
+    if report is None:
+        embed = discord.Embed(
+            title="Lockdown",
+            description="This server is not locked down.",
+            color=discord.Color.blue()
+        )
+        embed.set_footer(**footer)
+    else:
+        embed = lockdown_embed(report)
+    await ctx.send(embed=embed)
 
 
 @bot.command(name="help")
 async def bothelp(ctx):
     """Displays the help message"""
+    await ctx.send(embed=embeds.get("help", help_embed))
+
+
+def help_embed():
     embed = discord.Embed(
         title="Help",
         description="List of available commands:",
         color=discord.Color.blue()
     )
-    embed.add_field(name="!whitelist <member>", value="Whitelist a user from anti-nuke checks", inline=False)
-    embed.add_field(name="!unwhitelist <member>", value="Remove a user from whitelist", inline=False)
+    embed.add_field(name="!whitelist <member|role>", value="Whitelist a user or role from anti-nuke checks", inline=False)
+    embed.add_field(name="!unwhitelist <member|role>", value="Remove a user or role from whitelist", inline=False)
     embed.add_field(name="!viewwhitelist", value="View the current whitelist", inline=False)
     embed.add_field(name="!viewsettings", value="View the current anti-nuke settings", inline=False)
     embed.add_field(name="!antinuke <setting> <value>", value="Configure anti-nuke settings", inline=False)
+    embed.add_field(name="!blockword <add|remove> <word>", value="Manage this server's blocked words", inline=False)
+    embed.add_field(name="!blockwords", value="View this server's blocked words", inline=False)
+    embed.add_field(name="!queues", value="View punishment, cleanup and event queue metrics", inline=False)
+    embed.add_field(name="!lockdown", value="Freeze the server and roll back recent channel and role changes",
+                    inline=False)
+    embed.add_field(name="!unlock", value="Finish rolling back and lift the lockdown", inline=False)
     embed.add_field(name="!help", value="Displays this help message", inline=False)
-    embed.set_footer(text="AntiEverything Bot", icon_url=bot.user.avatar.url)
-    await ctx.send(embed=embed)
+    embed.set_footer(**footer)
+    return embed
+
 
 # Replace 'YOUR_TOKEN' with your bot's token
-bot.run(os.getenv('YOUR_TOKEN'))
+if __name__ == "__main__":
+    bot.run(os.getenv('YOUR_TOKEN'))
+    dispatcher.close()
+    alerts.close()
+    config.close()
+    trust.close()
+    scheduler.close()
+    registry.dump(METRICS_FILE)
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+
+# Start of Discord's snowflake timestamps, in milliseconds since the Unix epoch
+DISCORD_EPOCH = 1420070400000
+
+
+def snowflake_time(snowflake):
+    """Unix time, in seconds, at which Discord created ``snowflake``."""
+    return ((int(snowflake) >> 22) + DISCORD_EPOCH) / 1000
+
+
+class _GuildTail:
+    __slots__ = ("entries", "waiters", "last_id", "poll_task", "polled_at")
+
+    def __init__(self):
+        # (action, target_id) -> (entry, when Discord created it), roughly oldest first
+        self.entries = {}
+        self.waiters = {}
+        self.last_id = None
+        self.poll_task = None
+        self.polled_at = 0.0
+
+
+class AuditLogTailer:
+    """Resolves who performed an action from a per-guild index of audit-log entries.
+
+    Entries are indexed by ``(action, target_id)`` as they arrive, either fed
+    from the gateway through ``feed`` or pulled by a single poller per guild
+    that only runs while some handler is waiting. Many events in a burst
+    therefore share one ``audit_logs`` request instead of making one each,
+    and matching on the target means a handler can never pick up the entry
+    for somebody else's action. Only the newest entry for a key is kept, and
+    only until ``ttl`` seconds after Discord created it, going by its
+    snowflake, so neither a repeated action on the same target nor an old
+    entry a poll pulls in is blamed for a new event.
+
+    ``add`` and ``wait`` do the same for entries that are not shaped like
+    discord.py's, given by their parts, and only ever wait for the gateway.
+    """
+
+    def __init__(self, resolve_timeout=2.0, poll_interval=0.5, ttl=60.0, page_size=100):
+        self.resolve_timeout = resolve_timeout
+        self.poll_interval = poll_interval
+        self.ttl = ttl
+        self.page_size = page_size
+        self.rest_calls = 0
+        self.hits = 0
+        self.misses = 0
+        self._guilds = {}
+
+    def _tail(self, guild_id):
+        tail = self._guilds.get(guild_id)
+        if tail is None:
+            tail = self._guilds[guild_id] = _GuildTail()
+        return tail
+
+    def feed(self, entry):
+        """Index an entry received from the gateway."""
+        self._index(self._tail(entry.guild.id), entry)
+
+    def add(self, guild_id, action, target_id, entry):
+        """Index an entry received from the gateway, given by its parts."""
+        self._add(self._tail(guild_id), (action, target_id), entry)
+
+    def _index(self, tail, entry):
+        return self._add(tail, (entry.action, getattr(entry.target, "id", None)), entry)
+
+    def _add(self, tail, key, entry):
+        # Returns False for an entry too old to be behind any event handled now
+        if tail.last_id is None or entry.id > tail.last_id:
+            tail.last_id = entry.id
+        now = time.time()
+        created = snowflake_time(entry.id)
+        if created < now - self.ttl:
+            return False
+        found = tail.entries.get(key)
+        if found is None or entry.id > found[0].id:
+            # Moved to the end, so the entries stay ordered by when they were created
+            tail.entries.pop(key, None)
+            tail.entries[key] = found = (entry, created)
+        self._prune(tail, now)
+        for waiter in tail.waiters.pop(key, ()):
+            if not waiter.done():
+                waiter.set_result(found[0])
+        return True
+
+    async def resolve(self, guild, action, target_id):
+        """Return the audit-log entry for ``action`` on ``target_id``, or None."""
+        tail = self._tail(guild.id)
+        key = (action, target_id)
+        found = self._cached(tail, key)
+        if found is not None:
+            return found
+
+        self.misses += 1
+        started = time.monotonic()
+        entry = await self._wait(tail, key, guild)
+        # The poller has seen everything logged since this event and found no
+        # match, so there is nothing to attribute (e.g. a member left on their own).
+        if entry is not None or tail.polled_at > started:
+            return entry
+        return await self._fetch_one(guild, tail, action, target_id)
+
+    async def wait(self, guild_id, action, target_id):
+        """The entry ``add`` indexes for ``action`` on ``target_id`` within ``resolve_timeout``, or None."""
+        tail = self._tail(guild_id)
+        key = (action, target_id)
+        found = self._cached(tail, key)
+        if found is not None:
+            return found
+        self.misses += 1
+        return await self._wait(tail, key)
+
+    def _cached(self, tail, key):
+        found = tail.entries.get(key)
+        if found is not None and found[1] >= time.time() - self.ttl:
+            self.hits += 1
+            return found[0]
+        return None
+
+    async def _wait(self, tail, key, guild=None):
+        # Polls for the entry as well when given the guild to poll
+        waiter = asyncio.get_running_loop().create_future()
+        tail.waiters.setdefault(key, []).append(waiter)
+        if guild is not None and (tail.poll_task is None or tail.poll_task.done()):
+            tail.poll_task = asyncio.create_task(self._poll(guild, tail))
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), self.resolve_timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = tail.waiters.get(key)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del tail.waiters[key]
+
+    async def _poll(self, guild, tail):
+        # Only polled with discord.py, so cracker.py can use the tailer without it
+        import discord
+
+        while tail.waiters:
+            try:
+                self.rest_calls += 1
+                # After a quiet spell, start from the newest entries rather than
+                # paging forward through everything logged since.
+                if tail.last_id is None or time.monotonic() - tail.polled_at > self.ttl:
+                    entries = guild.audit_logs(limit=self.page_size)
+                else:
+                    entries = guild.audit_logs(limit=self.page_size, after=discord.Object(id=tail.last_id))
+                # Pages without ``after`` come newest first
+                for entry in sorted([entry async for entry in entries], key=lambda entry: entry.id):
+                    self._index(tail, entry)
+                tail.polled_at = time.monotonic()
+            except Exception as e:
+                logging.error(f"Error polling audit logs for guild {guild.id}: {e}")
+            self._prune(tail, time.time())
+            if tail.waiters:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _fetch_one(self, guild, tail, action, target_id):
+        self.rest_calls += 1
+        async for entry in guild.audit_logs(limit=10, action=action):
+            # Newest first, so the first match is the latest action on the target
+            if getattr(entry.target, "id", None) == target_id:
+                return entry if self._index(tail, entry) else None
+        return None
+
+    def _prune(self, tail, now):
+        entries = tail.entries
+        cutoff = now - self.ttl
+        while entries:
+            key = next(iter(entries))
+            if entries[key][1] >= cutoff:
+                break
+            del entries[key]
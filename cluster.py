@@ -0,0 +1,21 @@
+
+# Exit status a worker uses to ask the launcher to start it again right away
+RESTART_EXIT_CODE = 75
+
+
+def shard_for(guild_id, shard_count):
+    """The gateway shard Discord delivers a guild's events on."""
+    return (guild_id >> 22) % shard_count
+
+
+def shard_ranges(shard_count, workers):
+    """Split shards into ``workers`` contiguous, nearly equal ranges."""
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
@@ -0,0 +1,145 @@
+import re
+import time
+
+# Characters people put between the parts of an invite to dodge naive checks:
+# whitespace, brackets, markdown and zero-width characters.
+_SEP = r"[\s()\[\]{}<>*_|\\~`'\"\u200b-\u200d\u2060\ufeff-]{0,3}"
+_DOT = rf"{_SEP}(?:\.|dot){_SEP}"
+
+INVITE_PATTERNS = (
+    rf"discord{_DOT}(?:gg|io|me|li){_SEP}/",
+    rf"discord(?:app)?{_DOT}com{_SEP}/{_SEP}invite",
+    rf"dsc{_DOT}gg{_SEP}/",
+    rf"invite{_DOT}gg{_SEP}/",
+)
+# The code after an invite pattern, past the same dodging characters
+_INVITE_CODE = re.compile(rf"{_SEP}/?{_SEP}([A-Za-z0-9-]{{2,32}})")
+
+
+def _trie_pattern(words):
+    """Build a regex from literal words that branches on shared prefixes.
+
+    ``re`` tries each alternative of ``a|b|c`` in turn; folding the words into
+    a trie first keeps the work per position proportional to the longest
+    match instead of the number of words.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        if list(node) == [""]:
+            return ""
+        optional = "" in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        pattern = "(?:" + "|".join(branches) + ")"
+        return pattern + "?" if optional else pattern
+
+    return build(trie)
+
+
+class ContentFilter:
+    """Scans messages against invite patterns and per-guild blocklists in one pass.
+
+    Every rule for a guild is compiled into a single regex with one named
+    group per rule kind, cached per guild and rebuilt only after
+    ``set_guild_words`` changes that guild's list.
+    """
+
+    def __init__(self, invite_patterns=INVITE_PATTERNS):
+        self.invite_patterns = tuple(invite_patterns)
+        self._guild_words = {}
+        self._compiled = {}
+
+    def set_guild_words(self, guild_id, words):
+        self._guild_words[guild_id] = sorted({word.lower() for word in words if word})
+        self._compiled.pop((guild_id, True), None)
+        self._compiled.pop((guild_id, False), None)
+
+    def forget(self, guild_id):
+        self._guild_words.pop(guild_id, None)
+        self._compiled.pop((guild_id, True), None)
+        self._compiled.pop((guild_id, False), None)
+
+    def guild_words(self, guild_id):
+        return list(self._guild_words.get(guild_id, ()))
+
+    def _matcher(self, guild_id, invites):
+        key = (guild_id, invites)
+        matcher = self._compiled.get(key)
+        if matcher is None:
+            groups = []
+            if invites:
+                groups.append("(?P<invite>" + "|".join(self.invite_patterns) + ")")
+            words = self._guild_words.get(guild_id)
+            if words:
+                groups.append(r"(?P<blocked>\b" + _trie_pattern(words) + r"\b)")
+            matcher = re.compile("|".join(groups), re.IGNORECASE) if groups else None
+            self._compiled[key] = matcher
+        return matcher
+
+    def scan(self, guild_id, content, invites=True):
+        """Return ``(kind, matched_text)`` for the first hit, or None.
+
+        ``kind`` is ``"invite"`` or ``"blocked"``.
+        """
+        if not content:
+            return None
+        matcher = self._matcher(guild_id, invites)
+        if matcher is None:
+            return None
+        match = matcher.search(content)
+        if match is None:
+            return None
+        return match.lastgroup, match.group()
+
+
+def invite_code(content, matched_text):
+    """The invite code following ``matched_text``, an invite match from ``scan``, or None."""
+    start = content.find(matched_text)
+    if start < 0:
+        return None
+    code = _INVITE_CODE.match(content, start + len(matched_text))
+    return code.group(1) if code else None
+
+
+def _benchmark(messages=200_000):
+    import random
+
+    random.seed(0)
+    words = ("gg", "lol", "anyone", "up", "for", "ranked", "tonight", "the", "patch", "notes", "are", "out",
+             "check", "pinned", "message", "thanks", "nice", "clip", "bro", "what", "time", "is", "raid")
+    spam = ("join discord.gg/abc123 now", "free nitro discord.com/invite/xyz", "dsc.gg/server",
+            "discord . gg / hidden", "discord(.)gg/evil", "discord\u200b.gg/zw")
+    corpus = []
+    for _ in range(messages):
+        if random.random() < 0.02:
+            corpus.append(random.choice(spam))
+        else:
+            corpus.append(" ".join(random.choice(words) for _ in range(random.randint(3, 30))))
+    blocklist = ["free nitro", "steam gift", "crypto airdrop", "onlyfans"] + [f"slur{i}" for i in range(200)]
+    size = sum(len(text) for text in corpus) / 1e6
+
+    def naive(text):
+        lowered = text.lower()
+        return ("discord.gg/" in lowered or "discord.com/invite" in lowered or "dsc.gg/" in lowered
+                or any(word in lowered for word in blocklist))
+
+    content_filter = ContentFilter()
+    content_filter.set_guild_words(1, blocklist)
+
+    for name, check in (("naive substring checks", naive),
+                        ("ContentFilter.scan", lambda text: content_filter.scan(1, text))):
+        start = time.perf_counter()
+        hits = sum(1 for text in corpus if check(text))
+        elapsed = time.perf_counter() - start
+        print(f"{name:24} {messages / elapsed:>10,.0f} msg/s {size / elapsed:>7.1f} MB/s  {hits} hits")
+
+
+if __name__ == "__main__":
+    _benchmark()
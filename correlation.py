@@ -0,0 +1,311 @@
+import logging
+import math
+import re
+import time
+
+# Kinds of keys correlated across guilds
+ACTOR = "actor"
+INVITE = "invite"
+CONTENT = "content"
+KINDS = (ACTOR, INVITE, CONTENT)
+
+# Shorter texts, once normalized, are too common to say anything
+MIN_CONTENT = 16
+
+_MASK = (1 << 64) - 1
+_WORDS = re.compile(r"[^\W\d_]+")
+
+
+def _hash(*items):
+    # Python's tuple hash is fast but leaves the bits too uneven for the
+    # sketches; one more multiply-xorshift round fixes that
+    x = hash(items) & _MASK
+    x = (x ^ x >> 32) * 0xD6E8FEB86659FD93 & _MASK
+    return x ^ x >> 32
+
+
+def content_key(content, code=None):
+    """Message text reduced to its lowercase words, without ``code``; None if too short to compare."""
+    if code:
+        content = content.replace(code, " ")
+    text = " ".join(_WORDS.findall(content.casefold()))
+    return text if len(text) >= MIN_CONTENT else None
+
+
+class CountMinSketch:
+    """Approximate counts for any number of keys in four rows of 65,536 counters.
+
+    A key is given as a 64-bit hash, and each 16-bit quarter of it picks its
+    counter in one row. Estimates never undercount, and with conservative
+    updates overcount by at most about ``e / 65536`` of all counts added, in
+    all but ``exp(-4)`` of cases. Counters are single bytes that stop at 255,
+    which is plenty for counting guilds against a threshold of a few.
+    """
+
+    def __init__(self):
+        self.counts = bytearray(4 << 16)
+
+    @staticmethod
+    def cells(h):
+        return h & 0xFFFF, 0x10000 | h >> 16 & 0xFFFF, 0x20000 | h >> 32 & 0xFFFF, 0x30000 | h >> 48
+
+    def add(self, h, amount=1, cells=None):
+        """Count ``h`` and return its new estimate."""
+        counts = self.counts
+        a, b, c, d = cells or self.cells(h)
+        value = min(min(counts[a], counts[b], counts[c], counts[d]) + amount, 255)
+        # Conservative update: only the counters that were the minimum can be exact
+        for i in (a, b, c, d):
+            if counts[i] < value:
+                counts[i] = value
+        return value
+
+    def estimate(self, h, cells=None):
+        counts = self.counts
+        a, b, c, d = cells or self.cells(h)
+        return min(counts[a], counts[b], counts[c], counts[d])
+
+    def clear(self):
+        self.counts = bytearray(len(self.counts))
+
+    def nbytes(self):
+        return len(self.counts)
+
+
+class BloomFilter:
+    """Set membership in 2**20 bits, with false positives but no false negatives.
+
+    A member is given as a 64-bit hash, and three 20-bit slices of it pick its
+    bits; with 100,000 members about 1% of non-members test positive.
+    """
+
+    def __init__(self):
+        self.array = bytearray(1 << 17)
+
+    @staticmethod
+    def cells(h):
+        return h & 0xFFFFF, h >> 20 & 0xFFFFF, h >> 40 & 0xFFFFF
+
+    def add(self, h, cells=None):
+        """Add ``h``; returns False if it was (probably) there already."""
+        array = self.array
+        added = False
+        for bit in cells or self.cells(h):
+            byte = array[bit >> 3]
+            if not byte >> (bit & 7) & 1:
+                array[bit >> 3] = byte | 1 << (bit & 7)
+                added = True
+        return added
+
+    def __contains__(self, h):
+        return self.contains(h)
+
+    def contains(self, h, cells=None):
+        array = self.array
+        a, b, c = cells or self.cells(h)
+        return bool(array[a >> 3] >> (a & 7) & array[b >> 3] >> (b & 7) & array[c >> 3] >> (c & 7) & 1)
+
+    def clear(self):
+        self.array = bytearray(len(self.array))
+
+    def nbytes(self):
+        return len(self.array)
+
+
+class HyperLogLog:
+    """Distinct count of 64-bit hashes in ``2 ** p`` bytes, within about ``1.04 / sqrt(2 ** p)``."""
+
+    def __init__(self, p=12):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add(self, h):
+        index = h & ((1 << self.p) - 1)
+        rank = 65 - self.p - (h >> self.p).bit_length()
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self, *others):
+        """Estimated distinct hashes added here or to any of ``others``."""
+        registers = self.registers
+        for other in others:
+            registers = bytes(map(max, registers, other.registers))
+        m = len(registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in registers)
+        zeros = registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small counts: linear counting of the empty registers is more accurate
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def clear(self):
+        self.registers = bytearray(len(self.registers))
+
+    def nbytes(self):
+        return len(self.registers)
+
+
+class _Generation:
+    __slots__ = ("seen", "spread", "distinct")
+
+    def __init__(self, p):
+        # (kind, key, guild) sightings, guilds per (kind, key), and distinct keys and guilds
+        self.seen = BloomFilter()
+        self.spread = CountMinSketch()
+        self.distinct = {kind: HyperLogLog(p) for kind in KINDS + ("guild",)}
+
+    def clear(self):
+        self.seen.clear()
+        self.spread.clear()
+        for sketch in self.distinct.values():
+            sketch.clear()
+
+    def nbytes(self):
+        return self.seen.nbytes() + self.spread.nbytes() + sum(s.nbytes() for s in self.distinct.values())
+
+
+class CrossGuildCorrelator:
+    """Spots the same actor, invite or message turning up in many guilds at once.
+
+    ``observe(kind, key, guild_id)`` returns how many guilds ``key`` was seen
+    in lately. A Bloom filter of ``(kind, key, guild)`` sightings lets only a
+    guild's first sighting of a key through to a count-min sketch of guilds
+    per key, and HyperLogLogs count the distinct keys and guilds for the
+    metrics. All of them come in two generations of ``window`` seconds and
+    the older one is dropped when a new one starts, so a sighting counts for
+    one to two windows. Memory is fixed by the sketch sizes and each call is
+    a few hash computations, however many guilds and keys there are.
+
+    A key seen in ``spread`` guilds is trending, and ``on_trend(sensitivity,
+    until)`` is called so detection can be made more sensitive everywhere
+    until ``until`` on this correlator's clock; later sightings extend it.
+    Each process correlates the guilds it sees, so with several workers a
+    key has to spread within one worker's shards.
+    """
+
+    def __init__(self, on_trend=None, spread=3, window=600.0, sensitivity=0.6, boost_for=900.0, p=12,
+                 clock=time.monotonic):
+        self.on_trend = on_trend
+        self.spread = spread
+        self.window = window
+        self.sensitivity = sensitivity
+        self.boost_for = boost_for
+        self.clock = clock
+        self._generations = [_Generation(p), _Generation(p)]
+        self._rotate_at = None
+        # (kind, key) -> when its boost runs out
+        self.trending = {}
+        self.trends = {kind: 0 for kind in KINDS}
+
+    def observe(self, kind, key, guild_id):
+        """Record a sighting of ``key`` in a guild and return the number of guilds it was seen in."""
+        now = self.clock()
+        if self._rotate_at is None:
+            self._rotate_at = now + self.window
+        elif now >= self._rotate_at:
+            self._rotate(now)
+        current, previous = self._generations
+        h = _hash(kind, key)
+        current.distinct[kind].add(h)
+        current.distinct["guild"].add(_hash(guild_id))
+        # Worked out once for both generations
+        cells = CountMinSketch.cells(h)
+        bits = BloomFilter.cells(_hash(h, guild_id))
+        if not previous.seen.contains(None, bits) and current.seen.add(None, bits):
+            spread = current.spread.add(h, cells=cells)
+        else:
+            spread = current.spread.estimate(h, cells)
+        spread += previous.spread.estimate(h, cells)
+        if spread >= self.spread:
+            self._trend(kind, key, spread, now)
+        return spread
+
+    def observe_message(self, guild_id, author_id, content, code=None):
+        """Record an offending message: its author, the invite ``code`` it posted if any, and its text."""
+        self.observe(ACTOR, author_id, guild_id)
+        if code:
+            self.observe(INVITE, code, guild_id)
+        key = content_key(content, code)
+        if key is not None:
+            self.observe(CONTENT, key, guild_id)
+
+    def _trend(self, kind, key, spread, now):
+        until = now + self.boost_for
+        previous = self.trending.get((kind, key))
+        if previous is None or previous <= now:
+            self.trends[kind] += 1
+            logging.warning(f"{kind} {key!r} seen in {spread} guilds; raising detection sensitivity everywhere")
+            if len(self.trending) > 1024:
+                self.trending = {k: t for k, t in self.trending.items() if t > now}
+        self.trending[(kind, key)] = until
+        if self.on_trend is not None:
+            self.on_trend(self.sensitivity, until)
+
+    def _rotate(self, now):
+        windows = int((now - self._rotate_at) // self.window) + 1
+        self._rotate_at += windows * self.window
+        current, previous = self._generations
+        previous.clear()
+        if windows > 1:
+            # Nothing seen for over a window: both generations are stale
+            current.clear()
+        self._generations = [previous, current]
+
+    def distinct(self):
+        """Distinct keys of each kind, and guilds, seen in the last one to two windows."""
+        current, previous = self._generations
+        return {kind: sketch.count(previous.distinct[kind]) for kind, sketch in current.distinct.items()}
+
+    def nbytes(self):
+        return sum(generation.nbytes() for generation in self._generations)
+
+
+def _benchmark(observations=200_000, guild_counts=(100, 1_000, 10_000)):
+    import random
+    import tracemalloc
+
+    raider = 900000000000000000
+    for guilds in guild_counts:
+        rng = random.Random(guilds)
+        guild_ids = [1094926261459111936 + i for i in range(guilds)]
+        # Benign traffic: actors, invites and messages that each stay in one
+        # guild, and every 2,000 observations a raider hitting another guild
+        stream = []
+        for i in range(observations):
+            guild_id = rng.choice(guild_ids)
+            kind = KINDS[i % 3]
+            stream.append((kind, f"{guild_id}:{rng.randrange(50)}" if kind != ACTOR else guild_id * 100 + rng.randrange(50),
+                           guild_id))
+            if i % 2000 == 0:
+                stream.append((ACTOR, raider, guild_ids[i // 2000 % guilds]))
+
+        clock = [0.0]
+        correlator = CrossGuildCorrelator(clock=lambda: clock[0])
+        logging.disable(logging.WARNING)
+        raider_guilds = None
+        started = time.perf_counter()
+        for i, (kind, key, guild_id) in enumerate(stream):
+            clock[0] = i / 20
+            spread = correlator.observe(kind, key, guild_id)
+            if key == raider and raider_guilds is None and spread >= correlator.spread:
+                raider_guilds = spread
+        elapsed = time.perf_counter() - started
+        logging.disable(logging.NOTSET)
+        false_trends = sum(1 for kind, key in correlator.trending if key != raider)
+
+        # The exact alternative: a set of guilds per key
+        tracemalloc.start()
+        exact = {}
+        for kind, key, guild_id in stream:
+            exact.setdefault((kind, key), set()).add(guild_id)
+        exact_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        distinct = correlator.distinct()
+        print(f"{guilds:>6,} guilds: {elapsed / len(stream) * 1e6:.2f} µs per observation, sketches "
+              f"{correlator.nbytes() / 1024:,.0f} KB (exact sets {exact_bytes / 1024:,.0f} KB); raider trending "
+              f"once in {raider_guilds} guilds, {false_trends} false trends; {distinct['guild']:,} guilds and "
+              f"{distinct[ACTOR]:,} actors seen lately")
+
+
+if __name__ == "__main__":
+    _benchmark()
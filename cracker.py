@@ -1,14 +1,33 @@
+import asyncio
 import sys
+import time
 import hikari
 import lightbulb
-from collections import defaultdict, deque
+from collections import defaultdict
 import datetime
 import os
 import logging
 import json
+from glob import glob
 from dotenv import load_dotenv
-from PIL import Image, ImageDraw, ImageFont
-import io
+from imageworker import ImageWorkerPool, ImageJobRejected, RenderCache, render_text, build_gif, GIF_EFFECTS, MAX_UPLOAD_BYTES
+from logstore import WriteBehindLog, PartitionedLog
+from modlog import ModLogStore
+from trustlist import TrustList, GLOBAL, USER, ROLE
+from statecodec import GuildListCodec, GuildKindCodec, IdSetCodec
+from cluster import RESTART_EXIT_CODE, shard_for
+from auditlog import AuditLogTailer
+from contentfilter import ContentFilter, invite_code
+from correlation import CrossGuildCorrelator, ACTOR
+from fingerprint import NearDuplicateDetector
+from detector import (RateDetector, DeleteTracker, ACTION_NAMES, MESSAGE_DELETES, CHANNEL_CREATES, ROLE_CREATES, ROLE_DELETES, MEMBER_BANS,
+                      CHANNEL_DELETES)
+from lockdown import LockdownManager, HikariGuildAPI, CHANNEL_CREATE, CHANNEL_DELETE, ROLE_CREATE, ROLE_DELETE
+from scheduler import Scheduler
+from alerts import AlertDispatcher, EmbedTemplates
+from dispatch import EventDispatcher, CRITICAL, NORMAL, LOW
+from metrics import Registry, RateLimitCounter, monitor_loop_lag, serve as serve_metrics
+from gatewayprofile import hikari_profile
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,7 +40,28 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("No bot token provided. Set the BOT_TOKEN environment variable.")
 
-bot = lightbulb.BotApp(token=BOT_TOKEN, prefix='.', intents=hikari.Intents.ALL)
+# Set by launcher.py when this process is one worker of several
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id]
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+WORKER_ID = int(os.getenv("WORKER_ID", "0"))
+
+# Gateway events the listeners below handle; the intents and cache follow from them
+GATEWAY_EVENTS = (
+    hikari.GuildMessageCreateEvent,
+    hikari.GuildMessageDeleteEvent,
+    hikari.GuildBulkMessageDeleteEvent,
+    hikari.AuditLogEntryCreateEvent,
+    hikari.GuildChannelCreateEvent,
+    hikari.GuildChannelDeleteEvent,
+    hikari.RoleCreateEvent,
+    hikari.RoleDeleteEvent,
+    hikari.MemberDeleteEvent,
+)
+
+bot = lightbulb.BotApp(token=BOT_TOKEN, prefix='.', **hikari_profile(GATEWAY_EVENTS))
+if WORKER_ID:
+    # Application commands are global, one worker syncing them is enough
+    bot.unsubscribe(hikari.StartedEvent, bot._manage_application_commands)
 
 # Create a folder for storing JSON files
 DATA_FOLDER = "data"
@@ -29,9 +69,19 @@ os.makedirs(DATA_FOLDER, exist_ok=True)
 
 # File paths for JSON files
 MOD_LOGS_FILE = os.path.join(DATA_FOLDER, "mod_logs.json")
+MOD_LOGS_DB = os.path.join(DATA_FOLDER, "mod_logs.sqlite3")
 RECENT_ACTIONS_FILE = os.path.join(DATA_FOLDER, "recent_actions.json")
 USER_TIMEZONES_FILE = os.path.join(DATA_FOLDER, "user_timezones.json")
 BYPASS_USERS_FILE = os.path.join(DATA_FOLDER, "bypass_users.json")
+TRUST_DB = os.path.join(DATA_FOLDER, "trust.sqlite3")
+THRESHOLDS_FILE = os.path.join(DATA_FOLDER, "thresholds.json")
+LOCKDOWN_FILE = os.path.join(DATA_FOLDER, f"lockdowns-{WORKER_ID}.json" if SHARD_IDS else "lockdowns.json")
+METRICS_FILE = os.path.join(DATA_FOLDER, f"metrics-{WORKER_ID}.json" if SHARD_IDS else "metrics.json")
+LOG_CHANNELS_FILE = os.path.join(DATA_FOLDER, "log_channels.json")
+SCHEDULE_FILE = os.path.join(DATA_FOLDER, f"schedule-{WORKER_ID}.json" if SHARD_IDS else "schedule.json")
+
+# Local port for the Prometheus endpoint, 0 to disable it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
 
 # Load data from JSON files
 def load_json(file_path, default):
@@ -41,16 +91,412 @@ def load_json(file_path, default):
     return default
 
 
-mod_logs = load_json(MOD_LOGS_FILE, defaultdict(list))
+# Recent actions and thresholds are journaled by a background writer instead
+# of rewriting the whole file on every event. Snapshots are binary
+# (statecodec.py); the decode functions read the older JSON files. Mod logs
+# and the bypass list used to be kept the same way and are only read to
+# import them.
+def apply_mod_log(state, op, guild_id, entry):
+    state[guild_id].append(entry)
+
+
+def decode_mod_logs(data):
+    return defaultdict(list, {int(guild_id): entries for guild_id, entries in data.items()})
+
+
+def apply_recent_actions(state, op, guild_id, kind, timestamps):
+    state[guild_id][kind] = timestamps
+
+
+def decode_recent_actions(data):
+    state = defaultdict(dict)
+    for guild_id, kinds in data.items():
+        for kind, timestamps in kinds.items():
+            # Older files stored each deque through str(), which cannot be read back
+            if not isinstance(timestamps, list):
+                continue
+            state[int(guild_id)][kind] = [
+                t if isinstance(t, (int, float)) else datetime.datetime.fromisoformat(t).timestamp()
+                for t in timestamps
+            ]
+    return state
+
+
+def apply_threshold(state, op, guild_id, kind, count, window):
+    state[guild_id][kind] = [count, window]
+
+
+def decode_thresholds(data):
+    return defaultdict(dict, {int(guild_id): kinds for guild_id, kinds in data.items()})
+
+
+def apply_log_channel(state, op, guild_id, channel_id):
+    if channel_id is None:
+        state.pop(guild_id, None)
+    else:
+        state[guild_id] = channel_id
+
+
+def decode_log_channels(data):
+    return {int(guild_id): channel_id for guild_id, channel_id in data.items()}
+
+
+def apply_bypass(state, op, user_id):
+    if op == "add":
+        state.add(user_id)
+    else:
+        state.discard(user_id)
+
+
+if SHARD_IDS:
+    # Guild state is split per shard so each worker only touches its own guilds
+    def guild_store(path, default, apply, decode, codec):
+        return PartitionedLog(
+            path, SHARD_IDS, lambda guild_id: shard_for(guild_id, SHARD_COUNT),
+            lambda shard_id: os.path.join(DATA_FOLDER, "shards", str(shard_id), os.path.basename(path)),
+            default, apply, decode=decode, codec=codec
+        )
+else:
+    def guild_store(path, default, apply, decode, codec):
+        return WriteBehindLog(path, default, apply, decode=decode, codec=codec)
+
+recent_actions_store = guild_store(RECENT_ACTIONS_FILE, lambda: defaultdict(dict), apply_recent_actions,
+                                   decode_recent_actions, GuildKindCodec("times"))
+thresholds_store = guild_store(THRESHOLDS_FILE, lambda: defaultdict(dict), apply_threshold, decode_thresholds,
+                               GuildKindCodec("threshold"))
+# A handful of ids, so a JSON snapshot is fine
+log_channels_store = guild_store(LOG_CHANNELS_FILE, dict, apply_log_channel, decode_log_channels, None)
+
+# Structured mod log entries, shared by every worker
+modlog = ModLogStore(MOD_LOGS_DB)
+# Kinds of mod log entries, for filtering /modlogs
+MOD_LOG_ACTIONS = ACTION_NAMES + ("invite_deleted", "duplicate_messages", "lockdown", "ban", "unban", "mute", "unmute",
+                                  "legacy")
+
+# Per-guild bypass users and roles, shared with antieverything.py
+trust = TrustList(TRUST_DB)
+
+# Saved state is filled in by load_state while the gateway connects; until
+# then handlers see these empty containers, and whatever they record is kept.
 support_chat_status = defaultdict(lambda: True)  # Initialize with True to allow chat by default
-recent_actions = load_json(RECENT_ACTIONS_FILE, defaultdict(lambda: defaultdict(deque)))
-user_timezones = load_json(USER_TIMEZONES_FILE, defaultdict(lambda: 'UTC'))
-bypass_users = set(load_json(BYPASS_USERS_FILE, []))
+recent_actions = defaultdict(dict)
+user_timezones = defaultdict(lambda: 'UTC')
+thresholds = defaultdict(dict)
+log_channels = {}
+
+# Mass-action detector, seeded by load_state with the saved thresholds and recent history
+detector = RateDetector()
+# Message deletions are aggregated per channel and actor instead, against the
+# same message_deletes threshold
+delete_tracker = DeleteTracker(lambda guild_id: detector.threshold(guild_id, MESSAGE_DELETES))
+# Invite spammers and deleters seen across guilds; when one spreads, every
+# guild's thresholds are lowered for a while
+correlator = CrossGuildCorrelator(detector.boost)
+# Many accounts posting the same or slightly altered text in a guild
+duplicates = NearDuplicateDetector()
+# Who made each channel and role change, fed from the audit-log gateway events
+audit_logs = AuditLogTailer()
+
+
+def import_legacy_mod_logs():
+    # The old logs are free-form strings without a time, so they are dated by
+    # the file they came from. Shard files were seeded from the unsharded one,
+    # whose entries for those guilds are skipped.
+    sharded = set()
+    paths = sorted(glob(os.path.join(DATA_FOLDER, "shards", "*", os.path.basename(MOD_LOGS_FILE)))) + [MOD_LOGS_FILE]
+    for path in paths:
+        log = WriteBehindLog(path, lambda: defaultdict(list), apply_mod_log, decode=decode_mod_logs, codec=GuildListCodec())
+        if not log.exists():
+            continue
+        dated = max(os.path.getmtime(p) for p in (log.path, log.snapshot_path, log.journal_path) if os.path.exists(p))
+        entries = log.read()
+        if path != MOD_LOGS_FILE:
+            sharded.update(entries)
+        rows = [(guild_id, dated, "legacy", None, None, entry)
+                for guild_id, guild_entries in entries.items() if path != MOD_LOGS_FILE or guild_id not in sharded
+                for entry in guild_entries]
+        if modlog.import_rows(os.path.relpath(path, DATA_FOLDER), rows):
+            logging.info(f"Imported {len(rows)} mod log entries from {path}")
+
+
+def read_legacy_bypass_users():
+    log = WriteBehindLog(BYPASS_USERS_FILE, set, apply_bypass, decode=set, codec=IdSetCodec())
+    return log.read() if log.exists() else None
+
+
+async def load_state():
+    started = time.perf_counter()
+    try:
+        # Each store is read in its own thread
+        _, _, _, _, legacy_bypass, _ = await asyncio.gather(
+            asyncio.to_thread(import_legacy_mod_logs),
+            recent_actions_store.load_into(recent_actions),
+            thresholds_store.load_into(thresholds),
+            log_channels_store.load_into(log_channels),
+            asyncio.to_thread(read_legacy_bypass_users),
+            scheduler.load(),
+        )
+        # The old bypass list was not per guild, so it keeps applying everywhere
+        if legacy_bypass is not None and trust.import_entries(
+                "cracker:bypass_users", [(GLOBAL, USER, user_id) for user_id in legacy_bypass]):
+            logging.info(f"Imported {len(legacy_bypass)} bypass users from {BYPASS_USERS_FILE}")
+        user_timezones.update(await asyncio.to_thread(load_json, USER_TIMEZONES_FILE, {}))
+    except Exception as e:
+        logging.error(f"Error loading saved state: {e}")
+        return
+    for guild_id, kinds in thresholds.items():
+        for kind, (count, window) in kinds.items():
+            detector.set_threshold(guild_id, ACTION_NAMES.index(kind), count, window)
+    for guild_id, kinds in recent_actions.items():
+        for kind, timestamps in kinds.items():
+            detector.restore(guild_id, ACTION_NAMES.index(kind), timestamps)
+    logging.info(f"Loaded saved state in {time.perf_counter() - started:.2f}s")
+
+
+# Invite-link matcher shared by every guild
+content_filter = ContentFilter()
+
+# Pillow rendering runs in worker processes, off the event loop
+image_pool = ImageWorkerPool()
+# Encoded generateimage results keyed by (text, bg_color, text_color)
+render_cache = RenderCache()
+
+# Metrics, served on METRICS_PORT and written to METRICS_FILE on shutdown
+registry = Registry()
+listener_seconds = registry.histogram("cracker_listener_seconds", "Time spent in each event listener.", ("listener",))
+command_seconds = registry.histogram("cracker_command_seconds", "Time spent in each command.", ("command",))
+detections = registry.counter("cracker_detections_total", "Mass actions detected.", ("action",))
+deletions = registry.counter("cracker_message_deletions_total", "Messages deleted by the bot.", ("reason",))
+rest_calls = registry.counter("cracker_rest_calls_total", "REST calls made by the anti-nuke handlers.", ("route",))
+lockdown_reverts = registry.counter("cracker_lockdown_reverts_total", "Changes rolled back by lockdowns.", ("kind",))
+lockdown_recovery = registry.histogram("cracker_lockdown_recovery_seconds",
+                                       "Time from the first change of a raid until it was rolled back.",
+                                       buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600))
+ratelimits = registry.counter("cracker_ratelimits_total", "Rate-limited REST responses.", ("logger",))
+RateLimitCounter(ratelimits, "hikari.rest", "hikari.ratelimits")
+loop_lag = registry.histogram("cracker_event_loop_lag_seconds", "How late the event loop runs scheduled work.")
+registry.collector("cracker_render_cache", "generateimage render cache.", ("stat",), lambda: {
+    "bytes": render_cache.size, "hits": render_cache.hits, "misses": render_cache.misses,
+})
+registry.collector("cracker_image_jobs_pending", "Image jobs queued or running.", (), lambda: {(): image_pool.pending})
+
+# Gateway events are handled from per-guild queues taken in turn, so a raid in
+# one guild cannot starve the rest; bans and deletions never wait behind
+# message scans, which are dropped first when a guild falls behind
+dispatcher = EventDispatcher()
+registry.collector("cracker_event_queue_depth", "Events waiting to be handled per guild.", ("guild",),
+                   dispatcher.depths, replace=True)
+registry.collector("cracker_events_total", "Events handled, failed or shed per priority.", ("priority", "outcome"),
+                   dispatcher.outcomes, kind="counter")
+registry.collector("cracker_correlated_keys", "Distinct actors, invites and messages, and guilds, seen lately.",
+                   ("kind",), correlator.distinct)
+registry.collector("cracker_correlation_trends_total", "Keys seen spreading across guilds.", ("kind",),
+                   lambda: correlator.trends, kind="counter")
+registry.collector("cracker_fingerprinted_messages", "Recent messages indexed for near-duplicate detection.", (),
+                   lambda: {(): len(duplicates)})
+
+
+def log_action(guild_id, action, reason, actor_id=None, target_id=None):
+    modlog.record(guild_id, action, reason, actor_id=actor_id, target_id=target_id)
+
+
+def alert_channel(guild_id, channel_id):
+    # The guild's log channel if it set one. Otherwise only message events
+    # carry a text channel, and everything else goes to the system channel.
+    log_channel = log_channels.get(guild_id)
+    if log_channel is not None:
+        return log_channel
+    if channel_id is None:
+        guild = bot.cache.get_guild(guild_id)
+        channel_id = guild.system_channel_id if guild else None
+    return channel_id
+
+
+async def send_message(channel_id, embed):
+    rest_calls.inc("create_message")
+    message = await bot.rest.create_message(channel_id, embed=embed)
+    return message.id
+
+
+async def edit_message(channel_id, message_id, embed):
+    rest_calls.inc("edit_message")
+    await bot.rest.edit_message(channel_id, message_id, embed=embed)
 
-# Save data to JSON files
-def save_json(file_path, data):
-    with open(file_path, "w") as file:
-        json.dump(data, file, default=str, indent=4)
+
+# Alerts are sent by background tasks; repeats within a minute update one
+# message with a count instead of posting another
+alerts = AlertDispatcher(send_message, edit_message, route=alert_channel)
+registry.collector("cracker_alerts_total", "Alerts raised, and the messages sent or edited for them.", ("outcome",),
+                   lambda: {"raised": alerts.alerts, "sent": alerts.sent, "edited": alerts.edited,
+                            "failed": alerts.failed}, kind="counter")
+# Embeds that never change, built on first use
+embeds = EmbedTemplates()
+
+
+def send_alert(guild_id, kind, description, channel_id=None, color=0xFF0000):
+    def render(count):
+        return hikari.Embed(
+            title="Anti-Nuke",
+            description=description if count == 1 else f"{description} (x{count})",
+            color=hikari.Color(color)
+        )
+
+    alerts.alert(guild_id, channel_id, kind, render)
+
+
+def invite_notice(count):
+    if count > 1:
+        return hikari.Embed(
+            title="Anti-Nuke",
+            description=f"Invite links are not allowed in this server. ({count} removed)",
+            color=hikari.Color(0xFF0000)
+        )
+    return embeds.get("invite", lambda: hikari.Embed(
+        title="Anti-Nuke",
+        description="Invite links are not allowed in this server.",
+        color=hikari.Color(0xFF0000)
+    ))
+
+
+async def report_lockdown(report):
+    lockdown_recovery.observe(report.time_to_recover)
+    for kind, count in report.reverted.items():
+        lockdown_reverts.inc(kind, amount=count)
+    reverted = report.reverted
+    summary = (f"Lockdown lifted: {reverted[CHANNEL_CREATE]} channels deleted, {reverted[CHANNEL_DELETE]} restored, "
+               f"{reverted[ROLE_CREATE]} roles deleted, {reverted[ROLE_DELETE]} restored, {report.restored} "
+               f"permissions put back; recovered in {report.time_to_recover:.1f}s")
+    if report.failed:
+        summary += " (failed: " + ", ".join(f"{kind} {count}" for kind, count in report.failed.items()) + ")"
+    log_action(report.guild_id, "lockdown", summary)
+    send_alert(report.guild_id, "lockdown", f"{report.reason}\n{summary}.", color=0xFFA500 if report.failed else 0x00FF00)
+
+
+# Mass channel and role changes lock the guild down: @everyone is frozen and
+# everything created or deleted around the raid is rolled back in one batch
+lockdowns = LockdownManager(HikariGuildAPI(bot), on_end=report_lockdown, state_path=LOCKDOWN_FILE)
+
+# Discord lifts a timeout after 28 days at most, so longer mutes are renewed
+# an hour before it runs out
+MAX_TIMEOUT = 28 * 86400
+MAX_MUTE_MINUTES = 365 * 1440
+
+
+async def apply_mute(guild_id, user_id, until, reason):
+    end = min(until, time.time() + MAX_TIMEOUT)
+    rest_calls.inc("timeout")
+    await bot.rest.edit_member(guild_id, user_id, reason=reason,
+                               communication_disabled_until=datetime.datetime.fromtimestamp(end, datetime.timezone.utc))
+    if until > end:
+        scheduler.schedule("remute", guild_id, user_id, end - 3600, reason)
+
+
+async def lift_ban(guild_id, user_id, reason):
+    rest_calls.inc("unban")
+    await bot.rest.unban_user(guild_id, user_id, reason=reason)
+    log_action(guild_id, "unban", reason, target_id=user_id)
+
+
+async def lift_mute(guild_id, user_id, reason):
+    scheduler.cancel("remute", guild_id, user_id)
+    rest_calls.inc("timeout")
+    await bot.rest.edit_member(guild_id, user_id, communication_disabled_until=None, reason=reason)
+    log_action(guild_id, "unmute", reason, target_id=user_id)
+
+
+async def renew_mute(guild_id, user_id, reason):
+    until = scheduler.due("unmute", guild_id, user_id)
+    if until is not None:
+        await apply_mute(guild_id, user_id, until, reason)
+
+
+# Temporary bans and mutes end through the scheduler, which keeps them across
+# restarts; loaded by load_state
+scheduler = Scheduler(SCHEDULE_FILE, {"unban": lift_ban, "unmute": lift_mute, "remute": renew_mute})
+registry.collector("cracker_scheduled_actions", "Timed moderation actions waiting to run.", (),
+                   lambda: {(): len(scheduler.entries)})
+registry.collector("cracker_scheduled_actions_run_total", "Timed moderation actions run.", ("outcome",),
+                   lambda: {"ok": scheduler.fired, "failed": scheduler.failed}, kind="counter")
+
+
+async def is_trusted_actor(guild_id, user_id):
+    # The owner is never on the trust list, as only they can edit it
+    guild = bot.cache.get_guild(guild_id)
+    if guild is not None and guild.owner_id == user_id:
+        return True
+    # There is no member cache, so the roles of someone who has not posted
+    # since startup are fetched before a trusted role can let them through
+    if trust.needs_roles(guild_id, user_id):
+        try:
+            rest_calls.inc("fetch_member")
+            member = await bot.rest.fetch_member(guild_id, user_id)
+            trust.observe_member(guild_id, user_id, member.role_ids)
+        except hikari.NotFoundError:
+            # No longer a member, so no role of theirs is trusted
+            trust.observe_member(guild_id, user_id, ())
+        except Exception as e:
+            logging.error(f"Error fetching member {user_id} in guild {guild_id}: {e}")
+    return trust.is_trusted(guild_id, user_id)
+
+
+async def attribute(event, change, action, target_id):
+    # Changes by trusted actors are never undone and do not count towards a
+    # lockdown; unattributed ones count and are rolled back by it
+    entry = await audit_logs.wait(event.guild_id, action, int(target_id))
+    if entry is not None and entry.user_id is not None:
+        if await is_trusted_actor(event.guild_id, entry.user_id):
+            change.resolve(False)
+            return False
+        correlator.observe(ACTOR, entry.user_id, event.guild_id)
+    change.resolve(True)
+    return True
+
+
+async def check_mass_action(event, action, description, target_id, channel_id=None, lock=False):
+    if not detector.hit(event.guild_id, action):
+        return
+    if lock:
+        lockdowns.trigger(event.guild_id, description)
+    detections.inc(ACTION_NAMES[action])
+    log_action(event.guild_id, ACTION_NAMES[action], description, target_id=target_id)
+    recent_actions_store.record(
+        recent_actions, "ring", event.guild_id, ACTION_NAMES[action], detector.export(event.guild_id, action)
+    )
+    send_alert(event.guild_id, ACTION_NAMES[action], description, channel_id)
+
+
+async def check_delete_burst(event, count):
+    burst = delete_tracker.ingest(event.guild_id, event.channel_id, count)
+    if burst is None:
+        return
+    # One alert and one log entry per incident, however long it goes on
+    detections.inc("message_deletes")
+    description = (f"Mass message deletion detected! {burst.deleted} messages deleted in "
+                   f"{len(burst.channels)} channels")
+    actor_id = None
+    if burst.actors:
+        actor_id, credited = burst.actors.most_common(1)[0]
+        description += f", {credited} of them by <@{actor_id}>"
+    log_action(event.guild_id, "message_deletes", description, actor_id=actor_id, target_id=event.channel_id)
+    send_alert(event.guild_id, "message_deletes", description, event.channel_id)
+
+
+async def remove_duplicates(guild_id, channel_id, cluster):
+    # Everything the cluster's accounts posted is deleted, including what
+    # came before it was flagged, in one bulk delete per channel
+    channels = defaultdict(list)
+    for author_id, (message_channel_id, message_id) in cluster.take():
+        correlator.observe_message(guild_id, author_id, cluster.text)
+        channels[message_channel_id].append(message_id)
+    if cluster.flagged == 1:
+        detections.inc("duplicate_messages")
+        description = f"Coordinated spam detected! {len(cluster.authors)} accounts posted near-identical messages"
+        log_action(guild_id, "duplicate_messages", description, target_id=channel_id)
+        send_alert(guild_id, "duplicate_messages", description, channel_id)
+    for message_channel_id, message_ids in channels.items():
+        deletions.inc("duplicate_messages", amount=len(message_ids))
+        rest_calls.inc("delete_messages")
+        await bot.rest.delete_messages(message_channel_id, message_ids)
 
 
 SUPPORT_SERVER_ID = 1094926261459111936
@@ -58,9 +504,26 @@ SUPPORT_INVITE_LINK = "https://discord.gg/uNwvyTCeJv"
 STATUS_VOICE_CHANNEL_ID = 1333341675573219328  # voice channel ID
 
 
+@bot.listen(hikari.StartingEvent)
+async def on_starting(event: hikari.StartingEvent) -> None:
+    # Not awaited, so the shards connect while the state loads
+    bot.d.load_task = asyncio.create_task(load_state())
+
+
 @bot.listen(hikari.StartedEvent)
 async def on_started(event: hikari.StartedEvent) -> None:
     logging.info('Bot has started!')
+    bot.d.loop_lag_task = asyncio.create_task(monitor_loop_lag(loop_lag))
+    bot.d.trust_watch_task = asyncio.create_task(trust.watch())
+    # Guilds still frozen from before a restart
+    bot.d.thaw_task = asyncio.create_task(lockdowns.thaw_stale())
+    if METRICS_PORT:
+        try:
+            bot.d.metrics_server = await serve_metrics(registry, port=METRICS_PORT)
+        except OSError as e:
+            logging.error(f"Could not serve metrics on port {METRICS_PORT}: {e}")
+    if WORKER_ID:
+        return
     try:
         # Update voice channel name to indicate the bot is online
         channel = await bot.rest.fetch_channel(STATUS_VOICE_CHANNEL_ID)
@@ -74,18 +537,33 @@ async def on_stopped(event: hikari.StoppedEvent) -> None:
     logging.info('Bot has stopped!')
     try:
         # Update voice channel name to indicate the bot is offline
-        if bot.rest.is_alive:
+        if bot.rest.is_alive and not SHARD_IDS:
             channel = await bot.rest.fetch_channel(STATUS_VOICE_CHANNEL_ID)
             await bot.rest.edit_channel(channel, name="🔴 Bot Status: Offline")
     except Exception as e:
         logging.error(f"Error updating status channel: {e}")
+    # Write out anything still queued before the process exits or re-execs
+    dispatcher.close()
+    alerts.close()
+    for store in (modlog, recent_actions_store, trust, thresholds_store, log_channels_store, scheduler):
+        store.close()
+    image_pool.shutdown()
+    registry.dump(METRICS_FILE)
 
 
 @bot.command
 @lightbulb.command('restart', 'Restarts the bot.')
 @lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("restart")
 async def restart(ctx: lightbulb.Context) -> None:
     try:
+        if SHARD_IDS:
+            # Only this worker's shards go down; the launcher starts it again
+            await ctx.respond(f"Restarting shards {SHARD_IDS[0]}-{SHARD_IDS[-1]}...")
+            logging.info(f'Worker {WORKER_ID} is restarting...')
+            bot.d.exit_code = RESTART_EXIT_CODE
+            await bot.close()
+            return
         await ctx.respond("Restarting the bot...")
         logging.info('Bot is restarting...')
         # Update voice channel name to indicate the bot is restarting
@@ -111,19 +589,48 @@ async def on_command_error(event: lightbulb.CommandErrorEvent) -> None:
     logging.error(f"Error in command {event.context.command.name}: {event.exception}")
 
 
+def info_embed():
+    embed = hikari.Embed(
+        title="Bot Information",
+        description="This is a sample bot created using Hikari and Lightbulb.",
+        color=hikari.Color(0xFFD700)
+    )
+    embed.add_field(name="Author", value="fentbusgaming", inline=True)
+    embed.add_field(name="Version", value="1.2.3-233", inline=True)
+    return embed
+
+
+def commands_embed():
+    embed = hikari.Embed(
+        title="Commands",
+        description="List of available commands:",
+        color=hikari.Color(0xFF4500)
+    )
+    embed.add_field(name="/info", value="Provides information about the bot.", inline=False)
+    embed.add_field(name="/commands", value="Lists all available commands.", inline=False)
+    embed.add_field(name="/ban", value="Bans a user from the server, for good or for some hours.", inline=False)
+    embed.add_field(name="/mute", value="Mutes a user in the server for some minutes.", inline=False)
+    embed.add_field(name="/kick", value="Kicks a user from the server.", inline=False)
+    embed.add_field(name="/warn", value="Warns a user.", inline=False)
+    embed.add_field(name="/modlogs", value="Displays moderation logs.", inline=False)
+    embed.add_field(name="/settimezone", value="Sets your timezone.", inline=False)
+    embed.add_field(name="/time", value="Displays the current time in your timezone.", inline=False)
+    embed.add_field(name="/restart", value="Restarts the bot.", inline=False)
+    embed.add_field(name="/bypass", value="Manages this server's anti-nuke bypass list.", inline=False)
+    embed.add_field(name="/threshold", value="Sets the anti-nuke detection threshold for an action.", inline=False)
+    embed.add_field(name="/lockdown", value="Locks the server down or lifts a lockdown.", inline=False)
+    embed.add_field(name="/logchannel", value="Sets the channel anti-nuke alerts are sent to.", inline=False)
+    embed.add_field(name="/support", value="Provides the support server invite link.", inline=False)
+    return embed
+
+
 @bot.command
 @lightbulb.command('info', 'Provides information about the bot.')
 @lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("info")
 async def info(ctx: lightbulb.Context) -> None:
     try:
-        embed = hikari.Embed(
-            title="Bot Information",
-            description="This is a sample bot created using Hikari and Lightbulb.",
-            color=hikari.Color(0xFFD700)
-        )
-        embed.add_field(name="Author", value="fentbusgaming", inline=True)
-        embed.add_field(name="Version", value="1.2.3-233", inline=True)
-        await ctx.respond(embed=embed)
+        await ctx.respond(embed=embeds.get("info", info_embed))
     except Exception as e:
         await ctx.respond("An error occurred while processing your request.")
         logging.error(f"Error in info command: {e}")
@@ -132,26 +639,10 @@ async def info(ctx: lightbulb.Context) -> None:
 @bot.command
 @lightbulb.command('commands', 'Lists all available commands.')
 @lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("commands")
 async def commands(ctx: lightbulb.Context) -> None:
     try:
-        embed = hikari.Embed(
-            title="Commands",
-            description="List of available commands:",
-            color=hikari.Color(0xFF4500)
-        )
-        embed.add_field(name="/info", value="Provides information about the bot.", inline=False)
-        embed.add_field(name="/commands", value="Lists all available commands.", inline=False)
-        embed.add_field(name="/ban", value="Bans a user from the server.", inline=False)
-        embed.add_field(name="/mute", value="Mutes a user in the server.", inline=False)
-        embed.add_field(name="/kick", value="Kicks a user from the server.", inline=False)
-        embed.add_field(name="/warn", value="Warns a user.", inline=False)
-        embed.add_field(name="/modlogs", value="Displays moderation logs.", inline=False)
-        embed.add_field(name="/settimezone", value="Sets your timezone.", inline=False)
-        embed.add_field(name="/time", value="Displays the current time in your timezone.", inline=False)
-        embed.add_field(name="/restart", value="Restarts the bot.", inline=False)
-        embed.add_field(name="/bypass", value="Manages anti-nuke bypass list.", inline=False)
-        embed.add_field(name="/support", value="Provides the support server invite link.", inline=False)
-        await ctx.respond(embed=embed)
+        await ctx.respond(embed=embeds.get("commands", commands_embed))
     except Exception as e:
         await ctx.respond("An error occurred while processing your request.")
         logging.error(f"Error in commands command: {e}")
@@ -160,6 +651,7 @@ async def commands(ctx: lightbulb.Context) -> None:
 @bot.command
 @lightbulb.command('support', 'Provides the support server invite link.')
 @lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("support")
 async def support(ctx: lightbulb.Context) -> None:
     try:
         await ctx.respond(f"Join our support server: {SUPPORT_INVITE_LINK}")
@@ -169,23 +661,196 @@ async def support(ctx: lightbulb.Context) -> None:
 
 
 @bot.command
-@lightbulb.option("user", "The user to add or remove from the bypass list.", hikari.User)
-@lightbulb.option("action", "Add or remove the user from the bypass list.", choices=["add", "remove"])
-@lightbulb.command('bypass', 'Manages the anti-nuke bypass list.')
+@lightbulb.option("role", "A role whose members bypass anti-nuke.", hikari.Role, required=False)
+@lightbulb.option("user", "A user who bypasses anti-nuke.", hikari.User, required=False)
+@lightbulb.option("action", "Add to, remove from or show this server's bypass list.", choices=["add", "remove", "list"])
+@lightbulb.command('bypass', "Manages this server's anti-nuke bypass list.")
 @lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("bypass")
 async def bypass(ctx: lightbulb.Context) -> None:
+    if not ctx.author.id == ctx.get_guild().owner_id:
+        await ctx.respond("You do not have permission to use this command.")
+        return
+    action = ctx.options.action
+    if action == "list":
+        users, roles = trust.entries(ctx.guild_id)
+        entries = [f"<@{user_id}>" for user_id in users] + [f"<@&{role_id}>" for role_id in roles]
+        await ctx.respond("Bypass list: " + (", ".join(entries) if entries else "empty"))
+        return
+    user = ctx.options.user
+    role = ctx.options.role
+    if user is None and role is None:
+        await ctx.respond("Give a user or a role.")
+        return
+    for kind, target, name in ((USER, user, user and user.username), (ROLE, role, role and role.name)):
+        if target is None:
+            continue
+        if action == "add":
+            trust.add(ctx.guild_id, kind, target.id)
+            await ctx.respond(f"{name} has been added to the bypass list.")
+        else:
+            trust.remove(ctx.guild_id, kind, target.id)
+            await ctx.respond(f"{name} has been removed from the bypass list.")
+
+
+@bot.command
+@lightbulb.option("reason", "Why the user is banned.", str, required=False, default="No reason given")
+@lightbulb.option("hours", "Lift the ban after this many hours; permanent if not given.", float, required=False,
+                  min_value=0.1)
+@lightbulb.option("user", "The user to ban.", hikari.User)
+@lightbulb.command('ban', 'Bans a user from the server.')
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("ban")
+async def ban(ctx: lightbulb.Context) -> None:
+    if not ctx.author.id == ctx.get_guild().owner_id:
+        await ctx.respond("You do not have permission to use this command.")
+        return
+    user = ctx.options.user
+    hours = ctx.options.hours
+    try:
+        await bot.rest.ban_user(ctx.guild_id, user.id, reason=ctx.options.reason)
+    except Exception as e:
+        await ctx.respond("An error occurred while processing your request.")
+        logging.error(f"Error in ban command: {e}")
+        return
+    log_action(ctx.guild_id, "ban", ctx.options.reason, actor_id=ctx.author.id, target_id=user.id)
+    if hours:
+        scheduler.schedule("unban", ctx.guild_id, user.id, time.time() + hours * 3600,
+                           f"Temporary ban by {ctx.author.username} expired")
+        await ctx.respond(f"{user.username} has been banned for {hours:g} hours.")
+    else:
+        # A permanent ban replaces a temporary one
+        scheduler.cancel("unban", ctx.guild_id, user.id)
+        await ctx.respond(f"{user.username} has been banned.")
+
+
+@bot.command
+@lightbulb.option("reason", "Why the user is muted.", str, required=False, default="No reason given")
+@lightbulb.option("minutes", "How long the mute lasts.", float, min_value=1, max_value=MAX_MUTE_MINUTES)
+@lightbulb.option("user", "The user to mute.", hikari.User)
+@lightbulb.command('mute', 'Mutes a user in the server.')
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("mute")
+async def mute(ctx: lightbulb.Context) -> None:
     if not ctx.author.id == ctx.get_guild().owner_id:
         await ctx.respond("You do not have permission to use this command.")
         return
     user = ctx.options.user
+    minutes = ctx.options.minutes
+    until = time.time() + minutes * 60
+    # Scheduled first, so renewing a long mute can find when it ends
+    scheduler.schedule("unmute", ctx.guild_id, user.id, until, f"Mute by {ctx.author.username} expired")
+    try:
+        await apply_mute(ctx.guild_id, user.id, until, ctx.options.reason)
+    except Exception as e:
+        scheduler.cancel("unmute", ctx.guild_id, user.id)
+        await ctx.respond("An error occurred while processing your request.")
+        logging.error(f"Error in mute command: {e}")
+        return
+    log_action(ctx.guild_id, "mute", ctx.options.reason, actor_id=ctx.author.id, target_id=user.id)
+    await ctx.respond(f"{user.username} has been muted until <t:{int(until)}:f>.")
+
+
+@bot.command
+@lightbulb.option("cursor", "Continue after this entry, as given at the end of the previous page.", int, required=False)
+@lightbulb.option("hours", "Only show entries from the last this many hours.", float, required=False, min_value=0)
+@lightbulb.option("action", "Only show one kind of entry.", choices=list(MOD_LOG_ACTIONS), required=False)
+@lightbulb.option("user", "Only show entries caused by this user.", hikari.User, required=False)
+@lightbulb.command('modlogs', 'Displays moderation logs.')
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("modlogs")
+async def modlogs(ctx: lightbulb.Context) -> None:
+    if not ctx.author.id == ctx.get_guild().owner_id:
+        await ctx.respond("You do not have permission to use this command.")
+        return
+    try:
+        user = ctx.options.user
+        hours = ctx.options.hours
+        entries, cursor = await modlog.query(
+            ctx.guild_id,
+            actor_id=user.id if user else None,
+            action=ctx.options.action,
+            since=time.time() - hours * 3600 if hours else None,
+            cursor=ctx.options.cursor,
+        )
+        if not entries:
+            await ctx.respond("No moderation log entries found.")
+            return
+        lines = []
+        for entry in entries:
+            line = f"<t:{int(entry.created_at)}:f> **{entry.action.replace('_', ' ')}** {entry.reason[:200]}"
+            if entry.actor_id:
+                line += f" (<@{entry.actor_id}>)"
+            lines.append(line)
+        embed = hikari.Embed(
+            title="Moderation Logs",
+            description="\n".join(lines),
+            color=hikari.Color(0xFF4500)
+        )
+        if cursor is not None:
+            embed.set_footer(f"More entries: run /modlogs again with cursor {cursor}")
+        await ctx.respond(embed=embed)
+    except Exception as e:
+        await ctx.respond("An error occurred while processing your request.")
+        logging.error(f"Error in modlogs command: {e}")
+
+
+@bot.command
+@lightbulb.option("seconds", "The time window in seconds.", float, min_value=1)
+@lightbulb.option("count", "How many actions within the window trigger a detection.", int, min_value=2)
+@lightbulb.option("action", "The action to configure.", choices=list(ACTION_NAMES))
+@lightbulb.command('threshold', 'Sets the anti-nuke detection threshold for an action.')
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("threshold")
+async def threshold(ctx: lightbulb.Context) -> None:
+    if not ctx.author.id == ctx.get_guild().owner_id:
+        await ctx.respond("You do not have permission to use this command.")
+        return
     action = ctx.options.action
-    if action == "add":
-        bypass_users.add(user.id)
-        await ctx.respond(f"{user.username} has been added to the bypass list.")
-    elif action == "remove":
-        bypass_users.discard(user.id)
-        await ctx.respond(f"{user.username} has been removed from the bypass list.")
-    save_json(BYPASS_USERS_FILE, list(bypass_users))
+    count = ctx.options.count
+    seconds = ctx.options.seconds
+    detector.set_threshold(ctx.guild_id, ACTION_NAMES.index(action), count, seconds)
+    thresholds_store.record(thresholds, "set", ctx.guild_id, action, count, seconds)
+    await ctx.respond(f"Anti-nuke will now trigger on {count} {action.replace('_', ' ')} within {seconds:g} seconds.")
+
+
+@bot.command
+@lightbulb.option("action", "Lock the server down, or finish rolling back and lift the lockdown.", choices=["start", "end"])
+@lightbulb.command('lockdown', 'Locks the server down or lifts a lockdown.')
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("lockdown")
+async def lockdown(ctx: lightbulb.Context) -> None:
+    if not ctx.author.id == ctx.get_guild().owner_id:
+        await ctx.respond("You do not have permission to use this command.")
+        return
+    if ctx.options.action == "start":
+        lockdowns.trigger(ctx.guild_id, f"Lockdown started by {ctx.author.username}.")
+        await ctx.respond(f"Server locked down: @everyone is frozen and channel and role changes from the last "
+                          f"{lockdowns.lookback:.0f} seconds are being rolled back.")
+        return
+    # The report is posted to the system channel
+    if await lockdowns.end(ctx.guild_id) is None:
+        await ctx.respond("This server is not locked down.")
+    else:
+        await ctx.respond("Lockdown lifted.")
+
+
+@bot.command
+@lightbulb.option("channel", "The channel to send alerts to; leave out to send them where things happen.",
+                  hikari.TextableGuildChannel, required=False)
+@lightbulb.command('logchannel', 'Sets the channel anti-nuke alerts are sent to.')
+@lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("logchannel")
+async def logchannel(ctx: lightbulb.Context) -> None:
+    if not ctx.author.id == ctx.get_guild().owner_id:
+        await ctx.respond("You do not have permission to use this command.")
+        return
+    channel = ctx.options.channel
+    log_channels_store.record(log_channels, "set", ctx.guild_id, channel.id if channel else None)
+    if channel is None:
+        await ctx.respond("Anti-nuke alerts will be sent to the channel where things happen.")
+    else:
+        await ctx.respond(f"Anti-nuke alerts will be sent to <#{channel.id}>.")
 
 
 @bot.command
@@ -194,184 +859,246 @@ async def bypass(ctx: lightbulb.Context) -> None:
 @lightbulb.option("text", "The text to display on the image.", str, required=True)
 @lightbulb.command('generateimage', 'Generates an image with specified text and colors.')
 @lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("generateimage")
 async def generateimage(ctx: lightbulb.Context) -> None:
     try:
         text = ctx.options.text
         bg_color = ctx.options.bg_color
         text_color = ctx.options.text_color
 
-        # Create an image with Pillow
-        img = Image.new('RGB', (400, 200), color=bg_color)
-        d = ImageDraw.Draw(img)
-        font = ImageFont.load_default()
-        d.text((10, 10), text, font=font, fill=text_color)
-
-        # Save the image to a file
-        img_path = "output.png"
-        img.save(img_path)
+        # Render the image in a worker process unless an identical one is cached
+        key = (text, bg_color.lower(), text_color.lower())
+        img_data = render_cache.get(key)
+        if img_data is None:
+            img_data = await image_pool.submit(ctx.author.id, render_text, text, bg_color, text_color)
+            render_cache.put(key, img_data)
 
-        # Send the image to the user
-        await ctx.respond("Here is your generated image:", attachment=img_path)
+        # Send the image to the user straight from memory
+        await ctx.respond("Here is your generated image:", attachment=hikari.Bytes(img_data, "output.png"))
+    except ImageJobRejected as e:
+        await ctx.respond(str(e))
     except Exception as e:
         await ctx.respond("An error occurred while generating the image.")
         logging.error(f"Error in generateimage command: {e}")
 
 
 @bot.command
+@lightbulb.option("frame_ms", "How long each frame is shown, in milliseconds.", int, required=False, default=100, min_value=20, max_value=5000)
+@lightbulb.option("max_size", "Largest width or height of the GIF in pixels.", int, required=False, default=320, min_value=32, max_value=1024)
+@lightbulb.option("effect", "Animation applied to the images.", choices=list(GIF_EFFECTS), required=False, default="none")
+@lightbulb.option("image4", "Another frame for the GIF.", hikari.Attachment, required=False)
+@lightbulb.option("image3", "Another frame for the GIF.", hikari.Attachment, required=False)
+@lightbulb.option("image2", "Another frame for the GIF.", hikari.Attachment, required=False)
 @lightbulb.option("image", "Upload an image to create a GIF.", hikari.Attachment, required=True)
-@lightbulb.command('gif', 'Creates a GIF from an uploaded image.')
+@lightbulb.command('gif', 'Creates an animated GIF from uploaded images.')
 @lightbulb.implements(lightbulb.PrefixCommand, lightbulb.SlashCommand)
+@command_seconds.time("gif")
 async def gif(ctx: lightbulb.Context) -> None:
     try:
-        image = ctx.options.image
-        img_data = await image.read()
-        img = Image.open(io.BytesIO(img_data))
+        images = [ctx.options.image, ctx.options.image2, ctx.options.image3, ctx.options.image4]
+        images = [image for image in images if image is not None]
+        if any(image.size > MAX_UPLOAD_BYTES for image in images):
+            await ctx.respond(f"Images larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB are not supported.")
+            return
+        img_data = [await image.read() for image in images]
 
-        # Create a GIF with a single frame
-        gif_path = "output.gif"
-        img.save(gif_path, save_all=True, append_images=[img], loop=0, duration=500)
+        # Build the animation in a worker process
+        gif_data, metrics = await image_pool.submit(
+            ctx.author.id, build_gif, img_data, ctx.options.effect, ctx.options.max_size, ctx.options.frame_ms
+        )
+        logging.info(f"gif: {metrics}")
 
-        await ctx.respond("Here is your GIF:", attachment=gif_path)
+        await ctx.respond(
+            f"Here is your GIF: {metrics['frames']} frames, {metrics['width']}x{metrics['height']}, "
+            f"{metrics['bytes'] / 1024:.0f} KB, encoded in {metrics['encode_ms']:.0f} ms.",
+            attachment=hikari.Bytes(gif_data, "output.gif")
+        )
+    except ImageJobRejected as e:
+        await ctx.respond(str(e))
     except Exception as e:
         await ctx.respond("An error occurred while creating the GIF.")
         logging.error(f"Error in gif command: {e}")
 
 
+# The listeners below run from the dispatcher's per-guild queues, except the
+# audit-log one, which only attributes changes and is cheap enough to run inline
+def guild_of(event):
+    return event.guild_id
+
+
 @bot.listen(hikari.GuildMessageCreateEvent)
+@dispatcher.queued(LOW, guild_of)
+@listener_seconds.time("on_message_create")
 async def on_message_create(event: hikari.GuildMessageCreateEvent) -> None:
     try:
-        if event.is_bot or not event.guild_id or event.author_id in bypass_users:
+        if event.is_bot or not event.guild_id:
+            return
+        # The message carries the author's roles, which keeps role bypasses current
+        if event.member is not None:
+            trust.observe_member(event.guild_id, event.author_id, event.member.role_ids)
+        if trust.is_trusted(event.guild_id, event.author_id):
             return
         if event.guild_id == SUPPORT_SERVER_ID and not support_chat_status[event.guild_id]:
+            deletions.inc("support_chat_closed")
+            rest_calls.inc("delete_message")
             await event.message.delete()
             return
-        if "discord.gg/" in event.content:
+        match = content_filter.scan(event.guild_id, event.content)
+        if match:
+            # Only invites are scanned for here; blocked words would not be raid signals
+            if match[0] == "invite":
+                correlator.observe_message(event.guild_id, event.author_id, event.content,
+                                           invite_code(event.content, match[1]))
+            deletions.inc("invite")
+            rest_calls.inc("delete_message")
             await event.message.delete()
-            embed = hikari.Embed(
-                title="Anti-Nuke",
-                description="Invite links are not allowed in this server.",
-                color=hikari.Color(0xFF0000)
-            )
-            await event.get_channel().send(embed=embed)
-            mod_logs[event.guild_id].append(f"Deleted invite link from {event.author.username}")
-            save_json(MOD_LOGS_FILE, mod_logs)
+            log_action(event.guild_id, "invite_deleted", f"Deleted invite link from {event.author.username}",
+                       actor_id=event.author_id, target_id=event.message_id)
+            # Shown where the link was posted, not in the log channel
+            alerts.alert(event.guild_id, event.channel_id, "invite", invite_notice, route=False)
+            return
+        cluster = duplicates.check(event.guild_id, event.author_id, event.content, (event.channel_id, event.message_id))
+        if cluster is not None:
+            await remove_duplicates(event.guild_id, event.channel_id, cluster)
     except Exception as e:
         logging.error(f"Error in on_message_create event: {e}")
 
 
 @bot.listen(hikari.GuildMessageDeleteEvent)
+@dispatcher.queued(NORMAL, guild_of)
+@listener_seconds.time("on_message_delete")
 async def on_message_delete(event: hikari.GuildMessageDeleteEvent) -> None:
     try:
-        if event.is_bot or not event.guild_id:
+        if not event.guild_id:
             return
-        recent_actions[event.guild_id]['message_deletes'].append(datetime.datetime.now())
-        if len(recent_actions[event.guild_id]['message_deletes']) > 5:
-            recent_actions[event.guild_id]['message_deletes'].popleft()
-        if len(recent_actions[event.guild_id]['message_deletes']) == 5 and (
-                datetime.datetime.now() - recent_actions[event.guild_id]['message_deletes'][0]).total_seconds() < 10:
-            embed = hikari.Embed(
-                title="Anti-Nuke",
-                description="Mass message deletion detected!",
-                color=hikari.Color(0xFF0000)
-            )
-            await event.get_channel().send(embed=embed)
-            mod_logs[event.guild_id].append("Mass message deletion detected!")
-            save_json(MOD_LOGS_FILE, mod_logs)
-            save_json(RECENT_ACTIONS_FILE, recent_actions)
+        await check_delete_burst(event, 1)
     except Exception as e:
         logging.error(f"Error in on_message_delete event: {e}")
 
 
+@bot.listen(hikari.GuildBulkMessageDeleteEvent)
+@dispatcher.queued(NORMAL, guild_of)
+@listener_seconds.time("on_bulk_message_delete")
+async def on_bulk_message_delete(event: hikari.GuildBulkMessageDeleteEvent) -> None:
+    try:
+        await check_delete_burst(event, len(event.message_ids))
+    except Exception as e:
+        logging.error(f"Error in on_bulk_message_delete event: {e}")
+
+
+STRUCTURAL_ACTIONS = (hikari.AuditLogEventType.CHANNEL_CREATE, hikari.AuditLogEventType.CHANNEL_DELETE,
+                      hikari.AuditLogEventType.ROLE_CREATE, hikari.AuditLogEventType.ROLE_DELETE)
+
+
+@bot.listen(hikari.AuditLogEntryCreateEvent)
+@listener_seconds.time("on_audit_log_entry_create")
+async def on_audit_log_entry_create(event: hikari.AuditLogEntryCreateEvent) -> None:
+    try:
+        entry = event.entry
+        if entry.action_type in STRUCTURAL_ACTIONS:
+            # The channel and role listeners wait for these
+            audit_logs.add(event.guild_id, entry.action_type, int(entry.target_id), entry)
+            return
+        # Names who deleted messages, which the delete events do not carry
+        if entry.action_type == hikari.AuditLogEventType.MESSAGE_DELETE:
+            channel_id = entry.options.channel_id
+        elif entry.action_type == hikari.AuditLogEventType.MESSAGE_BULK_DELETE:
+            channel_id = entry.target_id
+        else:
+            return
+        if entry.user_id is not None:
+            trusted = trust.is_trusted(event.guild_id, entry.user_id)
+            delete_tracker.attribute(event.guild_id, channel_id, entry.user_id, trusted, entry.options.count)
+            if not trusted:
+                correlator.observe(ACTOR, entry.user_id, event.guild_id)
+    except Exception as e:
+        logging.error(f"Error in on_audit_log_entry_create event: {e}")
+
+
 @bot.listen(hikari.GuildChannelCreateEvent)
+@dispatcher.queued(NORMAL, guild_of)
+@listener_seconds.time("on_channel_create")
 async def on_channel_create(event: hikari.GuildChannelCreateEvent) -> None:
     try:
-        if event.is_bot or not event.guild_id:
+        if not event.guild_id:
             return
-        recent_actions[event.guild_id]['channel_creates'].append(datetime.datetime.now())
-        if len(recent_actions[event.guild_id]['channel_creates']) > 5:
-            recent_actions[event.guild_id]['channel_creates'].popleft()
-        if len(recent_actions[event.guild_id]['channel_creates']) == 5 and (
-                datetime.datetime.now() - recent_actions[event.guild_id]['channel_creates'][0]).total_seconds() < 10:
-            embed = hikari.Embed(
-                title="Anti-Nuke",
-                description="Mass channel creation detected!",
-                color=hikari.Color(0xFF0000)
-            )
-            await event.get_channel().send(embed=embed)
-            mod_logs[event.guild_id].append("Mass channel creation detected!")
-            save_json(MOD_LOGS_FILE, mod_logs)
-            save_json(RECENT_ACTIONS_FILE, recent_actions)
+        # The bot's own rollback is not journaled and does not count. Journaled
+        # before anything is awaited, so a lockdown sees it straight away.
+        change = lockdowns.record(event.guild_id, CHANNEL_CREATE, {"id": int(event.channel_id)}, attributed=True)
+        if change is None:
+            return
+        if await attribute(event, change, hikari.AuditLogEventType.CHANNEL_CREATE, event.channel_id):
+            await check_mass_action(event, CHANNEL_CREATES, "Mass channel creation detected!", event.channel_id,
+                                    lock=True)
     except Exception as e:
         logging.error(f"Error in on_channel_create event: {e}")
 
 
+@bot.listen(hikari.GuildChannelDeleteEvent)
+@dispatcher.queued(CRITICAL, guild_of)
+@listener_seconds.time("on_channel_delete")
+async def on_channel_delete(event: hikari.GuildChannelDeleteEvent) -> None:
+    try:
+        if not event.guild_id:
+            return
+        change = lockdowns.record(event.guild_id, CHANNEL_DELETE, lockdowns.api.channel_spec(event.channel),
+                                  attributed=True)
+        if change is None:
+            return
+        if await attribute(event, change, hikari.AuditLogEventType.CHANNEL_DELETE, event.channel_id):
+            await check_mass_action(event, CHANNEL_DELETES, "Mass channel deletion detected!", event.channel_id,
+                                    lock=True)
+    except Exception as e:
+        logging.error(f"Error in on_channel_delete event: {e}")
+
+
 @bot.listen(hikari.RoleCreateEvent)
+@dispatcher.queued(NORMAL, guild_of)
+@listener_seconds.time("on_role_create")
 async def on_role_create(event: hikari.RoleCreateEvent) -> None:
     try:
-        if event.is_bot or not event.guild_id:
+        if not event.guild_id:
+            return
+        change = lockdowns.record(event.guild_id, ROLE_CREATE, {"id": int(event.role_id)}, attributed=True)
+        if change is None:
             return
-        recent_actions[event.guild_id]['role_creates'].append(datetime.datetime.now())
-        if len(recent_actions[event.guild_id]['role_creates']) > 5:
-            recent_actions[event.guild_id]['role_creates'].popleft()
-        if len(recent_actions[event.guild_id]['role_creates']) == 5 and (
-                datetime.datetime.now() - recent_actions[event.guild_id]['role_creates'][0]).total_seconds() < 10:
-            embed = hikari.Embed(
-                title="Anti-Nuke",
-                description="Mass role creation detected!",
-                color=hikari.Color(0xFF0000)
-            )
-            await event.get_channel().send(embed=embed)
-            mod_logs[event.guild_id].append("Mass role creation detected!")
-            save_json(MOD_LOGS_FILE, mod_logs)
-            save_json(RECENT_ACTIONS_FILE, recent_actions)
+        if await attribute(event, change, hikari.AuditLogEventType.ROLE_CREATE, event.role_id):
+            await check_mass_action(event, ROLE_CREATES, "Mass role creation detected!", event.role_id, lock=True)
     except Exception as e:
         logging.error(f"Error in on_role_create event: {e}")
 
 
 @bot.listen(hikari.RoleDeleteEvent)
+@dispatcher.queued(CRITICAL, guild_of)
+@listener_seconds.time("on_role_delete")
 async def on_role_delete(event: hikari.RoleDeleteEvent) -> None:
     try:
-        if event.is_bot or not event.guild_id:
+        if not event.guild_id:
+            return
+        # Only a cached role can be recreated
+        spec = lockdowns.api.role_spec(event.old_role) if event.old_role else {"id": int(event.role_id)}
+        change = lockdowns.record(event.guild_id, ROLE_DELETE, spec, attributed=True)
+        if change is None:
             return
-        recent_actions[event.guild_id]['role_deletes'].append(datetime.datetime.now())
-        if len(recent_actions[event.guild_id]['role_deletes']) > 5:
-            recent_actions[event.guild_id]['role_deletes'].popleft()
-        if len(recent_actions[event.guild_id]['role_deletes']) == 5 and (
-                datetime.datetime.now() - recent_actions[event.guild_id]['role_deletes'][0]).total_seconds() < 10:
-            embed = hikari.Embed(
-                title="Anti-Nuke",
-                description="Mass role deletion detected!",
-                color=hikari.Color(0xFF0000)
-            )
-            await event.get_channel().send(embed=embed)
-            mod_logs[event.guild_id].append("Mass role deletion detected!")
-            save_json(MOD_LOGS_FILE, mod_logs)
-            save_json(RECENT_ACTIONS_FILE, recent_actions)
+        if await attribute(event, change, hikari.AuditLogEventType.ROLE_DELETE, event.role_id):
+            await check_mass_action(event, ROLE_DELETES, "Mass role deletion detected!", event.role_id, lock=True)
     except Exception as e:
         logging.error(f"Error in on_role_delete event: {e}")
 
 
 @bot.listen(hikari.MemberDeleteEvent)
+@dispatcher.queued(CRITICAL, guild_of)
+@listener_seconds.time("on_member_delete")
 async def on_member_delete(event: hikari.MemberDeleteEvent) -> None:
     try:
-        if event.is_bot or not event.guild_id:
+        if not event.guild_id:
             return
-        recent_actions[event.guild_id]['member_bans'].append(datetime.datetime.now())
-        if len(recent_actions[event.guild_id]['member_bans']) > 5:
-            recent_actions[event.guild_id]['member_bans'].popleft()
-        if len(recent_actions[event.guild_id]['member_bans']) == 5 and (
-                datetime.datetime.now() - recent_actions[event.guild_id]['member_bans'][0]).total_seconds() < 10:
-            embed = hikari.Embed(
-                title="Anti-Nuke",
-                description="Mass member ban detected!",
-                color=hikari.Color(0xFF0000)
-            )
-            await event.get_channel().send(embed=embed)
-            mod_logs[event.guild_id].append("Mass member ban detected!")
-            save_json(MOD_LOGS_FILE, mod_logs)
-            save_json(RECENT_ACTIONS_FILE, recent_actions)
+        trust.forget_member(event.guild_id, event.user_id)
+        await check_mass_action(event, MEMBER_BANS, "Mass member ban detected!", event.user_id)
     except Exception as e:
         logging.error(f"Error in on_member_delete event: {e}")
 
 
-bot.run()
\ No newline at end of file
+if __name__ == "__main__":
+    bot.run(shard_ids=SHARD_IDS or None, shard_count=SHARD_COUNT)
+    sys.exit(bot.d.exit_code or 0)
\ No newline at end of file
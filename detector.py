@@ -0,0 +1,337 @@
+import time
+from array import array
+from collections import Counter, deque
+
+# Action kinds tracked by the detector. They index straight into each guild's
+# ring list, so lookups on the hot path never build keys.
+MESSAGE_DELETES = 0
+CHANNEL_CREATES = 1
+ROLE_CREATES = 2
+ROLE_DELETES = 3
+MEMBER_BANS = 4
+CHANNEL_DELETES = 5
+ACTION_NAMES = ("message_deletes", "channel_creates", "role_creates", "role_deletes", "member_bans", "channel_deletes")
+
+DEFAULT_COUNT = 5
+DEFAULT_WINDOW = 10.0
+
+# Most deletions one channel adds to a guild's burst score: a purge stays in
+# one channel, a raid deletes across many
+CHANNEL_CAP = 3
+# How long a channel's deletions are credited to the last actor the audit log named there
+ATTRIBUTION_TTL = 5.0
+
+
+class _Ring:
+    __slots__ = ("times", "pos", "filled", "count", "window")
+
+    def __init__(self, count, window):
+        self.times = array("d", [0.0]) * count
+        self.pos = 0
+        self.filled = 0
+        self.count = count
+        self.window = window
+
+
+class RateDetector:
+    """Sliding-window detector for "N actions within T seconds" per guild.
+
+    Each (guild, action) pair owns a preallocated ring of the last N
+    monotonic timestamps, so evaluating an event is a couple of array writes
+    and one subtraction regardless of history size.
+    """
+
+    def __init__(self, count=DEFAULT_COUNT, window=DEFAULT_WINDOW, clock=time.monotonic):
+        self.count = count
+        self.window = window
+        self.clock = clock
+        self._guilds = {}
+        self._thresholds = {}
+        # Below 1 while boosted: every guild trips on that fraction of its count
+        self.sensitivity = 1.0
+        self.boosted_until = 0.0
+
+    def _new_rings(self, guild_id):
+        overrides = self._thresholds.get(guild_id, {})
+        return [_Ring(*overrides.get(action, (self.count, self.window))) for action in range(len(ACTION_NAMES))]
+
+    def hit(self, guild_id, action, now=None):
+        """Record one action and return True if the guild is over its threshold."""
+        rings = self._guilds.get(guild_id)
+        if rings is None:
+            rings = self._guilds[guild_id] = self._new_rings(guild_id)
+        ring = rings[action]
+        if now is None:
+            now = self.clock()
+        times = ring.times
+        pos = ring.pos
+        times[pos] = now
+        pos += 1
+        if pos == ring.count:
+            pos = 0
+        ring.pos = pos
+        count = ring.count
+        if ring.filled < count:
+            ring.filled += 1
+        if self.sensitivity < 1.0:
+            if now < self.boosted_until:
+                count = max(2, round(count * self.sensitivity))
+            else:
+                self.sensitivity = 1.0
+        if ring.filled < count:
+            return False
+        # The oldest of the last ``count`` actions; with the full count, the
+        # slot about to be overwritten
+        return now - times[pos - count] < ring.window
+
+    def boost(self, sensitivity, until):
+        """Until ``until`` on this detector's clock, trip on ``sensitivity`` times every threshold's count."""
+        self.sensitivity = sensitivity
+        self.boosted_until = max(self.boosted_until, until)
+
+    def set_threshold(self, guild_id, action, count, window):
+        """Override the threshold for one guild and action, keeping recent history."""
+        self._thresholds.setdefault(guild_id, {})[action] = (count, float(window))
+        rings = self._guilds.get(guild_id)
+        if rings is not None:
+            history = self._history(rings[action])
+            rings[action] = ring = _Ring(count, float(window))
+            for t in history[-count:]:
+                self._push(ring, t)
+
+    def threshold(self, guild_id, action):
+        return self._thresholds.get(guild_id, {}).get(action, (self.count, self.window))
+
+    def export(self, guild_id, action):
+        """Return the guild's recent actions as epoch timestamps, oldest first."""
+        rings = self._guilds.get(guild_id)
+        if rings is None:
+            return []
+        offset = time.time() - self.clock()
+        return [t + offset for t in self._history(rings[action])]
+
+    def restore(self, guild_id, action, timestamps):
+        """Load epoch timestamps produced by ``export``.
+
+        Merged with any actions already recorded, since state may finish
+        loading after the first events of a session have come in. Those are
+        also in ``timestamps`` when it was exported after them, so only the
+        older entries are taken.
+        """
+        rings = self._guilds.get(guild_id)
+        if rings is None:
+            rings = self._guilds[guild_id] = self._new_rings(guild_id)
+        ring = rings[action]
+        offset = time.time() - self.clock()
+        history = self._history(ring)
+        # Allow for the two clocks drifting between export and restore
+        before = history[0] - 0.001 if history else float("inf")
+        history = sorted([t - offset for t in timestamps if t - offset < before] + history)
+        rings[action] = ring = _Ring(ring.count, ring.window)
+        for t in history[-ring.count:]:
+            self._push(ring, t)
+
+    @staticmethod
+    def _history(ring):
+        if ring.filled < ring.count:
+            return list(ring.times[:ring.filled])
+        return list(ring.times[ring.pos:]) + list(ring.times[:ring.pos])
+
+    @staticmethod
+    def _push(ring, t):
+        ring.times[ring.pos] = t
+        ring.pos = (ring.pos + 1) % ring.count
+        ring.filled = min(ring.filled + 1, ring.count)
+
+
+class DeleteBurst:
+    """One message-delete incident in a guild, as reported when it opens."""
+
+    __slots__ = ("guild_id", "started", "last_over", "deleted", "channels", "actors")
+
+    def __init__(self, guild_id, now):
+        self.guild_id = guild_id
+        self.started = now
+        self.last_over = now
+        self.deleted = 0
+        # Messages deleted per channel and per credited actor
+        self.channels = Counter()
+        self.actors = Counter()
+
+
+class _GuildDeletes:
+    __slots__ = ("channels", "credits", "burst")
+
+    def __init__(self):
+        # channel_id -> deque of [time, count, actor_id]
+        self.channels = {}
+        # channel_id -> (actor_id, trusted, until)
+        self.credits = {}
+        self.burst = None
+
+
+class DeleteTracker:
+    """Message-delete bursts per guild, from single and bulk delete events.
+
+    Deletions are kept in a sliding window per channel, with the actor the
+    audit log last named for that channel. A guild's score is the sum over
+    channels of each channel's count capped at ``channel_cap``, so a purge of
+    one channel scores the cap however many messages it removes, while
+    deletions spread over channels add up. Deletions by trusted actors weigh
+    nothing. ``threshold(guild_id)`` gives the ``(count, window)`` to reach,
+    normally the guild's message_deletes setting on the RateDetector.
+
+    Reaching the threshold opens one ``DeleteBurst``, which ``ingest`` returns
+    once. Further deletions join it until the score has stayed under the
+    threshold for a whole window, so an incident raises one alert.
+    """
+
+    def __init__(self, threshold, channel_cap=CHANNEL_CAP, attribution_ttl=ATTRIBUTION_TTL, clock=time.monotonic):
+        self.threshold = threshold
+        self.channel_cap = channel_cap
+        self.attribution_ttl = attribution_ttl
+        self.clock = clock
+        self._guilds = {}
+
+    def attribute(self, guild_id, channel_id, actor_id, trusted, count=0):
+        """Credit a channel's deletions to ``actor_id``, from an audit-log entry.
+
+        The entry can arrive after the delete events it covers, so up to
+        ``count`` of the channel's recent uncredited deletions are credited
+        too, and dropped if the actor is trusted.
+        """
+        now = self.clock()
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = _GuildDeletes()
+        guild.credits[channel_id] = (actor_id, trusted, now + self.attribution_ttl)
+        entries = guild.channels.get(channel_id)
+        if not entries or not count:
+            return
+        for entry in reversed(entries):
+            if entry[0] < now - self.attribution_ttl or count <= 0:
+                break
+            if entry[2] is None:
+                credited = min(entry[1], count)
+                count -= credited
+                if trusted:
+                    entry[1] -= credited
+                else:
+                    entry[2] = actor_id
+                    if guild.burst is not None:
+                        guild.burst.actors[actor_id] += credited
+
+    def ingest(self, guild_id, channel_id, count=1, now=None):
+        """Record ``count`` deleted messages; returns the burst if this opened one."""
+        if now is None:
+            now = self.clock()
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = _GuildDeletes()
+        actor_id = None
+        credit = guild.credits.get(channel_id)
+        if credit is not None:
+            if credit[2] < now:
+                del guild.credits[channel_id]
+            elif credit[1]:
+                return None
+            else:
+                actor_id = credit[0]
+        entries = guild.channels.get(channel_id)
+        if entries is None:
+            entries = guild.channels[channel_id] = deque()
+        entries.append([now, count, actor_id])
+
+        limit, window = self.threshold(guild_id)
+        score = self._score(guild, now - window)
+        burst = guild.burst
+        if burst is not None:
+            if score >= limit:
+                burst.last_over = now
+            elif now - burst.last_over >= window:
+                burst = guild.burst = None
+        if burst is not None:
+            burst.deleted += count
+            burst.channels[channel_id] += count
+            if actor_id is not None:
+                burst.actors[actor_id] += count
+            return None
+        if score < limit:
+            return None
+        # Opened with everything still in the window
+        burst = guild.burst = DeleteBurst(guild_id, now)
+        for channel, channel_entries in guild.channels.items():
+            for _, deleted, actor in channel_entries:
+                burst.deleted += deleted
+                burst.channels[channel] += deleted
+                if actor is not None:
+                    burst.actors[actor] += deleted
+        return burst
+
+    def _score(self, guild, since):
+        score = 0
+        cap = self.channel_cap
+        for channel_id in list(guild.channels):
+            entries = guild.channels[channel_id]
+            while entries and entries[0][0] < since:
+                entries.popleft()
+            if not entries:
+                del guild.channels[channel_id]
+                continue
+            total = 0
+            for entry in entries:
+                total += entry[1]
+                if total >= cap:
+                    break
+            score += min(total, cap)
+        return score
+
+
+def _benchmark(events=1_000_000, guilds=1000):
+    import datetime
+    from collections import defaultdict, deque
+
+    guild_ids = [1094926261459111936 + i for i in range(guilds)]
+
+    # The per-listener logic this module replaced
+    recent_actions = defaultdict(lambda: defaultdict(deque))
+
+    def legacy(guild_id):
+        recent_actions[guild_id]['role_creates'].append(datetime.datetime.now())
+        if len(recent_actions[guild_id]['role_creates']) > 5:
+            recent_actions[guild_id]['role_creates'].popleft()
+        return len(recent_actions[guild_id]['role_creates']) == 5 and (
+            datetime.datetime.now() - recent_actions[guild_id]['role_creates'][0]).total_seconds() < 10
+
+    detector = RateDetector()
+
+    def current(guild_id):
+        return detector.hit(guild_id, ROLE_CREATES)
+
+    for name, check in (("before (deque + datetime)", legacy), ("after (RateDetector)", current)):
+        start = time.perf_counter()
+        for i in range(events):
+            check(guild_ids[i % guilds])
+        elapsed = time.perf_counter() - start
+        print(f"{name:28} {events / elapsed:>12,.0f} events/sec")
+
+    # A raid deleting 200 messages across 4 channels over 20 seconds, fed
+    # one delete event at a time: alerts raised per incident
+    clock = [0.0]
+    tracker = DeleteTracker(lambda guild_id: (5, 10.0), clock=lambda: clock[0])
+    per_event = sum(detector.hit(guild_ids[0], MESSAGE_DELETES, now=i / 10) for i in range(200))
+    bursts = 0
+    for i in range(200):
+        clock[0] = i / 10
+        bursts += tracker.ingest(guild_ids[0], i % 4) is not None
+    print(f"alerts for one 200-delete raid: {per_event} from RateDetector.hit, {bursts} from DeleteTracker")
+
+    start = time.perf_counter()
+    for i in range(events):
+        tracker.ingest(guild_ids[i % guilds], i % 7, now=i / 1000)
+    elapsed = time.perf_counter() - start
+    print(f"{'DeleteTracker.ingest':28} {events / elapsed:>12,.0f} events/sec")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,265 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import Counter, deque
+
+# Event priorities. Critical events (bans, kicks, deletions) are never shed
+# and have workers of their own; low ones (plain message scans) are the first
+# to go when a guild falls behind.
+CRITICAL = 0
+NORMAL = 1
+LOW = 2
+PRIORITY_NAMES = ("critical", "normal", "low")
+
+
+class _Guild:
+    __slots__ = ("id", "queues", "running", "offered", "full")
+
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.queues = (deque(), deque(), deque())
+        self.running = 0
+        # Whether the guild is waiting in the critical and the general ring
+        self.offered = [False, False]
+        self.full = False
+
+    def backlog(self):
+        return len(self.queues[NORMAL]) + len(self.queues[LOW])
+
+    def depth(self):
+        return len(self.queues[CRITICAL]) + self.backlog()
+
+
+class EventDispatcher:
+    """Runs event handlers from bounded per-guild queues, taking guilds in turn.
+
+    ``submit`` queues ``handler(*args)`` for a guild and returns at once, so
+    a guild under raid piles up work in its own queue instead of in the event
+    loop. Guilds with queued work wait in a ring and each turn runs one
+    handler, so a guild with thousands of events gets no more turns than one
+    with a single event, and no guild runs more than ``guild_concurrency``
+    handlers at a time.
+
+    Critical events go through a ring of their own that every worker looks at
+    first, and ``critical_workers`` workers serve nothing else, so bans and
+    deletions start promptly however busy the general workers are. Once a
+    guild has ``shed_depth`` normal and low events queued its low ones are
+    dropped; at ``max_depth`` queued low events make room for normal ones, and
+    normal ones past that are dropped too. Critical events are never dropped.
+    """
+
+    def __init__(self, workers=32, critical_workers=4, guild_concurrency=8, shed_depth=200, max_depth=2000,
+                 latency_samples=1000):
+        self.workers = workers
+        self.critical_workers = critical_workers
+        self.guild_concurrency = guild_concurrency
+        self.shed_depth = shed_depth
+        self.max_depth = max_depth
+        self._guilds = {}
+        self._critical = asyncio.Queue()
+        self._general = asyncio.Queue()
+        self._tasks = []
+        self._outstanding = 0
+        self.latencies = [deque(maxlen=latency_samples) for _ in PRIORITY_NAMES]
+        self.completed = Counter()
+        self.failed = Counter()
+        self.shed = Counter()
+
+    def submit(self, guild_id, priority, handler, *args):
+        """Queue ``handler(*args)`` for a guild; returns False if it was shed."""
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = _Guild(guild_id)
+        queues = guild.queues
+        if priority != CRITICAL:
+            backlog = guild.backlog()
+            if priority == LOW and backlog >= self.shed_depth:
+                self.shed[LOW] += 1
+                return False
+            if backlog >= self.max_depth:
+                if not queues[LOW]:
+                    self.shed[NORMAL] += 1
+                    if not guild.full:
+                        guild.full = True
+                        logging.warning(f"Event queue of guild {guild_id} is full, dropping events")
+                    return False
+                queues[LOW].popleft()
+                self.shed[LOW] += 1
+                self._outstanding -= 1
+        queues[priority].append((handler, args, time.monotonic()))
+        self._outstanding += 1
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work(general=i >= self.critical_workers))
+                           for i in range(self.critical_workers + self.workers)]
+        self._offer(guild)
+        return True
+
+    def queued(self, priority, guild_of):
+        """Decorate an event handler so calling it queues it under ``guild_of(*args)``."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args):
+                self.submit(guild_of(*args), priority, func, *args)
+            return wrapper
+        return decorator
+
+    def depth(self, guild_id):
+        guild = self._guilds.get(guild_id)
+        return guild.depth() if guild else 0
+
+    def depths(self):
+        """Queued events per guild, for guilds with any."""
+        return {guild_id: guild.depth() for guild_id, guild in self._guilds.items() if guild.depth()}
+
+    async def drain(self):
+        """Wait until every queued event has been handled."""
+        while self._outstanding:
+            await asyncio.sleep(0.01)
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def _offer(self, guild):
+        # Puts the guild at the back of the rings it has work for, once
+        if guild.running >= self.guild_concurrency:
+            return
+        if guild.queues[CRITICAL] and not guild.offered[0]:
+            guild.offered[0] = True
+            self._critical.put_nowait(guild)
+            # Wakes a general worker in case the critical ones are all busy
+            self._general.put_nowait(None)
+        if guild.backlog() and not guild.offered[1]:
+            guild.offered[1] = True
+            self._general.put_nowait(guild)
+
+    async def _work(self, general):
+        while True:
+            if general and self._critical.empty():
+                guild = await self._general.get()
+                if guild is None:
+                    continue
+                ring = 1
+                queue = guild.queues[NORMAL] or guild.queues[LOW]
+            else:
+                guild = await self._critical.get() if not general else self._critical.get_nowait()
+                ring = 0
+                queue = guild.queues[CRITICAL]
+            guild.offered[ring] = False
+            if not queue or guild.running >= self.guild_concurrency:
+                # Emptied by shedding, or offered again when a running handler finishes
+                self._forget(guild)
+                continue
+            handler, args, enqueued = queue.popleft()
+            priority = CRITICAL if ring == 0 else NORMAL if queue is guild.queues[NORMAL] else LOW
+            self.latencies[priority].append(time.monotonic() - enqueued)
+            guild.running += 1
+            # The guild's next event can go to another worker meanwhile
+            self._offer(guild)
+            try:
+                await handler(*args)
+                self.completed[priority] += 1
+            except Exception as e:
+                self.failed[priority] += 1
+                logging.error(f"Error in {handler.__name__} for guild {guild.id}: {e}")
+            finally:
+                guild.running -= 1
+                self._outstanding -= 1
+                self._offer(guild)
+                self._forget(guild)
+
+    def _forget(self, guild):
+        if not guild.running and not guild.depth() and self._guilds.get(guild.id) is guild:
+            del self._guilds[guild.id]
+
+    def outcomes(self):
+        """Events completed, failed and shed per ``(priority, outcome)``."""
+        return {(name, outcome): counts[priority]
+                for priority, name in enumerate(PRIORITY_NAMES)
+                for outcome, counts in (("completed", self.completed), ("failed", self.failed), ("shed", self.shed))}
+
+    def stats(self):
+        """Queue depth, outcomes and queueing delay per priority."""
+        stats = {}
+        for priority, name in enumerate(PRIORITY_NAMES):
+            ordered = sorted(self.latencies[priority])
+            stats[name] = {
+                "depth": sum(len(guild.queues[priority]) for guild in self._guilds.values()),
+                "completed": self.completed[priority],
+                "failed": self.failed[priority],
+                "shed": self.shed[priority],
+                "p50": ordered[len(ordered) // 2] if ordered else 0.0,
+                "p99": ordered[int(len(ordered) * 0.99)] if ordered else 0.0,
+            }
+        return stats
+
+
+def _benchmark(noisy_events=5000, quiet_guilds=50, rate=100.0, work=0.0002, latency=0.02):
+    # One guild under raid floods message scans and role creations, a fifth
+    # of which make a REST call, while fifty quiet guilds each see a ban now
+    # and then. REST calls share one global rate limit of ``rate`` a second,
+    # as they do in both libraries, and take ``latency`` seconds once sent.
+    def busy():
+        end = time.perf_counter() + work
+        while time.perf_counter() < end:
+            pass
+
+    async def run(queued):
+        loop = asyncio.get_running_loop()
+        next_request = [0.0]
+        delays = []
+        handled = [0]
+
+        async def rest():
+            now = loop.time()
+            wait = max(0.0, next_request[0] - now)
+            next_request[0] = max(now, next_request[0]) + 1 / rate
+            await asyncio.sleep(wait + latency)
+
+        async def raid_event(request):
+            busy()
+            if request:
+                await rest()
+            handled[0] += 1
+
+        async def ban(arrived):
+            busy()
+            await rest()
+            delays.append(time.perf_counter() - arrived)
+
+        dispatcher = EventDispatcher()
+        tasks = []
+        started = time.perf_counter()
+        for i in range(noisy_events):
+            request = i % 5 == 0
+            if queued:
+                dispatcher.submit(0, NORMAL if request else LOW, raid_event, request)
+            else:
+                # What the libraries do: a task per event straight away
+                tasks.append(asyncio.create_task(raid_event(request)))
+            if i % 100 == 0:
+                if queued:
+                    dispatcher.submit(1 + i // 100 % quiet_guilds, CRITICAL, ban, time.perf_counter())
+                else:
+                    tasks.append(asyncio.create_task(ban(time.perf_counter())))
+                await asyncio.sleep(0)
+        if queued:
+            await dispatcher.drain()
+            dispatcher.close()
+        else:
+            await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        delays.sort()
+        return (handled[0], sum(dispatcher.shed.values()), delays[len(delays) // 2],
+                delays[int(len(delays) * 0.99)], elapsed)
+
+    for name, queued in (("task per event", False), ("EventDispatcher", True)):
+        handled, shed, p50, p99, elapsed = asyncio.run(run(queued))
+        print(f"{name:16} raid guild: {handled:,} handled, {shed:,} shed; quiet guilds' bans handled after "
+              f"p50 {p50:.2f}s, p99 {p99:.2f}s; all done after {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,283 @@
+import re
+import time
+from collections import deque
+from itertools import islice
+
+# Normalized texts shorter than this are everyday phrases that plenty of
+# people type on their own, so only longer ones are compared
+MIN_LENGTH = 32
+# Only the start of longer messages is compared
+MAX_LENGTH = 256
+# Characters per shingle, and how many of the smallest shingle hashes make a
+# message's signature
+SHINGLE = 4
+SIGNATURE = 24
+# A signature is indexed under its few smallest hashes. Two texts share their
+# smallest with a chance equal to their similarity, so near duplicates
+# almost always share one of these.
+KEYS = 4
+
+_TOKENS = re.compile(r"[^\W_]+")
+_SHINGLES = [slice(i, i + SHINGLE) for i in range(MAX_LENGTH - SHINGLE + 1)]
+
+
+def normalize(content):
+    """Message text as its lowercase words and numbers, one space apart, cut to ``MAX_LENGTH``."""
+    return " ".join(_TOKENS.findall(content.casefold()))[:MAX_LENGTH]
+
+
+def signature(text):
+    """Bottom-k MinHash of ``text``: the smallest ``SIGNATURE`` hashes of its shingles, sorted.
+
+    Built from Python's string hash, so signatures only compare within one process.
+    """
+    return sorted(set(map(hash, map(text.__getitem__, _SHINGLES[:len(text) - SHINGLE + 1]))))[:SIGNATURE]
+
+
+def similarity(a, b):
+    """Share of hashes two signatures, given as sets, have in common; it rises with the texts' similarity."""
+    return len(a & b) / max(len(a), len(b))
+
+
+class DuplicateCluster:
+    """Near-identical messages in one guild, and the authors who posted them lately."""
+
+    __slots__ = ("guild_id", "text", "authors", "pending", "flagged")
+
+    def __init__(self, guild_id, text):
+        self.guild_id = guild_id
+        # Normalized text of the first message
+        self.text = text
+        # author_id -> when they last posted, oldest first
+        self.authors = {}
+        # (time, author_id, ref) for messages not yet taken
+        self.pending = deque()
+        # How many times check has returned the cluster
+        self.flagged = 0
+
+    def take(self):
+        """The ``(author_id, ref)`` of messages added since the last call."""
+        taken = [(author_id, ref) for _, author_id, ref in self.pending]
+        self.pending.clear()
+        return taken
+
+
+class _Entry:
+    __slots__ = ("time", "hashes", "keys", "digest", "cluster")
+
+    def __init__(self, now, hashes, keys, digest, cluster):
+        self.time = now
+        # The signature as a set, and the keys it is indexed under
+        self.hashes = hashes
+        self.keys = keys
+        self.digest = digest
+        self.cluster = cluster
+
+
+class _GuildIndex:
+    __slots__ = ("entries", "exact", "buckets")
+
+    def __init__(self):
+        # Oldest first, and likewise in every bucket, so eviction pops from the left
+        self.entries = deque()
+        # hash of the normalized text -> its latest entry
+        self.exact = {}
+        # signature key -> entries indexed under it
+        self.buckets = {}
+
+
+class NearDuplicateDetector:
+    """Flags many accounts posting the same or slightly altered text in a guild.
+
+    ``check`` normalizes a message and looks it up by a hash of the
+    normalized text, which catches verbatim copies with one dict lookup. A
+    message that is not a copy gets a bottom-k MinHash signature of its
+    character shingles and is compared with the recent messages that share
+    one of its index keys, newest first, up to ``candidates`` per key; keys
+    from common words are shared by much of the chat, so the limit bounds the
+    cost. A message with at least ``similarity`` of its signature in common
+    with another joins that message's cluster; any other starts one.
+
+    Each guild's messages are indexed for ``window`` seconds, or until it has
+    ``max_messages`` newer ones. Once ``authors`` distinct authors have added
+    to a cluster within ``window`` seconds, ``check`` returns the cluster for
+    that message and every later one that joins it, with what the caller has
+    not acted on yet waiting in ``take()``. ``ref`` is whatever the caller
+    needs to act on a message, such as its channel and message ids.
+    """
+
+    def __init__(self, authors=5, window=30.0, similarity=0.6, min_length=MIN_LENGTH, max_messages=5000,
+                 candidates=4, clock=time.monotonic):
+        self.authors = authors
+        self.window = window
+        self.similarity = similarity
+        self.min_length = min_length
+        self.max_messages = max_messages
+        self.candidates = candidates
+        self.clock = clock
+        self.clusters = 0
+        self._guilds = {}
+        self._sweep_at = None
+
+    def __len__(self):
+        return sum(len(index.entries) for index in self._guilds.values())
+
+    def check(self, guild_id, author_id, content, ref=None):
+        """Index a message; returns its cluster if enough authors posted near duplicates lately."""
+        text = normalize(content)
+        if len(text) < self.min_length:
+            return None
+        now = self.clock()
+        if self._sweep_at is None or now >= self._sweep_at:
+            self._sweep(now)
+        index = self._guilds.get(guild_id)
+        if index is None:
+            index = self._guilds[guild_id] = _GuildIndex()
+        else:
+            self._evict(index, now - self.window)
+
+        digest = hash(text)
+        match = index.exact.get(digest)
+        if match is not None:
+            hashes, keys = match.hashes, match.keys
+        else:
+            sig = signature(text)
+            hashes, keys = frozenset(sig), tuple(sig[:KEYS])
+            match = self._nearest(index, hashes, keys)
+        cluster = match.cluster if match is not None else DuplicateCluster(guild_id, text)
+        entry = _Entry(now, hashes, keys, digest, cluster)
+        index.entries.append(entry)
+        index.exact[digest] = entry
+        for key in keys:
+            bucket = index.buckets.get(key)
+            if bucket is None:
+                bucket = index.buckets[key] = deque()
+            bucket.append(entry)
+        if len(index.entries) > self.max_messages:
+            self._drop(index)
+        return self._join(cluster, author_id, ref, now)
+
+    def _nearest(self, index, hashes, keys):
+        threshold = self.similarity
+        for key in keys:
+            bucket = index.buckets.get(key)
+            if bucket:
+                for entry in islice(reversed(bucket), self.candidates):
+                    if similarity(hashes, entry.hashes) >= threshold:
+                        return entry
+        return None
+
+    def _join(self, cluster, author_id, ref, now):
+        authors = cluster.authors
+        since = now - self.window
+        # Moved to the end, so the authors stay ordered by when they last posted
+        authors.pop(author_id, None)
+        authors[author_id] = now
+        while authors[next(iter(authors))] < since:
+            del authors[next(iter(authors))]
+        pending = cluster.pending
+        pending.append((now, author_id, ref))
+        if not cluster.flagged:
+            while pending[0][0] < since:
+                pending.popleft()
+            if len(authors) < self.authors:
+                return None
+            self.clusters += 1
+        cluster.flagged += 1
+        return cluster
+
+    def _evict(self, index, since):
+        entries = index.entries
+        while entries and entries[0].time < since:
+            self._drop(index)
+
+    @staticmethod
+    def _drop(index):
+        entry = index.entries.popleft()
+        if index.exact.get(entry.digest) is entry:
+            del index.exact[entry.digest]
+        for key in entry.keys:
+            bucket = index.buckets[key]
+            bucket.popleft()
+            if not bucket:
+                del index.buckets[key]
+
+    def _sweep(self, now):
+        # Guilds only evict when they get a message, so quiet ones are emptied here
+        self._sweep_at = now + self.window
+        for guild_id, index in list(self._guilds.items()):
+            self._evict(index, now - self.window)
+            if not index.entries:
+                del self._guilds[guild_id]
+
+
+def _benchmark(messages=200_000, guilds=100, raiders=30):
+    import random
+
+    rng = random.Random(1)
+    # A made-up vocabulary used with Zipf frequencies, like real chat
+    words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 8))) for _ in range(2000)]
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    spam = "hey everyone come join our server for free nitro giveaways and daily events"
+    extras = ("now", "pls", "fast", "ok", "guys", "lol")
+
+    def variant():
+        text = spam.split()
+        choice = rng.randrange(3)
+        if choice == 0:
+            text.append(rng.choice(extras))
+        elif choice == 1:
+            i = rng.randrange(len(text))
+            text[i] = text[i][:-1]
+        else:
+            text.insert(0, rng.choice(extras))
+        return " ".join(text).upper() if rng.random() < 0.3 else " ".join(text)
+
+    # Benign chat in many guilds, with thirty raid accounts posting altered
+    # copies of one message in a single guild over the last tenth of it
+    stream = []
+    raid_guild = 1094926261459111936
+    for i in range(messages):
+        guild_id = raid_guild + rng.randrange(guilds)
+        text = " ".join(rng.choices(words, weights, k=rng.randint(3, 14)))
+        stream.append((i / 500, guild_id, rng.randrange(10**6), text, False))
+        if i >= messages * 9 // 10 and i % 50 == 0:
+            stream.append((i / 500, raid_guild, 10**7 + rng.randrange(raiders), variant(), True))
+
+    clock = [0.0]
+    detector = NearDuplicateDetector(clock=lambda: clock[0])
+    caught = missed = false = 0
+    started = time.perf_counter()
+    for now, guild_id, author_id, text, raid in stream:
+        clock[0] = now
+        cluster = detector.check(guild_id, author_id, text)
+        if raid:
+            if cluster is None:
+                missed += 1
+            else:
+                caught += 1
+        elif cluster is not None:
+            false += 1
+    elapsed = time.perf_counter() - started
+    print(f"NearDuplicateDetector: {elapsed / len(stream) * 1e6:.1f} µs per message over {len(stream):,} messages "
+          f"in {guilds:,} guilds; {detector.clusters} clusters flagged, {caught} raid messages flagged as they came and "
+          f"{missed} held until {detector.authors} raiders had posted, {false} benign messages flagged; "
+          f"{len(detector):,} messages indexed at the end")
+
+    # The straightforward alternative: compare with every recent message in the guild
+    recent = {}
+    started = time.perf_counter()
+    for now, guild_id, author_id, text, raid in stream[-20_000:]:
+        text = normalize(text)
+        if len(text) < MIN_LENGTH:
+            continue
+        sig = frozenset(signature(text))
+        kept = recent[guild_id] = [(t, s) for t, s in recent.get(guild_id, ()) if t >= now - detector.window]
+        any(similarity(sig, s) >= detector.similarity for _, s in kept)
+        kept.append((now, sig))
+    elapsed = time.perf_counter() - started
+    print(f"compare with every recent message: {elapsed / 20_000 * 1e6:.1f} µs per message")
+
+
+if __name__ == "__main__":
+    _benchmark()
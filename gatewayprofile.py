@@ -0,0 +1,226 @@
+import logging
+
+# Intents each discord.py / py-cord listener needs before Discord sends its event
+DISCORD_EVENT_INTENTS = {
+    "on_message": ("guilds", "guild_messages"),
+    "on_message_delete": ("guilds", "guild_messages"),
+    "on_bulk_message_delete": ("guilds", "guild_messages"),
+    "on_guild_channel_create": ("guilds",),
+    "on_guild_channel_delete": ("guilds",),
+    "on_guild_role_create": ("guilds",),
+    "on_guild_role_delete": ("guilds",),
+    "on_member_join": ("guilds", "members"),
+    "on_member_remove": ("guilds", "members"),
+    "on_member_update": ("guilds", "members"),
+    "on_member_ban": ("guilds", "bans"),
+    "on_member_unban": ("guilds", "bans"),
+    "on_audit_log_entry_create": ("guilds", "bans"),
+    "on_presence_update": ("guilds", "presences"),
+    "on_typing": ("guilds", "guild_typing"),
+    "on_voice_state_update": ("guilds", "voice_states"),
+    "on_ready": (),
+}
+
+# The only parts of hikari's cache the handlers read: guilds (owner and system
+# channel), guild channels (event.get_channel and lockdown snapshots), roles
+# (lockdown snapshots and deleted roles) and the bot's own user.
+HIKARI_CACHE = ("GUILDS", "GUILD_CHANNELS", "ROLES", "ME")
+
+
+def hikari_profile(event_types, prefix_commands=True, cache=HIKARI_CACHE):
+    """GatewayBot keyword arguments for a bot that listens to ``event_types``.
+
+    Intents come from hikari's own table of what each event needs, so they
+    follow the listeners. hikari logs a warning when a listener is added for
+    an event these intents do not deliver, which catches a profile that has
+    fallen behind the code. Members are never chunked and only the ``cache``
+    components are kept.
+    """
+    import hikari
+    from hikari.events.base_events import get_required_intents_for
+
+    intents = hikari.Intents.NONE
+    for event_type in event_types:
+        # Each entry is an alternative; the first is the narrowest
+        required = get_required_intents_for(event_type)
+        if required:
+            intents |= next(iter(required))
+    if prefix_commands:
+        intents |= hikari.Intents.GUILD_MESSAGES | hikari.Intents.MESSAGE_CONTENT
+    components = hikari.api.CacheComponents.NONE
+    for name in cache:
+        components |= hikari.api.CacheComponents[name]
+    return {
+        "intents": intents,
+        "cache_settings": hikari.impl.CacheSettings(components=components),
+        "auto_chunk_members": False,
+    }
+
+
+def discord_profile(listeners, prefix_commands=True):
+    """commands.Bot keyword arguments for a bot with the ``listeners`` event handlers.
+
+    Presences, typing and voice are off unless a listener needs them, and the
+    message cache is disabled. Members are still cached when a listener needs
+    the members intent, because ``on_member_remove`` only fires for members
+    that are in the cache.
+    """
+    import discord
+
+    intents = discord.Intents.none()
+    for name in listeners:
+        for flag in DISCORD_EVENT_INTENTS[name]:
+            setattr(intents, flag, True)
+    if prefix_commands:
+        intents.guilds = intents.guild_messages = intents.message_content = True
+    return {
+        "intents": intents,
+        "member_cache_flags": discord.MemberCacheFlags.from_intents(intents),
+        "max_messages": None,
+    }
+
+
+def check_discord_listeners(bot, listeners):
+    """Warn about registered handlers the profile was not built for."""
+    listeners = set(listeners)
+    for name in DISCORD_EVENT_INTENTS:
+        registered = name in getattr(bot, "extra_events", {}) or name in vars(bot)
+        if registered and name not in listeners:
+            logging.warning(f"{name} is registered but not in the gateway profile; its intents may be missing")
+
+
+def guild_create_payload(guild_id, members, bot_id, presences=True, all_members=True, channels=50, roles=30):
+    """A synthetic GUILD_CREATE for a large guild, as Discord would send it.
+
+    Without the presences intent Discord only includes the bot and members in
+    voice in ``members``, and leaves ``presences`` out.
+    """
+    user_ids = [bot_id] + [guild_id + 1000 + i for i in range(members)]
+    member_ids = user_ids if all_members else user_ids[:1]
+    payload = {
+        "id": str(guild_id),
+        "name": f"guild {guild_id}",
+        "icon": None,
+        "owner_id": str(user_ids[1] if len(user_ids) > 1 else bot_id),
+        "afk_channel_id": None,
+        "afk_timeout": 300,
+        "verification_level": 1,
+        "default_message_notifications": 1,
+        "explicit_content_filter": 2,
+        "features": ["COMMUNITY", "NEWS"],
+        "mfa_level": 1,
+        "application_id": None,
+        "system_channel_id": str(guild_id + 1),
+        "system_channel_flags": 0,
+        "rules_channel_id": None,
+        "vanity_url_code": None,
+        "description": None,
+        "banner": None,
+        "splash": None,
+        "premium_tier": 2,
+        "premium_subscription_count": 14,
+        "preferred_locale": "en-US",
+        "public_updates_channel_id": None,
+        "nsfw_level": 0,
+        "premium_progress_bar_enabled": False,
+        "max_video_channel_users": 25,
+        "emojis": [],
+        "stickers": [],
+        "joined_at": "2021-01-01T00:00:00.000000+00:00",
+        "large": True,
+        "unavailable": False,
+        "member_count": members + 1,
+        "voice_states": [],
+        "threads": [],
+        "stage_instances": [],
+        "guild_scheduled_events": [],
+        "roles": [
+            {"id": str(guild_id + (i or 0)), "name": "@everyone" if i == 0 else f"role {i}", "color": 0,
+             "hoist": False, "icon": None, "unicode_emoji": None, "position": i, "permissions": "1071698660929",
+             "managed": False, "mentionable": False, "flags": 0}
+            for i in range(roles)
+        ],
+        "channels": [
+            {"id": str(guild_id + 1 + i), "type": 0, "name": f"channel-{i}", "position": i,
+             "permission_overwrites": [], "nsfw": False, "parent_id": None, "topic": None,
+             "last_message_id": None, "rate_limit_per_user": 0, "guild_id": str(guild_id)}
+            for i in range(channels)
+        ],
+        "members": [
+            {"user": {"id": str(user_id), "username": f"user{user_id % 100000}", "global_name": None,
+                      "discriminator": "0", "avatar": None, "bot": user_id == bot_id, "public_flags": 0},
+             "nick": None, "avatar": None, "roles": [str(guild_id + 1 + user_id % (roles - 1))],
+             "joined_at": "2022-05-01T12:00:00.000000+00:00", "premium_since": None, "deaf": False,
+             "mute": False, "flags": 0, "pending": False, "communication_disabled_until": None}
+            for user_id in member_ids
+        ],
+    }
+    if presences:
+        payload["presences"] = [
+            {"user": {"id": str(user_id)}, "guild_id": str(guild_id), "status": "online",
+             "client_status": {"desktop": "online"},
+             "activities": [{"id": "custom", "name": "Custom Status", "type": 4, "state": "grinding ranked",
+                             "created_at": 1700000000000}]}
+            for user_id in user_ids
+        ]
+    return payload
+
+
+def _benchmark(guilds=20, members=5000):
+    import asyncio
+    import json
+    import tracemalloc
+
+    import hikari
+    bot_id = 1000000000000000000
+    event_types = (hikari.GuildMessageCreateEvent, hikari.GuildMessageDeleteEvent, hikari.GuildBulkMessageDeleteEvent,
+                   hikari.AuditLogEntryCreateEvent, hikari.GuildChannelCreateEvent, hikari.GuildChannelDeleteEvent,
+                   hikari.RoleCreateEvent, hikari.RoleDeleteEvent, hikari.MemberDeleteEvent)
+    profile = hikari_profile(event_types)
+
+    class Shard:
+        id = 0
+        shard_count = 1
+
+        def get_user_id(self):
+            return hikari.Snowflake(bot_id)
+
+        async def request_guild_members(self, *args, **kwargs):
+            pass
+
+    async def ingest(options, presences):
+        bot = hikari.GatewayBot("offline", banner=None, **options)
+        shard = Shard()
+        inbound = 0
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(guilds):
+            guild_id = (1100000000000000000 + i * 10**7)
+            payload = guild_create_payload(guild_id, members, bot_id, presences=presences, all_members=presences)
+            inbound += len(json.dumps(payload))
+            await bot.event_manager.on_guild_create(shard, payload)
+            del payload
+        retained = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return inbound, retained, bot
+
+    everything = {"intents": hikari.Intents.ALL}
+    print(f"{guilds} guilds x {members:,} members")
+    print(f"profile intents: {profile['intents']!r}")
+    print(f"profile cache:   {profile['cache_settings'].components!r}")
+    results = {}
+    cache_only = dict(profile, intents=hikari.Intents.ALL)
+    for name, options, presences in (("Intents.ALL, default cache", everything, True),
+                                     ("Intents.ALL, profile cache", cache_only, True),
+                                     ("gateway profile", profile, False)):
+        inbound, retained, bot = asyncio.run(ingest(options, presences))
+        results[name] = (inbound, retained)
+        print(f"{name:28} GUILD_CREATE {inbound / 1e6:7.1f} MB in, cache retains {retained / 1e6:7.1f} MB")
+    all_in, all_kept = results["Intents.ALL, default cache"]
+    profile_in, profile_kept = results["gateway profile"]
+    print(f"inbound {all_in / max(profile_in, 1):.0f}x smaller, retained memory {all_kept / max(profile_kept, 1):.0f}x smaller "
+          f"(presence updates, typing and voice events are not delivered at all)")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SETTINGS = {
+    "anti_channel_create": True,
+    "anti_channel_delete": True,
+    "anti_role_create": True,
+    "anti_role_delete": True,
+    "anti_ban": True,
+    "anti_kick": True,
+    "punishment": "timeout",  # can be "timeout" or "kick"
+    "timeout_duration": 600,  # duration in seconds
+    "anti_invite_links": True,
+    "anti_mass_messages": True,
+    "anti_duplicate_messages": True,
+    "mass_message_threshold": 5,
+    "mass_message_timeframe": 10,  # seconds
+    "log_channel": None  # channel id for anti-nuke alerts, None for the system channel
+}
+
+# Bits for the on/off settings, tested on every event
+ANTI_CHANNEL_CREATE = 1 << 0
+ANTI_CHANNEL_DELETE = 1 << 1
+ANTI_ROLE_CREATE = 1 << 2
+ANTI_ROLE_DELETE = 1 << 3
+ANTI_BAN = 1 << 4
+ANTI_KICK = 1 << 5
+ANTI_INVITE_LINKS = 1 << 6
+ANTI_MASS_MESSAGES = 1 << 7
+ANTI_DUPLICATE_MESSAGES = 1 << 8
+FLAGS = {
+    "anti_channel_create": ANTI_CHANNEL_CREATE,
+    "anti_channel_delete": ANTI_CHANNEL_DELETE,
+    "anti_role_create": ANTI_ROLE_CREATE,
+    "anti_role_delete": ANTI_ROLE_DELETE,
+    "anti_ban": ANTI_BAN,
+    "anti_kick": ANTI_KICK,
+    "anti_invite_links": ANTI_INVITE_LINKS,
+    "anti_mass_messages": ANTI_MASS_MESSAGES,
+    "anti_duplicate_messages": ANTI_DUPLICATE_MESSAGES,
+}
+
+
+class GuildConfig:
+    """One guild's settings and blocklist.
+
+    ``settings`` holds only this guild's overrides and is what gets saved.
+    The remaining attributes are compiled from it by ``compile`` so handlers
+    test a bit or read a slot instead of looking up string keys.
+    ``whitelist`` is what older files saved before trust lists replaced it;
+    it is only read to migrate it and is not saved again.
+    """
+
+    __slots__ = ("settings", "whitelist", "blocklist", "flags", "kick", "timeout_duration",
+                 "mass_message_threshold", "mass_message_timeframe", "log_channel")
+
+    def __init__(self, settings, whitelist, blocklist, defaults):
+        self.settings = settings
+        self.whitelist = whitelist
+        self.blocklist = blocklist
+        self.compile(defaults)
+
+    def compile(self, defaults):
+        merged = dict(defaults, **self.settings)
+        self.flags = 0
+        for key, flag in FLAGS.items():
+            if merged[key]:
+                self.flags |= flag
+        self.kick = merged["punishment"] == "kick"
+        self.timeout_duration = merged["timeout_duration"]
+        self.mass_message_threshold = merged["mass_message_threshold"]
+        self.mass_message_timeframe = merged["mass_message_timeframe"]
+        self.log_channel = merged["log_channel"]
+
+    def merged(self, defaults):
+        return dict(defaults, **self.settings)
+
+
+class GuildConfigStore:
+    """Per-guild configuration, loaded on first use and kept in an LRU.
+
+    Each guild is stored in its own small file under ``folder``, so a change
+    rewrites only that guild's file. Writes go through a single background
+    thread, which keeps them off the event loop and in order.
+    """
+
+    def __init__(self, folder, defaults=DEFAULT_SETTINGS, capacity=1024, on_load=None, on_evict=None):
+        self.folder = folder
+        self.defaults = dict(defaults)
+        self.capacity = capacity
+        self.on_load = on_load
+        self.on_evict = on_evict
+        self._cache = OrderedDict()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="guild-config")
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, guild_id):
+        return os.path.join(self.folder, f"{guild_id}.json")
+
+    def get(self, guild_id):
+        config = self._cache.get(guild_id)
+        if config is not None:
+            self._cache.move_to_end(guild_id)
+            return config
+        config = self._load(guild_id)
+        self._cache[guild_id] = config
+        if len(self._cache) > self.capacity:
+            evicted, _ = self._cache.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(evicted)
+        if self.on_load:
+            self.on_load(guild_id, config)
+        return config
+
+    def _load(self, guild_id):
+        path = self._path(guild_id)
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                data = json.load(file)
+            return GuildConfig(data.get("settings", {}), set(data.get("whitelist", [])),
+                               data.get("blocklist", []), self.defaults)
+        return GuildConfig({}, set(), [], self.defaults)
+
+    def update(self, guild_id, **settings):
+        config = self.get(guild_id)
+        config.settings.update(settings)
+        config.compile(self.defaults)
+        self._save(guild_id, config)
+
+    def set_blocklist(self, guild_id, words):
+        config = self.get(guild_id)
+        config.blocklist = sorted(words)
+        self._save(guild_id, config)
+
+    def _save(self, guild_id, config):
+        # Snapshot now so later changes on the event loop cannot race the writer
+        data = {"settings": dict(config.settings), "blocklist": list(config.blocklist)}
+        self._writer.submit(self._write, self._path(guild_id), data)
+
+    @staticmethod
+    def _write(path, data):
+        try:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(data, file)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.error(f"Error saving {path}: {e}")
+
+    def close(self):
+        self._writer.shutdown(wait=True)
@@ -0,0 +1,876 @@
+"""Offline replay and load-test harness for the anti-nuke listeners.
+
+Drives the real listeners in cracker.py and antieverything.py with synthetic
+or recorded gateway events, against fake REST objects that count every call
+instead of touching the network. Detector clocks are driven from the event
+timestamps, so a stream replays deterministically however fast it is pushed.
+
+    python harness.py                          # generate a raid and replay it into both bots
+    python harness.py --record raid.jsonl      # also save the generated stream
+    python harness.py --replay raid.jsonl --bot cracker --check
+
+The report covers per-handler latency percentiles, events/sec, REST calls by
+route, how long queued events waited per priority and detection correctness against the expectations derived from the
+stream. With ``--check`` the exit status is non-zero when any detection is
+missed or spurious, which makes it usable as a CI regression gate.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+from collections import Counter, defaultdict
+
+from auditlog import DISCORD_EPOCH
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Snowflakes used by the generated scenario
+GUILD_BASE = 1100000000000000000
+USER_BASE = 800000000000000000
+MODERATOR_ID = 700000000000000001
+# Every guild's owner, and an admin trusted through ADMIN_ROLE_ID who never posts
+OWNER_ID = 700000000000000002
+ADMIN_ID = 700000000000000003
+ADMIN_ROLE_ID = 700000000000000004
+# Never punished, and their channel and role changes are never a raid
+TRUSTED_ACTORS = (MODERATOR_ID, OWNER_ID, ADMIN_ID)
+NUKER_BASE = 900000000000000000
+SPAMMER_BASE = 910000000000000000
+WAVE_BASE = 920000000000000000
+# On every guild's blocklist in AntiEverythingHarness
+BLOCKED_WORD = "frick"
+
+# Event types understood by the harness, in stream records
+EVENT_TYPES = ("message", "message_delete", "message_bulk_delete", "channel_create", "channel_delete", "role_create", "role_delete",
+               "ban", "kick")
+
+
+# Stream generation
+
+def generate(guilds=20, raid_guilds=5, nuke_actions=40, users_per_guild=50, duration=60.0, seed=0, spam_wave=8):
+    """Build a mixed stream of benign traffic, moderator actions and raids.
+
+    Each record is a dict with ``t`` (seconds from start), ``type``, ``guild``,
+    ``actor``, ``target`` and, for messages, ``content`` and ``spam``, plus
+    ``wave`` for the coordinated spam of ``spam_wave`` accounts, ``blocked``
+    for a blocked word and ``command`` for a prefix command. Message
+    deletions also carry the ``channel``, and bulk deletions a ``count``.
+    """
+    rng = random.Random(seed)
+    events = []
+    next_id = iter(range(10**17, 10**18))
+    chatter = ("anyone up for ranked", "patch notes are out", "check the pinned message", "gg", "nice clip",
+               "what time is the event", "thanks!", "lol", "brb", "is the server down?")
+
+    for g in range(guilds):
+        guild = GUILD_BASE + g
+        # Benign chat: each user speaks every few seconds at most
+        for u in range(users_per_guild):
+            t = rng.uniform(0, 5)
+            while t < duration:
+                events.append({"t": t, "type": "message", "guild": guild, "actor": USER_BASE + g * 1000 + u,
+                               "target": next(next_id), "content": rng.choice(chatter), "spam": False})
+                t += rng.uniform(3, 15)
+        # A whitelisted moderator tidies up a little
+        for kind in ("channel_delete", "role_delete", "ban"):
+            events.append({"t": rng.uniform(0, duration), "type": kind, "guild": guild, "actor": MODERATOR_ID,
+                           "target": next(next_id)})
+        # and purges a channel, once message by message and once in bulk
+        start = rng.uniform(0, duration - 5)
+        for i in range(20):
+            events.append({"t": start + 2.0 * i / 20, "type": "message_delete", "guild": guild, "actor": MODERATOR_ID,
+                           "target": next(next_id), "channel": guild + 1})
+        events.append({"t": rng.uniform(0, duration), "type": "message_bulk_delete", "guild": guild,
+                       "actor": MODERATOR_ID, "target": next(next_id), "channel": guild + 1, "count": 100})
+        # Someone uses the blocked word, and the moderator then takes it off
+        # the blocklist, which names it
+        t = rng.uniform(0, duration - 1)
+        events.append({"t": t, "type": "message", "guild": guild, "actor": USER_BASE + g * 1000,
+                       "target": next(next_id), "content": f"what the {BLOCKED_WORD} is this", "spam": False,
+                       "blocked": True})
+        events.append({"t": t + 1, "type": "message", "guild": guild, "actor": MODERATOR_ID, "target": next(next_id),
+                       "content": f"!blockword remove {BLOCKED_WORD}", "spam": False, "command": True})
+        # and sets up a few channels at once, as do the owner and the admin,
+        # which is not a raid as they are trusted
+        for actor in TRUSTED_ACTORS:
+            start = rng.uniform(0, duration - 5)
+            for i in range(6):
+                events.append({"t": start + 3.0 * i / 6, "type": "channel_create", "guild": guild, "actor": actor,
+                               "target": next(next_id)})
+
+    for g in rng.sample(range(guilds), raid_guilds):
+        guild = GUILD_BASE + g
+        nuker = NUKER_BASE + g
+        spammer = SPAMMER_BASE + g
+        start = rng.uniform(10, duration - 15)
+        for i in range(nuke_actions):
+            t = start + 5.0 * i / nuke_actions
+            events.append({"t": t, "type": rng.choice(("channel_create", "role_create", "role_delete", "ban")),
+                           "guild": guild, "actor": nuker, "target": next(next_id)})
+        # Each raid posts its own invite: one shared across guilds would trend
+        # in the correlator and lower every guild's detection thresholds,
+        # which CrackerHarness.score does not model
+        for i in range(20):
+            spam = i % 3 == 0
+            content = f"join discord . gg / freestuff{g}" if spam else "FREE NITRO CLICK HERE"
+            events.append({"t": start + 3.0 * i / 20, "type": "message", "guild": guild, "actor": spammer,
+                           "target": next(next_id), "content": content, "spam": spam})
+        # Fresh accounts each post an altered copy of one message. The server
+        # named differs by its letters, as digits are dropped when messages
+        # are correlated across guilds.
+        name = "".join("abcdefghij"[int(digit)] for digit in str(g))
+        for i in range(spam_wave):
+            words = f"hey everyone join {name} for free nitro giveaways and daily events".split()
+            words.insert(rng.randrange(len(words) + 1), rng.choice(("now", "pls", "fast", "guys")))
+            events.append({"t": start + 8.0 * i / spam_wave, "type": "message", "guild": guild,
+                           "actor": WAVE_BASE + g * 1000 + i, "target": next(next_id), "content": " ".join(words),
+                           "spam": False, "wave": True})
+        for i in range(nuke_actions // 2):
+            events.append({"t": start + 4.0 * i / nuke_actions, "type": "message_delete", "guild": guild,
+                           "actor": nuker, "target": next(next_id), "channel": guild + 1 + i % 4})
+
+    events.sort(key=lambda event: event["t"])
+    return events
+
+
+def load_stream(path):
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def save_stream(path, events):
+    with open(path, "w") as file:
+        for event in events:
+            file.write(json.dumps(event) + "\n")
+
+
+def snowflakes():
+    """Increasing ids stamped with the current time, like the audit-log entries Discord creates."""
+    last = 0
+    while True:
+        last = max(last + 1, int(time.time() * 1000 - DISCORD_EPOCH) << 22)
+        yield last
+
+
+# Fake REST surface shared by both bots
+
+class FakeRest:
+    """Counts REST calls by route and optionally simulates their latency."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.log = []
+
+    async def call(self, route, *details):
+        self.calls[route] += 1
+        self.log.append((route,) + details)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class _Avatar:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+
+class FakeUser:
+    def __init__(self, rest, user_id, bot=False):
+        self._rest = rest
+        self.id = user_id
+        self.bot = bot
+        self.username = f"user{user_id % 10000}"
+        self.mention = f"<@{user_id}>"
+        self.avatar = _Avatar()
+
+    async def timeout_for(self, duration, reason=None):
+        await self._rest.call("timeout", self.guild_id, self.id)
+
+
+class FakeTextChannel:
+    def __init__(self, rest, channel_id, guild):
+        self._rest = rest
+        self.id = channel_id
+        self.guild = guild
+
+    async def send(self, *args, **kwargs):
+        await self._rest.call("create_message", self.guild.id if self.guild else None)
+        return FakeMessage(self._rest, self)
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self._rest, self, message_id)
+
+    async def delete(self, *args, **kwargs):
+        await self._rest.call("channel_delete", self.guild.id, self.id)
+
+
+class FakeMessage:
+    _ids = iter(range(8 * 10**17, 9 * 10**17))
+
+    def __init__(self, rest, channel, message_id=None):
+        self._rest = rest
+        self.channel = channel
+        self.id = next(self._ids) if message_id is None else message_id
+
+    async def edit(self, *args, **kwargs):
+        await self._rest.call("edit_message", self.channel.id)
+
+    async def delete(self, *args, **kwargs):
+        await self._rest.call("message_delete", self.channel.id, self.id)
+
+
+class FakeRole:
+    def __init__(self, rest, role_id, guild):
+        self._rest = rest
+        self.id = role_id
+        self.guild = guild
+
+    async def delete(self, *args, **kwargs):
+        await self._rest.call("role_delete", self.guild.id, self.id)
+
+
+class FakeGuildAPI:
+    """The lockdown cache reads and REST calls (lockdown.py) for either bot."""
+
+    def __init__(self, rest):
+        self._rest = rest
+        self._ids = iter(range(5 * 10**17, 6 * 10**17))
+
+    @staticmethod
+    def channel_spec(channel):
+        return {"id": channel.id, "type": 0, "name": f"channel-{channel.id % 10000}", "position": 0,
+                "parent_id": None, "permission_overwrites": []}
+
+    @staticmethod
+    def role_spec(role):
+        return {"id": role.id, "name": f"role-{role.id % 10000}", "permissions": 0, "color": 0, "hoist": False,
+                "mentionable": False, "position": 1}
+
+    def snapshot(self, guild_id):
+        # Only @everyone, with Discord's default permissions
+        return {}, {guild_id: {"id": guild_id, "name": "@everyone", "permissions": 1071698660929, "color": 0,
+                               "hoist": False, "mentionable": False, "position": 0}}
+
+    async def create_channel(self, guild_id, spec):
+        await self._rest.call("channel_create", guild_id, spec["id"])
+        return next(self._ids)
+
+    async def delete_channel(self, guild_id, channel_id):
+        await self._rest.call("channel_delete", guild_id, channel_id)
+
+    async def edit_channel(self, guild_id, channel_id, fields):
+        await self._rest.call("channel_edit", guild_id, channel_id)
+
+    async def create_role(self, guild_id, spec):
+        await self._rest.call("role_create", guild_id, spec["id"])
+        return next(self._ids)
+
+    async def delete_role(self, guild_id, role_id):
+        await self._rest.call("role_delete", guild_id, role_id)
+
+    async def edit_role(self, guild_id, role_id, fields):
+        await self._rest.call("role_edit", guild_id, role_id)
+
+    async def move_roles(self, guild_id, positions):
+        await self._rest.call("role_positions", guild_id)
+
+
+class FakeGuild:
+    """The parts of discord.Guild the antieverything listeners touch."""
+
+    def __init__(self, rest, guild_id):
+        self._rest = rest
+        self.id = guild_id
+        self.owner_id = OWNER_ID
+        self.audit_entries = []
+        self.members = {}
+
+    def member(self, user_id):
+        member = self.members.get(user_id)
+        if member is None:
+            member = self.members[user_id] = FakeUser(self._rest, user_id)
+            member.guild_id = self.id
+        return member
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    async def fetch_member(self, user_id):
+        await self._rest.call("fetch_member", self.id, user_id)
+        return self.member(user_id)
+
+    async def kick(self, member, reason=None):
+        await self._rest.call("kick", self.id, member.id)
+
+    async def unban(self, user, reason=None):
+        await self._rest.call("unban", self.id, user.id)
+
+    async def audit_logs(self, limit=100, after=None, action=None, **kwargs):
+        await self._rest.call("audit_logs", self.id)
+        entries = [entry for entry in self.audit_entries
+                   if (after is None or entry.id > after.id) and (action is None or entry.action == action)]
+        # Newest first, unless paging forward with ``after``
+        entries = entries[:limit] if after is not None else entries[::-1][:limit]
+        for entry in entries:
+            yield entry
+
+
+# Bot adapters
+
+def flagged_waves(events, duplicates):
+    # Guilds where the coordinated spam reached NearDuplicateDetector's number
+    # of authors within its window; each account in a wave posts once
+    times = defaultdict(list)
+    for event in events:
+        if event.get("wave"):
+            times[event["guild"]].append(event["t"])
+    count = duplicates.authors
+    return {guild_id for guild_id, ts in times.items()
+            if any(b - a < duplicates.window for a, b in zip(ts, ts[count - 1:]))}
+
+
+def _percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class BotHarness:
+    name = None
+    handlers = {}
+
+    def __init__(self, module, rest):
+        self.module = module
+        self.rest = rest
+        self.now = 0.0
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.expected = Counter()
+        self.observed = Counter()
+        self.handler_name = None
+        self.submitted = 0
+        # The listeners only queue their events, so handlers are timed where the dispatcher runs them
+        dispatcher = getattr(module, "dispatcher", None)
+        if dispatcher is not None:
+            dispatcher.submit = self.timed_submit(dispatcher.submit)
+
+    def clock(self):
+        return self.now
+
+    def timed_submit(self, submit):
+        def wrapper(guild_id, priority, handler, *args):
+            # Run later, under the clock of the event that queued it
+            now, handler_name = self.now, self.handler_name
+            self.submitted += 1
+
+            async def run(*args):
+                self.now = now
+                await self.timed(handler_name, handler, args)
+
+            run.__name__ = handler.__name__
+            return submit(guild_id, priority, run, *args)
+
+        return wrapper
+
+    async def timed(self, handler_name, handler, args):
+        started = time.perf_counter()
+        try:
+            await handler(*args)
+        except Exception as e:
+            self.errors[handler_name] += 1
+            logging.debug(f"{handler_name} raised {e!r}")
+        self.latencies[handler_name].append(time.perf_counter() - started)
+
+    async def dispatch(self, event):
+        handler_name = self.handlers.get(event["type"])
+        if handler_name is None:
+            return
+        args = self.build(event)
+        handler = getattr(self.module, handler_name)
+        self.now = event["t"]
+        self.handler_name = handler_name
+        submitted = self.submitted
+        await self.timed(handler_name, handler, args)
+        if self.submitted != submitted:
+            # Only queued the event; timed when it runs
+            self.latencies[handler_name].pop()
+
+    def build(self, event):
+        raise NotImplementedError
+
+    async def settle(self):
+        pass
+
+    def score(self, events):
+        raise NotImplementedError
+
+
+class CrackerHarness(BotHarness):
+    name = "cracker"
+    handlers = {
+        "message": "on_message_create",
+        "message_delete": "on_message_delete",
+        "message_bulk_delete": "on_bulk_message_delete",
+        "channel_create": "on_channel_create",
+        "channel_delete": "on_channel_delete",
+        "role_create": "on_role_create",
+        "role_delete": "on_role_delete",
+        "ban": "on_member_delete",
+        "kick": "on_member_delete",
+    }
+    # Detector action name for each stream type
+    kinds = {"channel_create": "channel_creates", "channel_delete": "channel_deletes", "role_create": "role_creates", "role_delete": "role_deletes",
+             "ban": "member_bans", "kick": "member_bans"}
+    # Detections that lock the guild down
+    structural = ("channel_creates", "channel_deletes", "role_creates", "role_deletes")
+
+    def __init__(self, module, rest):
+        super().__init__(module, rest)
+        module.detector.clock = self.clock
+        module.delete_tracker.clock = self.clock
+        module.correlator.clock = self.clock
+        module.duplicates.clock = self.clock
+        module.lockdowns.api = FakeGuildAPI(rest)
+        module.lockdowns.clock = self.clock
+        harness = self
+
+        class Rest:
+            async def create_message(self, channel, *args, **kwargs):
+                await harness.rest.call("create_message", channel)
+                return FakeMessage(harness.rest, types.SimpleNamespace(id=channel))
+
+            async def edit_message(self, channel, message, *args, **kwargs):
+                await harness.rest.call("edit_message", channel)
+
+            async def delete_messages(self, channel, messages, *args, **kwargs):
+                await harness.rest.call("delete_messages", channel, len(messages))
+
+            async def fetch_member(self, guild, user, *args, **kwargs):
+                await harness.rest.call("fetch_member", guild, user)
+                return types.SimpleNamespace(id=user, role_ids=[ADMIN_ROLE_ID] if user == ADMIN_ID else [])
+
+        class Cache:
+            def get_guild(self, guild_id):
+                return types.SimpleNamespace(id=guild_id, system_channel_id=guild_id + 1, owner_id=OWNER_ID)
+
+        # hikari.GatewayBot exposes these through the rest and cache properties
+        module.bot._rest = Rest()
+        module.bot._cache = Cache()
+        self.trusted = set()
+        self._entry_ids = snowflakes()
+        import hikari
+        self.actions = {
+            "channel_create": hikari.AuditLogEventType.CHANNEL_CREATE,
+            "channel_delete": hikari.AuditLogEventType.CHANNEL_DELETE,
+            "role_create": hikari.AuditLogEventType.ROLE_CREATE,
+            "role_delete": hikari.AuditLogEventType.ROLE_DELETE,
+        }
+
+    def build(self, event):
+        rest = self.rest
+        guild_id = event["guild"]
+        channel = FakeTextChannel(rest, guild_id + 1, types.SimpleNamespace(id=guild_id))
+        kind = event["type"]
+        if guild_id not in self.trusted:
+            self.trusted.add(guild_id)
+            self.module.trust.add(guild_id, "user", MODERATOR_ID)
+            self.module.trust.add(guild_id, "role", ADMIN_ROLE_ID)
+        action = self.actions.get(kind)
+        if action is not None:
+            # What on_audit_log_entry_create does when the gateway delivers the entry
+            entry = types.SimpleNamespace(id=next(self._entry_ids), action_type=action, target_id=event["target"],
+                                          user_id=event["actor"])
+            self.module.audit_logs.add(guild_id, action, event["target"], entry)
+        if kind == "message":
+            message_id = event["target"]
+
+            async def delete():
+                await rest.call("message_delete", guild_id, message_id)
+
+            return (types.SimpleNamespace(
+                is_bot=False, guild_id=guild_id, author_id=event["actor"], channel_id=channel.id, member=None,
+                author=FakeUser(rest, event["actor"]), content=event["content"], message_id=message_id,
+                message=types.SimpleNamespace(id=message_id, delete=delete), get_channel=lambda: channel,
+            ),)
+        if kind == "message_delete":
+            return (types.SimpleNamespace(guild_id=guild_id, channel_id=event.get("channel", channel.id),
+                                          message_id=event["target"], get_channel=lambda: channel),)
+        if kind == "message_bulk_delete":
+            return (types.SimpleNamespace(guild_id=guild_id, channel_id=event.get("channel", channel.id),
+                                          message_ids=set(range(event["count"]))),)
+        if kind in ("channel_create", "channel_delete"):
+            return (types.SimpleNamespace(guild_id=guild_id, channel_id=event["target"],
+                                          channel=FakeTextChannel(rest, event["target"], channel.guild)),)
+        if kind in ("role_create", "role_delete"):
+            role = FakeRole(rest, event["target"], channel.guild)
+            return (types.SimpleNamespace(guild_id=guild_id, role_id=event["target"], role=role, old_role=role),)
+        return (types.SimpleNamespace(guild_id=guild_id, user_id=event["target"],
+                                      user=FakeUser(rest, event["target"])),)
+
+    async def settle(self):
+        # Handle the queued events, lift the lockdowns, which reports them, and let the alerts go out
+        await self.module.dispatcher.drain()
+        self.module.dispatcher.close()
+        await self.module.lockdowns.close()
+        await self.module.alerts.drain()
+        self.module.alerts.close()
+
+    def score(self, events):
+        # A detection is expected for every event that brings its (guild, kind)
+        # to 5 or more within the last 10 seconds, as RateDetector defaults, and
+        # one lockdown for each guild with a structural detection. Channel and
+        # role changes by trusted actors do not count.
+        history = defaultdict(list)
+        locked = set()
+        for event in events:
+            kind = self.kinds.get(event["type"])
+            if kind is None:
+                if event["type"] == "message" and event.get("spam"):
+                    self.expected["invite_deleted"] += 1
+                continue
+            if kind in self.structural and event["actor"] in TRUSTED_ACTORS:
+                continue
+            times = history[(event["guild"], kind)]
+            times.append(event["t"])
+            if len(times) >= 5 and event["t"] - times[-5] < 10:
+                self.expected[kind] += 1
+                if kind in self.structural:
+                    locked.add(event["guild"])
+        self.expected["lockdown"] = len(locked)
+        self.expected["message_deletes"] = self.delete_bursts(events)
+        self.expected["duplicate_messages"] = len(flagged_waves(events, self.module.duplicates))
+        modlog = self.module.modlog
+        modlog.flush()
+        conn = sqlite3.connect(modlog.path)
+        try:
+            for action, count in conn.execute("SELECT action, count(*) FROM mod_logs GROUP BY action"):
+                self.observed[action] += count
+        finally:
+            conn.close()
+
+
+    @staticmethod
+    def delete_bursts(events, count=5, window=10.0, cap=3):
+        # One burst per incident where a guild's deletions in the last 10
+        # seconds reach 5, counting at most 3 per channel, as DeleteTracker
+        # defaults. An incident ends once that has not held for 10 seconds.
+        deletions = defaultdict(list)
+        last_over = {}
+        bursts = 0
+        for event in events:
+            if event["type"] not in ("message_delete", "message_bulk_delete"):
+                continue
+            guild_id, now = event["guild"], event["t"]
+            recent = deletions[guild_id] = [d for d in deletions[guild_id] if d[0] >= now - window]
+            recent.append((now, event.get("channel", guild_id + 1), event.get("count", 1)))
+            per_channel = Counter()
+            for _, channel_id, deleted in recent:
+                per_channel[channel_id] += deleted
+            over = sum(min(total, cap) for total in per_channel.values()) >= count
+            if guild_id in last_over and (over or now - last_over[guild_id] < window):
+                if over:
+                    last_over[guild_id] = now
+                continue
+            last_over.pop(guild_id, None)
+            if over:
+                last_over[guild_id] = now
+                bursts += 1
+        return bursts
+
+
+class AntiEverythingHarness(BotHarness):
+    name = "antieverything"
+    handlers = {
+        "message": "on_message",
+        "channel_create": "on_guild_channel_create",
+        "channel_delete": "on_guild_channel_delete",
+        "role_create": "on_guild_role_create",
+        "role_delete": "on_guild_role_delete",
+        "ban": "on_member_ban",
+        "kick": "on_member_remove",
+    }
+
+    def __init__(self, module, rest, feed_audit_log=True):
+        super().__init__(module, rest)
+        self.feed_audit_log = feed_audit_log
+        self.guilds = {}
+        self._entry_ids = snowflakes()
+        module.recent_messages.clock = self.clock
+        module.detector.clock = self.clock
+        module.correlator.clock = self.clock
+        module.duplicates.clock = self.clock
+        module.lockdowns.api = FakeGuildAPI(rest)
+        module.lockdowns.clock = self.clock
+        module.bot._connection.user = FakeUser(rest, 1, bot=True)
+
+        async def process_commands(message):
+            # Counted rather than run: the fake messages could not carry a command context
+            if message.content.startswith(module.bot.command_prefix):
+                self.observed["command"] += 1
+
+        module.bot.process_commands = process_commands
+        module.bot.get_partial_messageable = lambda channel_id: FakeTextChannel(rest, channel_id, None)
+        import discord
+        self.actions = {
+            "channel_create": discord.AuditLogAction.channel_create,
+            "channel_delete": discord.AuditLogAction.channel_delete,
+            "role_create": discord.AuditLogAction.role_create,
+            "role_delete": discord.AuditLogAction.role_delete,
+            "ban": discord.AuditLogAction.ban,
+            "kick": discord.AuditLogAction.kick,
+        }
+
+    def guild(self, guild_id):
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            guild = self.guilds[guild_id] = FakeGuild(self.rest, guild_id)
+            self.module.trust.add(guild_id, "user", MODERATOR_ID)
+            self.module.trust.add(guild_id, "role", ADMIN_ROLE_ID)
+            # What the member cache reports
+            self.module.trust.observe_member(guild_id, ADMIN_ID, [ADMIN_ROLE_ID])
+            # What !blockword add does
+            self.module.config.set_blocklist(guild_id, {BLOCKED_WORD})
+            self.module.content_filter.set_guild_words(guild_id, {BLOCKED_WORD})
+        return guild
+
+    def build(self, event):
+        guild = self.guild(event["guild"])
+        actor = guild.member(event["actor"])
+        kind = event["type"]
+        if kind == "message":
+            channel = FakeTextChannel(self.rest, guild.id + 1, guild)
+            message_id = event["target"]
+            rest = self.rest
+
+            async def delete():
+                await rest.call("message_delete", guild.id, message_id)
+
+            return (types.SimpleNamespace(id=message_id, author=actor, guild=guild, channel=channel,
+                                          content=event["content"], delete=delete),)
+
+        # The gateway event for the action, and the audit-log entry behind it
+        if kind in ("channel_create", "channel_delete"):
+            target = FakeTextChannel(self.rest, event["target"], guild)
+        elif kind in ("role_create", "role_delete"):
+            target = FakeRole(self.rest, event["target"], guild)
+        else:
+            target = guild.member(event["target"])
+        entry = types.SimpleNamespace(id=next(self._entry_ids), action=self.actions[kind], target=target, user=actor,
+                                      guild=guild)
+        guild.audit_entries.append(entry)
+        if self.feed_audit_log:
+            # What on_audit_log_entry_create does when the gateway delivers the entry
+            self.module.audit_logs.feed(entry)
+        if kind == "ban":
+            return guild, target
+        return (target,)
+
+    async def settle(self):
+        # Handle the queued events, finish and lift the lockdowns, then let queued punishments,
+        # cleanup and alerts finish
+        await self.module.dispatcher.drain()
+        self.module.dispatcher.close()
+        await self.module.lockdowns.close()
+        remediation = self.module.remediation
+        while True:
+            queues = [queue for queue in remediation._queues.values() if queue._unfinished_tasks]
+            if not queues:
+                break
+            await asyncio.gather(*(queue.join() for queue in queues))
+        await self.module.alerts.drain()
+        self.module.alerts.close()
+
+    def score(self, events):
+        spam_counts = defaultdict(list)
+        waves = flagged_waves(events, self.module.duplicates)
+        for event in events:
+            kind = event["type"]
+            if event.get("command"):
+                self.expected["command"] += 1
+            if event["actor"] in TRUSTED_ACTORS:
+                continue
+            if kind == "message":
+                if event.get("spam") or event.get("blocked"):
+                    # Deleted before it counts towards the message rate
+                    self.expected["message_deleted"] += 1
+                elif event.get("wave"):
+                    if event["guild"] in waves:
+                        self.expected["message_deleted"] += 1
+                        self.expected[f"punished:{event['guild']}:{event['actor']}"] = 1
+                else:
+                    spam_counts[(event["guild"], event["actor"])].append(event["t"])
+                continue
+            self.expected[f"punished:{event['guild']}:{event['actor']}"] = 1
+            if kind in ("channel_create", "role_create"):
+                self.expected[kind.replace("create", "reverted")] += 1
+            elif kind == "ban":
+                self.expected["ban_reverted"] += 1
+        for (guild_id, actor), times in spam_counts.items():
+            if any(b - a < 10 for a, b in zip(times, times[4:])):
+                self.expected[f"punished:{guild_id}:{actor}"] = 1
+        # The blocked word is used in every guild, but is no sign of a raid
+        self.expected["blocked_word_trends"] = 0
+        self.observed["blocked_word_trends"] = sum(1 for _, key in self.module.correlator.trending
+                                                   if BLOCKED_WORD in str(key))
+
+        routes = {"channel_delete": "channel_reverted", "role_delete": "role_reverted", "unban": "ban_reverted",
+                  "message_delete": "message_deleted"}
+        for route, *details in self.rest.log:
+            if route in ("timeout", "kick"):
+                self.observed[f"punished:{details[0]}:{details[1]}"] = 1
+            elif route in routes:
+                self.observed[routes[route]] += 1
+
+
+def import_bot(name):
+    """Import a bot module without connecting; bot.run() is behind a __main__ guard."""
+    os.environ.setdefault("BOT_TOKEN", "offline-harness")
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    return importlib.import_module(name)
+
+
+async def run(events, bots, rest_latency=0.0, rate=None, feed_audit_log=True):
+    results = []
+    for name in bots:
+        rest = FakeRest(rest_latency)
+        module = import_bot(name)
+        if name == "cracker":
+            harness = CrackerHarness(module, rest)
+        else:
+            harness = AntiEverythingHarness(module, rest, feed_audit_log)
+        if hasattr(module, "load_state"):
+            # Normally started by the bot's StartingEvent listener
+            await module.load_state()
+
+        # Like the gateway, every event is dispatched as its own task
+        tasks = []
+        started = time.perf_counter()
+        for i, event in enumerate(events):
+            tasks.append(asyncio.create_task(harness.dispatch(event)))
+            if rate:
+                await asyncio.sleep(max(0.0, started + (i + 1) / rate - time.perf_counter()))
+            elif i % 256 == 0:
+                await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        await harness.settle()
+        elapsed = time.perf_counter() - started
+
+        harness.score(events)
+        results.append((harness, elapsed))
+    return results
+
+
+def report(events, results):
+    failed = False
+    summary = {}
+    for harness, elapsed in results:
+        handled = sum(len(samples) for samples in harness.latencies.values())
+        print(f"\n== {harness.name}: {handled:,} events in {elapsed:.2f}s ({handled / elapsed:,.0f} events/sec)")
+        print(f"{'handler':28} {'count':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+        handlers = {}
+        for handler_name, samples in sorted(harness.latencies.items()):
+            row = {q: _percentile(samples, f) * 1000 for q, f in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))}
+            row.update(count=len(samples), max=max(samples) * 1000, errors=harness.errors[handler_name])
+            handlers[handler_name] = row
+            print(f"{handler_name:28} {row['count']:>8,} {row['p50']:>8.3f} {row['p95']:>8.3f} {row['p99']:>8.3f} "
+                  f"{row['max']:>8.3f} {row['errors']:>7}")
+        print("REST calls: " + (", ".join(f"{route}={count}" for route, count in sorted(harness.rest.calls.items()))
+                                or "none"))
+        queues = harness.module.dispatcher.stats()
+        print("Event queues: " + ", ".join(
+            f"{priority} waited p50 {stats['p50'] * 1000:.1f} ms, p99 {stats['p99'] * 1000:.1f} ms, shed {stats['shed']}"
+            for priority, stats in queues.items()))
+
+        keys = sorted(set(harness.expected) | set(harness.observed))
+        punished_expected = sum(1 for key in harness.expected if key.startswith("punished:"))
+        punished_observed = sum(1 for key in harness.observed if key.startswith("punished:"))
+        missed = sum(1 for key in keys if key.startswith("punished:") and key not in harness.observed)
+        spurious = sum(1 for key in keys if key.startswith("punished:") and key not in harness.expected)
+        detections = {}
+        for key in keys:
+            if key.startswith("punished:"):
+                continue
+            detections[key] = {"expected": harness.expected[key], "observed": harness.observed[key]}
+            marker = "" if harness.expected[key] == harness.observed[key] else "  <-- mismatch"
+            failed |= bool(marker)
+            print(f"  {key:24} expected {harness.expected[key]:>6} observed {harness.observed[key]:>6}{marker}")
+        if punished_expected or punished_observed:
+            detections["punished"] = {"expected": punished_expected, "observed": punished_observed,
+                                      "missed": missed, "spurious": spurious}
+            failed |= bool(missed or spurious)
+            print(f"  {'punished actors':24} expected {punished_expected:>6} observed {punished_observed:>6}"
+                  f"  missed {missed} spurious {spurious}")
+        summary[harness.name] = {"events": handled, "seconds": elapsed, "handlers": handlers,
+                                 "rest_calls": dict(harness.rest.calls), "event_queues": queues,
+                                 "detections": detections}
+    return failed, summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bot", choices=("cracker", "antieverything", "both"), default="both")
+    parser.add_argument("--replay", help="replay a recorded JSONL event stream instead of generating one")
+    parser.add_argument("--record", help="write the generated stream to this JSONL file")
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--raid-guilds", type=int, default=5)
+    parser.add_argument("--nuke-actions", type=int, default=40)
+    parser.add_argument("--users", type=int, default=50, help="chatting users per guild")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate", type=float, help="pace dispatch at this many events/sec (default: flat out)")
+    parser.add_argument("--rest-latency-ms", type=float, default=0.0)
+    parser.add_argument("--poll-audit-log", action="store_true",
+                        help="do not feed audit-log entries from the gateway; make the bot poll for them")
+    parser.add_argument("--json", help="write the report as JSON to this file")
+    parser.add_argument("--check", action="store_true", help="exit non-zero on any detection mismatch")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.replay:
+        events = load_stream(args.replay)
+    else:
+        events = generate(args.guilds, args.raid_guilds, args.nuke_actions, args.users, seed=args.seed)
+        if args.record:
+            save_stream(args.record, events)
+    bots = ("cracker", "antieverything") if args.bot == "both" else (args.bot,)
+
+    # The bots keep their state under ./data, so run them somewhere disposable
+    with tempfile.TemporaryDirectory(prefix="harness-") as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            results = asyncio.run(run(events, bots, args.rest_latency_ms / 1000, args.rate,
+                                      feed_audit_log=not args.poll_audit_log))
+            # Let the bots' background writers finish before the directory goes away
+            for harness, _ in results:
+                for store_name in ("modlog", "recent_actions_store", "trust",
+                                   "thresholds_store", "log_channels_store"):
+                    store = getattr(harness.module, store_name, None)
+                    if store is not None:
+                        store.close()
+                config = getattr(harness.module, "config", None)
+                if hasattr(config, "close"):
+                    config.close()
+        finally:
+            os.chdir(cwd)
+
+    failed, summary = report(events, results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(summary, file, indent=2)
+    if args.check and failed:
+        print("\ndetection mismatch", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,242 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# Largest decoded image accepted, in pixels (about 32 MB as RGBA)
+MAX_PIXELS = 8_000_000
+# Largest upload accepted before it is even downloaded
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+# Largest GIF we try to produce, kept under Discord's default upload limit
+GIF_BUDGET_BYTES = 8 * 1024 * 1024
+GIF_EFFECTS = ("none", "spin", "pulse", "fade")
+
+
+class ImageJobRejected(Exception):
+    """Raised when an image job is refused; the message is safe to show the user."""
+
+
+def _init_worker(max_pixels):
+    from PIL import Image
+    # Pillow refuses to decode anything over twice this, and warns above it
+    Image.MAX_IMAGE_PIXELS = max_pixels
+
+
+def _open_checked(data, max_pixels):
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    # Only the header has been read at this point, so a decompression bomb is
+    # rejected before any pixels are decoded.
+    if img.width * img.height > max_pixels:
+        raise ImageJobRejected(f"Images larger than {max_pixels:,} pixels are not supported.")
+    return img
+
+
+def render_text(text, bg_color, text_color):
+    from PIL import Image, ImageDraw, ImageFont
+    img = Image.new('RGB', (400, 200), color=bg_color)
+    d = ImageDraw.Draw(img)
+    font = ImageFont.load_default()
+    d.text((10, 10), text, font=font, fill=text_color)
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _effect_frames(base, effect, steps=8):
+    """Expand the uploaded images into animation frames for ``effect``."""
+    from PIL import Image
+    if effect == "spin":
+        return [img.rotate(-360 * i / steps, resample=Image.BICUBIC) for img in base for i in range(steps)]
+    if effect == "pulse":
+        frames = []
+        for img in base:
+            for i in range(steps):
+                # Shrink to 80% and back over one cycle
+                scale = 1 - 0.2 * (1 - abs(1 - 2 * i / steps))
+                size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+                frame = Image.new("RGB", img.size)
+                frame.paste(img.resize(size, Image.LANCZOS), ((img.width - size[0]) // 2, (img.height - size[1]) // 2))
+                frames.append(frame)
+        return frames
+    if effect == "fade":
+        # Crossfade through every image and back to the first (or to black)
+        targets = base[1:] + base[:1] if len(base) > 1 else [Image.new("RGB", base[0].size)]
+        return [Image.blend(img, target, i / steps) for img, target in zip(base, targets) for i in range(steps)]
+    return list(base)
+
+
+def build_gif(images, effect="none", max_dimension=320, frame_ms=100, max_bytes=GIF_BUDGET_BYTES,
+              max_pixels=MAX_PIXELS):
+    """Build an animated GIF from uploaded images and return ``(data, metrics)``.
+
+    Frames are downsized to ``max_dimension``, quantized once to a palette
+    shared by the whole animation, and identical consecutive frames are
+    merged. Pillow then stores each frame as the region that differs from the
+    previous one. If the result is over ``max_bytes`` the animation is
+    rebuilt at a smaller size.
+    """
+    from PIL import Image
+    metrics = {}
+    started = time.perf_counter()
+    decoded = [_open_checked(data, max_pixels).convert("RGB") for data in images]
+    metrics["decode_ms"] = (time.perf_counter() - started) * 1000
+
+    dimension = max_dimension
+    for attempt in range(1, 5):
+        started = time.perf_counter()
+        base = []
+        for img in decoded:
+            img = img.copy()
+            img.thumbnail((dimension, dimension), Image.LANCZOS)
+            base.append(img)
+        # All frames share one canvas so differently sized uploads line up
+        canvas = (max(img.width for img in base), max(img.height for img in base))
+        for i, img in enumerate(base):
+            if img.size != canvas:
+                frame = Image.new("RGB", canvas)
+                frame.paste(img, ((canvas[0] - img.width) // 2, (canvas[1] - img.height) // 2))
+                base[i] = frame
+        frames = _effect_frames(base, effect)
+
+        # One palette for the whole animation, taken from a strip of every frame
+        sample_width = max(1, canvas[0] // 4)
+        sample_height = max(1, canvas[1] // 4)
+        strip = Image.new("RGB", (sample_width * len(frames), sample_height))
+        for i, frame in enumerate(frames):
+            strip.paste(frame.resize((sample_width, sample_height)), (i * sample_width, 0))
+        palette = strip.quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+        quantized = [frame.quantize(palette=palette, dither=Image.Dither.NONE) for frame in frames]
+
+        # Merge runs of identical frames into one longer frame
+        output, durations = [], []
+        for frame in quantized:
+            if output and frame.tobytes() == output[-1].tobytes():
+                durations[-1] += frame_ms
+            else:
+                output.append(frame)
+                durations.append(frame_ms)
+        metrics["quantize_ms"] = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        buffer = io.BytesIO()
+        output[0].save(buffer, format="GIF", save_all=True, append_images=output[1:], loop=0,
+                       duration=durations, optimize=True, disposal=1)
+        data = buffer.getvalue()
+        metrics["encode_ms"] = (time.perf_counter() - started) * 1000
+        metrics.update(frames=len(output), width=canvas[0], height=canvas[1], bytes=len(data), attempts=attempt)
+        if len(data) <= max_bytes:
+            return data, metrics
+        dimension = int(dimension * 0.75)
+    raise ImageJobRejected("The GIF would be too large to upload, try fewer images or a smaller size.")
+
+
+class RenderCache:
+    """LRU of encoded images, bounded by total size in bytes."""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        data = self._entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class ImageWorkerPool:
+    """Runs Pillow jobs in worker processes so decoding never blocks the gateway.
+
+    Jobs are capped overall (``max_pending``) and per user (``per_user``) and
+    refused with ``ImageJobRejected`` once a cap is reached. A job that runs
+    past ``timeout`` is abandoned and the pool is replaced so the stuck
+    process does not keep holding a worker slot.
+    """
+
+    def __init__(self, workers=2, max_pending=8, per_user=1, timeout=20.0, max_pixels=MAX_PIXELS):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.per_user = per_user
+        self.timeout = timeout
+        self.max_pixels = max_pixels
+        self._executor = None
+        self._pending = 0
+        self._per_user = Counter()
+
+    @property
+    def pending(self):
+        """Jobs queued or running."""
+        return self._pending
+
+    def _pool(self):
+        if self._executor is None:
+            # Not fork: by the first job the bot runs its writer threads, and a
+            # child forked while one of them holds a lock can deadlock. Workers
+            # are forked from a server process that has no threads and has
+            # already imported this module and Pillow; each still runs the bot
+            # script as __mp_main__, as with spawn.
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__, "PIL.Image"])
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(self.max_pixels,),
+            )
+        return self._executor
+
+    async def submit(self, user_id, fn, *args):
+        if self._pending >= self.max_pending:
+            raise ImageJobRejected("The image queue is full, please try again in a moment.")
+        if self._per_user[user_id] >= self.per_user:
+            raise ImageJobRejected("You already have an image being processed.")
+        self._pending += 1
+        self._per_user[user_id] += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await asyncio.wait_for(loop.run_in_executor(self._pool(), fn, *args), self.timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Image job {fn.__name__} timed out after {self.timeout}s")
+            self._recycle()
+            raise ImageJobRejected("Processing the image took too long.")
+        finally:
+            self._pending -= 1
+            self._per_user[user_id] -= 1
+            if not self._per_user[user_id]:
+                del self._per_user[user_id]
+
+    def _recycle(self):
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        # ProcessPoolExecutor cannot cancel a running job, so stop its processes
+        for process in list(getattr(executor, "_processes", {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
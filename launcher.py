@@ -0,0 +1,198 @@
+"""Run cracker.py as several worker processes, each owning a range of gateway shards.
+
+    python launcher.py --workers 4             # shard count recommended by Discord
+    python launcher.py --workers 4 --shards 16
+
+Recent actions and thresholds are split per shard under data/shards/<id>/,
+so each worker only loads and writes its own guilds. Mod logs and the
+bypass list are SQLite databases in WAL mode, which all workers share.
+
+A worker that crashes, or exits through the restart command, is started
+again on its own; the other workers keep their gateway sessions. Send SIGHUP
+for a rolling restart of every worker, SIGINT or SIGTERM to stop them all.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from cluster import RESTART_EXIT_CODE, shard_ranges
+from dotenv import load_dotenv
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_FOLDER = "data"
+CLUSTER_FILE = os.path.join(DATA_FOLDER, "cluster.json")
+
+# Seconds between starting workers, so their shards do not all identify at once
+START_DELAY = 5.0
+# A worker that stays up this long has its crash backoff reset
+HEALTHY_AFTER = 300.0
+MAX_BACKOFF = 60.0
+# How long workers get to close their shards and flush state before being killed
+STOP_TIMEOUT = 30.0
+
+
+async def recommended_shard_count(token):
+    import hikari
+    rest = hikari.RESTApp()
+    await rest.start()
+    try:
+        async with rest.acquire(token, hikari.TokenType.BOT) as client:
+            return (await client.fetch_gateway_bot_info()).shard_count
+    finally:
+        await rest.close()
+
+
+def pin_shard_count(shard_count):
+    """Keep the shard count stable, since guild state is stored per shard."""
+    layout = {}
+    if os.path.exists(CLUSTER_FILE):
+        with open(CLUSTER_FILE, "r") as file:
+            layout = json.load(file)
+    pinned = layout.get("shard_count")
+    if pinned is None:
+        if shard_count is None:
+            return None
+        with open(CLUSTER_FILE, "w") as file:
+            json.dump({"shard_count": shard_count}, file)
+        return shard_count
+    if shard_count is not None and shard_count != pinned:
+        raise SystemExit(
+            f"Guild state in {DATA_FOLDER}/shards is split for {pinned} shards, not {shard_count}. "
+            f"Run with --shards {pinned}, or move the guild data to the new layout first."
+        )
+    return pinned
+
+
+class Worker:
+    def __init__(self, index, shard_ids, shard_count, env):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.env = env
+        self.process = None
+        self.started = 0.0
+        self.backoff = 1.0
+        self.stopping = False
+
+    def start(self):
+        env = dict(self.env)
+        env["WORKER_ID"] = str(self.index)
+        env["SHARD_IDS"] = ",".join(map(str, self.shard_ids))
+        env["SHARD_COUNT"] = str(self.shard_count)
+        # One metrics port per worker, counting up from the configured one
+        metrics_port = int(env.get("METRICS_PORT", "9100"))
+        if metrics_port:
+            env["METRICS_PORT"] = str(metrics_port + self.index)
+        self.process = subprocess.Popen([sys.executable, os.path.join(HERE, "cracker.py")], env=env)
+        self.started = time.monotonic()
+        logging.info(f"Worker {self.index} (pid {self.process.pid}) started for shards "
+                     f"{self.shard_ids[0]}-{self.shard_ids[-1]} of {self.shard_count}")
+
+    def stop(self):
+        # SIGINT lets hikari close its shards and run the StoppedEvent handlers
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+
+
+class Launcher:
+    def __init__(self, workers, shard_count, token):
+        env = dict(os.environ, BOT_TOKEN=token)
+        self.workers = [Worker(i, shards, shard_count, env) for i, shards in enumerate(shard_ranges(shard_count, workers))]
+        self.stopping = False
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.rolling_restart()))
+        for i, worker in enumerate(self.workers):
+            if self.stopping:
+                break
+            if i:
+                await asyncio.sleep(START_DELAY)
+            worker.start()
+        await asyncio.gather(*(self.supervise(worker) for worker in self.workers))
+
+    async def supervise(self, worker):
+        while not self.stopping:
+            if worker.process is None:
+                await asyncio.sleep(0.5)
+                continue
+            process = worker.process
+            code = await asyncio.to_thread(process.wait)
+            if self.stopping:
+                break
+            if worker.stopping or worker.process is not process:
+                # Stopped by rolling_restart, which starts it again
+                await asyncio.sleep(0.5)
+                continue
+            if code == 0:
+                logging.info(f"Worker {worker.index} exited cleanly and will not be restarted")
+                return
+            if code == RESTART_EXIT_CODE:
+                logging.info(f"Worker {worker.index} asked to be restarted")
+                delay = 0.0
+            else:
+                if time.monotonic() - worker.started > HEALTHY_AFTER:
+                    worker.backoff = 1.0
+                delay = worker.backoff
+                worker.backoff = min(worker.backoff * 2, MAX_BACKOFF)
+                logging.error(f"Worker {worker.index} exited with status {code}, restarting in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            if not self.stopping:
+                worker.start()
+
+    async def rolling_restart(self):
+        for worker in self.workers:
+            if self.stopping:
+                return
+            worker.stopping = True
+            worker.stop()
+            await asyncio.to_thread(worker.process.wait)
+            worker.stopping = False
+            worker.start()
+            await asyncio.sleep(START_DELAY)
+
+    def stop(self):
+        if self.stopping:
+            return
+        logging.info("Stopping all workers...")
+        self.stopping = True
+        for worker in self.workers:
+            worker.stop()
+        asyncio.get_running_loop().call_later(STOP_TIMEOUT, self.kill)
+
+    def kill(self):
+        for worker in self.workers:
+            if worker.process is not None and worker.process.poll() is None:
+                logging.error(f"Worker {worker.index} did not stop in time, killing it")
+                worker.process.kill()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shards", type=int, help="total shard count (default: pinned, or Discord's recommendation)")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s launcher %(levelname)s %(message)s")
+    token = os.getenv("BOT_TOKEN")
+    if not token:
+        raise ValueError("No bot token provided. Set the BOT_TOKEN environment variable.")
+
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    shard_count = pin_shard_count(args.shards)
+    if shard_count is None:
+        shard_count = pin_shard_count(asyncio.run(recommended_shard_count(token)))
+    asyncio.run(Launcher(args.workers, shard_count, token).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,702 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+import time
+from collections import Counter, deque, namedtuple
+
+# Structural changes kept in the per-guild journal
+CHANNEL_CREATE = "channel_create"
+CHANNEL_DELETE = "channel_delete"
+ROLE_CREATE = "role_create"
+ROLE_DELETE = "role_delete"
+
+# Concurrent requests allowed per route while rolling back. Discord limits
+# channel deletes and edits per channel, so those fan out; creating channels
+# and anything on roles share one bucket per guild, where more requests in
+# flight would only wait in the library's queue.
+ROLLBACK_LIMITS = {
+    "channel_delete": 10,
+    "channel_edit": 5,
+    "channel_create": 2,
+    "role_delete": 2,
+    "role_create": 2,
+    "role_edit": 2,
+}
+
+# Taken from @everyone while a guild is locked down, as raw permission bits:
+# invites, kick, ban, administrator, manage channels and server, reactions,
+# sending messages, embeds, files, mentioning everyone, connecting to voice,
+# manage roles and webhooks, and creating or talking in threads.
+FREEZE_PERMISSIONS = sum(1 << bit for bit in (0, 1, 2, 3, 4, 5, 6, 11, 14, 15, 17, 20, 28, 29, 35, 36, 38))
+
+# Discord channel types the adapters can recreate
+TEXT, VOICE, CATEGORY, NEWS = 0, 2, 4, 5
+
+REASON = "Anti-nuke: lockdown rollback"
+
+IncidentReport = namedtuple(
+    "IncidentReport", "guild_id reason reverted failed skipped restored time_to_recover duration"
+)
+
+
+class Change:
+    """One channel or role created or deleted, as the gateway reported it.
+
+    ``spec`` is the object in Discord's own field names, so it can be sent
+    back to recreate it. Callers that attribute changes through the audit
+    log pass ``attributed=True`` and then call ``resolve``; rollback waits a
+    little for that before deciding whether to undo the change.
+    """
+
+    __slots__ = ("kind", "spec", "at", "revert", "pending", "scheduled")
+
+    def __init__(self, kind, spec, at, pending=None):
+        self.kind = kind
+        self.spec = spec
+        self.at = at
+        self.revert = True
+        self.pending = pending
+        self.scheduled = False
+
+    def resolve(self, revert):
+        """Decide whether a lockdown should undo this change, e.g. False for trusted actors."""
+        self.revert = revert
+        if self.pending is not None and not self.pending.done():
+            self.pending.set_result(revert)
+
+
+class Incident:
+    __slots__ = ("guild_id", "reason", "triggered", "first_change", "last_change", "snapshot", "frozen", "tasks",
+                 "roles", "channels", "creating", "restored", "reverted", "failed", "skipped", "recovered_at",
+                 "watcher", "ending", "positions")
+
+    def __init__(self, guild_id, reason, now):
+        self.guild_id = guild_id
+        self.reason = reason
+        self.triggered = now
+        self.first_change = now
+        self.last_change = now
+        self.snapshot = None
+        self.frozen = None
+        self.tasks = set()
+        # Old id -> future of the new id, for deleted roles and categories being recreated
+        self.roles = {}
+        self.channels = {}
+        self.creating = set()
+        self.restored = set()
+        self.reverted = Counter()
+        self.failed = Counter()
+        self.skipped = 0
+        self.recovered_at = now
+        self.watcher = None
+        self.ending = None
+        # New role id -> the position the deleted role had
+        self.positions = {}
+
+
+class LockdownManager:
+    """Freezes a guild under attack and rolls back its structural changes in one batch.
+
+    Every channel and role created or deleted is kept in a short per-guild
+    journal. ``trigger``, called when the detector fires, snapshots the
+    guild's channels, roles and permission overwrites from the cache, takes
+    ``FREEZE_PERMISSIONS`` from @everyone in a single role edit, and reverts
+    every change from the last ``lookback`` seconds and any that follow:
+    created channels and roles are deleted, deleted ones are recreated with
+    their permissions, overwrites and categories, roles first so recreated
+    channels can point at them. The reverts run concurrently, bounded per
+    route by ``ROLLBACK_LIMITS`` and paced under Discord's global limit of 50
+    requests a second. Once ``settle`` seconds pass without another change,
+    overwrites and role permissions edited during the incident are put back
+    from the snapshot, @everyone is thawed and ``on_end`` receives an
+    ``IncidentReport`` with the time from the first change to full recovery.
+
+    ``api`` does the REST calls and cache reads for one library; see
+    ``DiscordGuildAPI`` and ``HikariGuildAPI``.
+    """
+
+    def __init__(self, api, on_end=None, lookback=60.0, settle=30.0, attribution_timeout=3.0, route_limits=None,
+                 rate=40.0, state_path=None, journal_size=2000, clock=time.monotonic):
+        self.api = api
+        self.on_end = on_end
+        self.lookback = lookback
+        self.settle = settle
+        self.attribution_timeout = attribution_timeout
+        self.route_limits = dict(ROLLBACK_LIMITS, **(route_limits or {}))
+        self.rate = rate
+        self.state_path = state_path
+        self.journal_size = journal_size
+        self.clock = clock
+        self._journals = {}
+        self._incidents = {}
+        self._expected = {}
+        self._limits = {}
+        self._next_request = 0.0
+
+    # Journal
+
+    def record(self, guild_id, kind, spec, attributed=False):
+        """Journal a change and, during a lockdown, revert it.
+
+        Returns None for changes the bot made itself, which are never journaled.
+        """
+        if self._expected.pop((guild_id, spec["id"]), None) is not None:
+            return None
+        now = self.clock()
+        pending = asyncio.get_running_loop().create_future() if attributed else None
+        change = Change(kind, spec, now, pending)
+        journal = self._journals.get(guild_id)
+        if journal is None:
+            journal = self._journals[guild_id] = deque(maxlen=self.journal_size)
+        journal.append(change)
+        while journal[0].at < now - self.lookback:
+            journal.popleft()
+        incident = self._incidents.get(guild_id)
+        if incident is not None:
+            incident.last_change = now
+            self._schedule(incident, change)
+        return change
+
+    def expect(self, guild_id, target_id):
+        """Note a change the bot is about to make, so its gateway event is not journaled."""
+        now = self.clock()
+        if len(self._expected) > 4096:
+            self._expected = {key: deadline for key, deadline in self._expected.items() if deadline > now}
+        self._expected[(guild_id, target_id)] = now + self.lookback
+
+    # Incidents
+
+    def active(self, guild_id):
+        return guild_id in self._incidents
+
+    def incident(self, guild_id):
+        return self._incidents.get(guild_id)
+
+    def trigger(self, guild_id, reason):
+        """Lock a guild down and start rolling back; a no-op if it already is."""
+        incident = self._incidents.get(guild_id)
+        if incident is not None:
+            return incident
+        now = self.clock()
+        incident = self._incidents[guild_id] = Incident(guild_id, reason, now)
+        try:
+            incident.snapshot = self.api.snapshot(guild_id)
+        except Exception as e:
+            logging.error(f"Error snapshotting guild {guild_id} for lockdown: {e}")
+        self._spawn(incident, self._freeze(incident))
+        for change in self._journals.get(guild_id, ()):
+            if not change.scheduled and change.at >= now - self.lookback:
+                self._schedule(incident, change)
+        incident.watcher = asyncio.create_task(self._watch(incident))
+        logging.warning(f"Lockdown in guild {guild_id}: {reason}")
+        return incident
+
+    async def end(self, guild_id):
+        """Finish rolling back, restore and thaw the guild now; returns the report or None."""
+        incident = self._incidents.get(guild_id)
+        if incident is None:
+            return None
+        if incident.ending is not None:
+            return await asyncio.shield(incident.ending)
+        incident.ending = asyncio.get_running_loop().create_future()
+        if incident.watcher is not None and incident.watcher is not asyncio.current_task():
+            incident.watcher.cancel()
+        # Changes keep arriving while the batch runs, so wait until it is empty
+        while incident.tasks:
+            await asyncio.wait(list(incident.tasks))
+        await self._restore(incident)
+        del self._incidents[guild_id]
+        await self._thaw(guild_id, incident.frozen)
+        report = IncidentReport(
+            guild_id, incident.reason, incident.reverted, incident.failed, incident.skipped,
+            incident.reverted["overwrites"] + incident.reverted["permissions"],
+            incident.recovered_at - incident.first_change, self.clock() - incident.triggered,
+        )
+        logging.warning(f"Lockdown in guild {guild_id} lifted: {sum(report.reverted.values())} changes reverted, "
+                        f"{sum(report.failed.values())} failed, recovered in {report.time_to_recover:.1f}s")
+        if self.on_end is not None:
+            try:
+                await self.on_end(report)
+            except Exception as e:
+                logging.error(f"Error reporting lockdown in guild {guild_id}: {e}")
+        incident.ending.set_result(report)
+        return report
+
+    async def close(self):
+        """End every lockdown in progress."""
+        for guild_id in list(self._incidents):
+            await self.end(guild_id)
+
+    async def thaw_stale(self):
+        """Thaw guilds left frozen by a previous run that stopped mid-lockdown."""
+        saved = await asyncio.to_thread(self._load_frozen)
+        for guild_id, permissions in saved.items():
+            if guild_id not in self._incidents:
+                await self._thaw(guild_id, permissions)
+
+    async def _watch(self, incident):
+        while True:
+            remaining = incident.last_change + self.settle - self.clock()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        await self.end(incident.guild_id)
+
+    def _spawn(self, incident, coro):
+        task = asyncio.create_task(coro)
+        incident.tasks.add(task)
+        task.add_done_callback(incident.tasks.discard)
+
+    # Freezing
+
+    async def _freeze(self, incident):
+        everyone = (incident.snapshot or ({}, {}))[1].get(incident.guild_id)
+        if everyone is None:
+            return
+        permissions = everyone["permissions"]
+        if not permissions & FREEZE_PERMISSIONS:
+            return
+        incident.frozen = permissions
+        try:
+            await asyncio.to_thread(self._save_frozen, incident.guild_id, permissions)
+            await self._request("role_edit", self.api.edit_role, incident.guild_id, incident.guild_id,
+                                {"permissions": permissions & ~FREEZE_PERMISSIONS})
+        except Exception as e:
+            incident.failed["freeze"] += 1
+            logging.error(f"Error freezing @everyone in guild {incident.guild_id}: {e}")
+
+    async def _thaw(self, guild_id, permissions):
+        if permissions is None:
+            return
+        try:
+            await self._request("role_edit", self.api.edit_role, guild_id, guild_id, {"permissions": permissions})
+            await asyncio.to_thread(self._save_frozen, guild_id, None)
+        except Exception as e:
+            logging.error(f"Error thawing @everyone in guild {guild_id}: {e}")
+
+    def _load_frozen(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, "r") as file:
+            return {int(guild_id): permissions for guild_id, permissions in json.load(file).items()}
+
+    def _save_frozen(self, guild_id, permissions):
+        # Rare and tiny, so the whole file is rewritten each time
+        if not self.state_path:
+            return
+        saved = self._load_frozen()
+        if permissions is None:
+            saved.pop(guild_id, None)
+        else:
+            saved[guild_id] = permissions
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(saved, file)
+        os.replace(temp_path, self.state_path)
+
+    # Rolling back
+
+    def _schedule(self, incident, change):
+        change.scheduled = True
+        # Registered before anything runs, so dependents find them
+        loop = asyncio.get_running_loop()
+        if change.kind == ROLE_DELETE:
+            incident.roles[change.spec["id"]] = loop.create_future()
+        elif change.kind == CHANNEL_DELETE and change.spec.get("type") == CATEGORY:
+            incident.channels[change.spec["id"]] = loop.create_future()
+        # A create event can beat the response to the bot's own create request,
+        # but only for requests already in flight when the event arrived
+        in_flight = list(incident.creating) if change.kind in (CHANNEL_CREATE, ROLE_CREATE) else ()
+        self._spawn(incident, self._revert(incident, change, in_flight))
+
+    async def _revert(self, incident, change, in_flight):
+        guild_id = incident.guild_id
+        spec = change.spec
+        kind = change.kind
+        new_id = None
+        try:
+            if change.pending is not None and not change.pending.done():
+                await asyncio.wait([change.pending], timeout=self.attribution_timeout)
+            if not change.revert:
+                incident.skipped += 1
+                return
+            incident.first_change = min(incident.first_change, change.at)
+            if kind in (CHANNEL_CREATE, ROLE_CREATE):
+                if in_flight:
+                    await asyncio.wait(in_flight)
+                if spec["id"] in incident.restored:
+                    return
+                self.expect(guild_id, spec["id"])
+                if kind == CHANNEL_CREATE:
+                    await self._request("channel_delete", self.api.delete_channel, guild_id, spec["id"])
+                else:
+                    await self._request("role_delete", self.api.delete_role, guild_id, spec["id"])
+            elif "name" not in spec:
+                raise ValueError("it was not cached when it was deleted")
+            elif kind == ROLE_DELETE:
+                new_id = await self._create(incident, "role_create", self.api.create_role, spec)
+                if "position" in spec:
+                    incident.positions[new_id] = spec["position"]
+            else:
+                spec = dict(spec)
+                parent = incident.channels.get(spec.get("parent_id"))
+                if parent is not None:
+                    spec["parent_id"] = await parent
+                spec["permission_overwrites"] = await self._remap(incident, spec.get("permission_overwrites", ()))
+                new_id = await self._create(incident, "channel_create", self.api.create_channel, spec)
+            incident.reverted[kind] += 1
+        except Exception as e:
+            incident.failed[kind] += 1
+            logging.error(f"Error reverting {kind} of {spec['id']} in guild {guild_id}: {e}")
+        finally:
+            future = incident.roles.get(spec["id"]) or incident.channels.get(spec["id"])
+            if future is not None and not future.done():
+                future.set_result(new_id)
+            if change.revert:
+                incident.recovered_at = self.clock()
+
+    async def _create(self, incident, route, create, spec):
+        done = asyncio.get_running_loop().create_future()
+        incident.creating.add(done)
+        try:
+            new_id = await self._request(route, create, incident.guild_id, spec)
+            self.expect(incident.guild_id, new_id)
+            incident.restored.add(new_id)
+            return new_id
+        finally:
+            incident.creating.discard(done)
+            done.set_result(None)
+
+    @staticmethod
+    async def _remap(incident, overwrites):
+        # Point overwrites for recreated roles at their new ids, and drop those for roles that stay deleted
+        remapped = []
+        for overwrite in overwrites:
+            future = incident.roles.get(overwrite["id"])
+            if future is not None:
+                new_id = await future
+                if new_id is None:
+                    continue
+                overwrite = dict(overwrite, id=new_id)
+            remapped.append(overwrite)
+        return remapped
+
+    async def _restore(self, incident):
+        # Overwrites and role permissions edited during the incident go back to the snapshot
+        channels, roles = incident.snapshot or ({}, {})
+        try:
+            current_channels, current_roles = self.api.snapshot(incident.guild_id)
+        except Exception as e:
+            logging.error(f"Error snapshotting guild {incident.guild_id} to restore it: {e}")
+            current_channels, current_roles = {}, {}
+        edits = []
+        for channel_id, spec in channels.items():
+            current = current_channels.get(channel_id)
+            if current is not None and _overwrites(current) != _overwrites(spec):
+                overwrites = await self._remap(incident, spec["permission_overwrites"])
+                edits.append(self._edit(incident, "overwrites", "channel_edit", self.api.edit_channel, channel_id,
+                                        {"permission_overwrites": overwrites}))
+        for role_id, spec in roles.items():
+            current = current_roles.get(role_id)
+            if role_id != incident.guild_id and current is not None and current["permissions"] != spec["permissions"]:
+                edits.append(self._edit(incident, "permissions", "role_edit", self.api.edit_role, role_id,
+                                        {"permissions": spec["permissions"]}))
+        # Recreated roles come back at the bottom; one request puts them all where they were
+        if incident.positions:
+            edits.append(self._edit(incident, "positions", "role_edit", self.api.move_roles, incident.positions, None))
+        if edits:
+            await asyncio.gather(*edits)
+            incident.recovered_at = self.clock()
+
+    async def _edit(self, incident, kind, route, edit, target_id, fields):
+        try:
+            if fields is None:
+                await self._request(route, edit, incident.guild_id, target_id)
+            else:
+                await self._request(route, edit, incident.guild_id, target_id, fields)
+            incident.reverted[kind] += 1
+        except Exception as e:
+            incident.failed[kind] += 1
+            logging.error(f"Error restoring {kind} in guild {incident.guild_id}: {e}")
+
+    async def _request(self, route, call, *args):
+        limit = self._limits.get(route)
+        if limit is None:
+            limit = self._limits[route] = asyncio.Semaphore(self.route_limits.get(route, 1))
+        async with limit:
+            # Spaced out under the global limit, which every bucket shares
+            now = time.monotonic()
+            slot = max(now, self._next_request)
+            self._next_request = slot + 1.0 / self.rate
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            return await call(*args)
+
+
+def _overwrites(spec):
+    return {(o["id"], o["type"], o["allow"], o["deny"]) for o in spec.get("permission_overwrites", ())}
+
+
+class DiscordGuildAPI:
+    """Lockdown REST calls and cache reads for discord.py / py-cord.
+
+    Channels and roles are created from the raw payloads through ``bot.http``,
+    which takes Discord's field names as they are.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @staticmethod
+    def channel_spec(channel):
+        import discord
+
+        overwrites = []
+        for target, overwrite in channel.overwrites.items():
+            allow, deny = overwrite.pair()
+            # Targets that are not cached come back as a discord.Object carrying the type
+            role = isinstance(target, discord.Role) or getattr(target, "type", None) is discord.Role
+            overwrites.append({"id": target.id, "type": 0 if role else 1, "allow": allow.value, "deny": deny.value})
+        spec = {"id": channel.id, "type": channel.type.value, "name": channel.name, "position": channel.position,
+                "parent_id": channel.category_id, "permission_overwrites": overwrites}
+        for field, attribute in (("topic", "topic"), ("nsfw", "nsfw"), ("rate_limit_per_user", "slowmode_delay"),
+                                 ("bitrate", "bitrate"), ("user_limit", "user_limit")):
+            value = getattr(channel, attribute, None)
+            if value is not None:
+                spec[field] = value
+        return spec
+
+    @staticmethod
+    def role_spec(role):
+        return {"id": role.id, "name": role.name, "permissions": role.permissions.value, "color": role.colour.value,
+                "hoist": role.hoist, "mentionable": role.mentionable, "position": role.position}
+
+    def snapshot(self, guild_id):
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            return {}, {}
+        return ({channel.id: self.channel_spec(channel) for channel in guild.channels},
+                {role.id: self.role_spec(role) for role in guild.roles if not role.managed})
+
+    async def create_channel(self, guild_id, spec):
+        options = {key: value for key, value in spec.items() if key not in ("id", "type")}
+        data = await self.bot.http.create_channel(guild_id, spec["type"], reason=REASON, **options)
+        return int(data["id"])
+
+    async def delete_channel(self, guild_id, channel_id):
+        await self.bot.http.delete_channel(channel_id, reason=REASON)
+
+    async def edit_channel(self, guild_id, channel_id, fields):
+        await self.bot.http.edit_channel(channel_id, reason=REASON, **fields)
+
+    async def create_role(self, guild_id, spec):
+        fields = {key: value for key, value in spec.items() if key not in ("id", "position")}
+        data = await self.bot.http.create_role(guild_id, reason=REASON, **fields)
+        return int(data["id"])
+
+    async def delete_role(self, guild_id, role_id):
+        await self.bot.http.delete_role(guild_id, role_id, reason=REASON)
+
+    async def edit_role(self, guild_id, role_id, fields):
+        await self.bot.http.edit_role(guild_id, role_id, reason=REASON, **fields)
+
+    async def move_roles(self, guild_id, positions):
+        await self.bot.http.move_role_position(
+            guild_id, [{"id": role_id, "position": position} for role_id, position in positions.items()],
+            reason=REASON
+        )
+
+
+class HikariGuildAPI:
+    """Lockdown REST calls and cache reads for hikari, which needs the ROLES cache."""
+
+    def __init__(self, bot):
+        import hikari
+
+        self.bot = bot
+        # Older hikari releases take no audit-log reason for role deletes
+        self._delete_role_reason = "reason" in inspect.signature(hikari.impl.RESTClientImpl.delete_role).parameters
+
+    @staticmethod
+    def channel_spec(channel):
+        spec = {
+            "id": int(channel.id), "type": int(channel.type), "name": channel.name, "position": channel.position,
+            "parent_id": int(channel.parent_id) if channel.parent_id else None,
+            "permission_overwrites": [
+                {"id": int(o.id), "type": int(o.type), "allow": int(o.allow), "deny": int(o.deny)}
+                for o in channel.permission_overwrites.values()
+            ],
+        }
+        rate_limit = getattr(channel, "rate_limit_per_user", None)
+        if rate_limit is not None:
+            spec["rate_limit_per_user"] = int(rate_limit.total_seconds())
+        for field, attribute in (("topic", "topic"), ("nsfw", "is_nsfw"), ("bitrate", "bitrate"),
+                                 ("user_limit", "user_limit")):
+            value = getattr(channel, attribute, None)
+            if value is not None:
+                spec[field] = value
+        return spec
+
+    @staticmethod
+    def role_spec(role):
+        return {"id": int(role.id), "name": role.name, "permissions": int(role.permissions), "color": int(role.color),
+                "hoist": role.is_hoisted, "mentionable": role.is_mentionable, "position": role.position}
+
+    def snapshot(self, guild_id):
+        cache = self.bot.cache
+        return ({int(channel_id): self.channel_spec(channel)
+                 for channel_id, channel in cache.get_guild_channels_view_for_guild(guild_id).items()},
+                {int(role_id): self.role_spec(role)
+                 for role_id, role in cache.get_roles_view_for_guild(guild_id).items() if not role.is_managed})
+
+    @staticmethod
+    def _overwrites(overwrites):
+        import hikari
+
+        return [hikari.PermissionOverwrite(id=o["id"], type=hikari.PermissionOverwriteType(o["type"]),
+                                           allow=hikari.Permissions(o["allow"]), deny=hikari.Permissions(o["deny"]))
+                for o in overwrites]
+
+    async def create_channel(self, guild_id, spec):
+        rest = self.bot.rest
+        options = {"position": spec["position"], "permission_overwrites": self._overwrites(spec["permission_overwrites"]),
+                   "reason": REASON}
+        if spec["type"] != CATEGORY and spec.get("parent_id"):
+            options["category"] = spec["parent_id"]
+        if spec["type"] in (TEXT, NEWS):
+            create = rest.create_guild_text_channel if spec["type"] == TEXT else rest.create_guild_news_channel
+            channel = await create(guild_id, spec["name"], topic=spec.get("topic") or None, nsfw=spec.get("nsfw", False),
+                                   rate_limit_per_user=spec.get("rate_limit_per_user", 0), **options)
+        elif spec["type"] == VOICE:
+            channel = await rest.create_guild_voice_channel(guild_id, spec["name"], bitrate=spec.get("bitrate", 64000),
+                                                            user_limit=spec.get("user_limit", 0), **options)
+        elif spec["type"] == CATEGORY:
+            channel = await rest.create_guild_category(guild_id, spec["name"], **options)
+        else:
+            raise ValueError(f"channels of type {spec['type']} cannot be recreated")
+        return int(channel.id)
+
+    async def delete_channel(self, guild_id, channel_id):
+        await self.bot.rest.delete_channel(channel_id, reason=REASON)
+
+    async def edit_channel(self, guild_id, channel_id, fields):
+        await self.bot.rest.edit_channel(channel_id, permission_overwrites=self._overwrites(fields["permission_overwrites"]),
+                                         reason=REASON)
+
+    async def create_role(self, guild_id, spec):
+        import hikari
+
+        role = await self.bot.rest.create_role(guild_id, name=spec["name"], permissions=hikari.Permissions(spec["permissions"]),
+                                               color=spec["color"], hoist=spec["hoist"], mentionable=spec["mentionable"],
+                                               reason=REASON)
+        return int(role.id)
+
+    async def delete_role(self, guild_id, role_id):
+        if self._delete_role_reason:
+            await self.bot.rest.delete_role(guild_id, role_id, reason=REASON)
+        else:
+            await self.bot.rest.delete_role(guild_id, role_id)
+
+    async def edit_role(self, guild_id, role_id, fields):
+        import hikari
+
+        await self.bot.rest.edit_role(guild_id, role_id, permissions=hikari.Permissions(fields["permissions"]),
+                                      reason=REASON)
+
+    async def move_roles(self, guild_id, positions):
+        await self.bot.rest.reposition_roles(guild_id, {position: role_id for role_id, position in positions.items()})
+
+
+def _benchmark(created=200, deleted_channels=30, deleted_roles=20, latency=0.08):
+    # Every request takes ``latency``; creates and role changes share one
+    # bucket per guild, which lets one request through at a time, like Discord
+    class SimulatedAPI:
+        def __init__(self):
+            self.calls = Counter()
+            self.guild_bucket = asyncio.Lock()
+            self.ids = iter(range(10**18, 2 * 10**18))
+
+        async def _call(self, route, per_guild):
+            self.calls[route] += 1
+            if per_guild:
+                async with self.guild_bucket:
+                    await asyncio.sleep(latency)
+            else:
+                await asyncio.sleep(latency)
+
+        def snapshot(self, guild_id):
+            return {}, {guild_id: {"id": guild_id, "permissions": 1071698660929}}
+
+        async def create_channel(self, guild_id, spec):
+            await self._call("channel_create", True)
+            return next(self.ids)
+
+        async def delete_channel(self, guild_id, channel_id):
+            await self._call("channel_delete", False)
+
+        async def edit_channel(self, guild_id, channel_id, fields):
+            await self._call("channel_edit", False)
+
+        async def create_role(self, guild_id, spec):
+            await self._call("role_create", True)
+            return next(self.ids)
+
+        async def delete_role(self, guild_id, role_id):
+            await self._call("role_delete", True)
+
+        async def edit_role(self, guild_id, role_id, fields):
+            await self._call("role_edit", True)
+
+        async def move_roles(self, guild_id, positions):
+            await self._call("role_positions", True)
+
+    guild_id = 1100000000000000000
+    roles = [{"id": 2000 + i, "name": f"role {i}", "permissions": 0, "color": 0, "hoist": False, "mentionable": False,
+              "position": i + 1} for i in range(deleted_roles)]
+    channels = [{"id": 3000 + i, "type": TEXT, "name": f"channel-{i}", "position": i, "parent_id": None,
+                 "permission_overwrites": [{"id": roles[i % deleted_roles]["id"], "type": 0, "allow": 1024, "deny": 0}]}
+                for i in range(deleted_channels)]
+    changes = ([(CHANNEL_CREATE, {"id": 1000 + i}) for i in range(created)] + [(ROLE_DELETE, r) for r in roles]
+               + [(CHANNEL_DELETE, c) for c in channels])
+
+    async def per_event():
+        # What antieverything did: an audit-log lookup and one revert per event, one at a time
+        api = SimulatedAPI()
+        started = time.perf_counter()
+        for kind, spec in changes:
+            await api._call("audit_logs", False)
+            if kind == CHANNEL_CREATE:
+                await api.delete_channel(guild_id, spec["id"])
+            elif kind == ROLE_DELETE:
+                await api.create_role(guild_id, spec)
+            else:
+                await api.create_channel(guild_id, spec)
+        return time.perf_counter() - started, api.calls
+
+    async def batch():
+        api = SimulatedAPI()
+        reports = []
+
+        async def on_end(report):
+            reports.append(report)
+
+        manager = LockdownManager(api, on_end=on_end, settle=0.05)
+        for kind, spec in changes:
+            manager.record(guild_id, kind, spec)
+        await manager.trigger(guild_id, "benchmark").watcher
+        return reports[0], api.calls
+
+    print(f"{created} created channels, {deleted_channels} deleted channels and {deleted_roles} deleted roles, "
+          f"{latency * 1000:.0f} ms per request")
+    elapsed, calls = asyncio.run(per_event())
+    print(f"per event, serial:  recovered in {elapsed:6.2f}s with {sum(calls.values())} requests")
+    report, calls = asyncio.run(batch())
+    print(f"lockdown batch:     recovered in {report.time_to_recover:6.2f}s with {sum(calls.values())} requests "
+          f"({', '.join(f'{route} {count}' for route, count in sorted(calls.items()))}); "
+          f"{sum(report.failed.values())} failed")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,425 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+
+SNAPSHOT_VERSION = 1
+# Binary snapshots: magic, codec name, codec version, seq
+SNAPSHOT_MAGIC = b"WBLS"
+_HEADER = struct.Struct("<4s16sHQ")
+
+
+class WriteBehindLog:
+    """Append-only journal with a background writer and compaction.
+
+    The live state is kept in memory by the caller. Every change is described
+    as a small op that is queued with ``append`` and written to
+    ``<path>.log`` by a writer thread, in batches, on a timer or once enough
+    ops are pending. The snapshot at ``path`` is only rewritten when the
+    journal is compacted, so the cost of recording an event no longer grows
+    with the size of the history and handlers never touch the disk. A batch
+    that fails to write is kept and written first on the next round, and
+    ops appended after ``close`` are written straight away.
+
+    ``apply(state, op, *args)`` folds one op into the state and is used both
+    by the caller (through ``record``) and when replaying the journal.
+
+    With a ``codec`` (see statecodec.py) the snapshot is written in its binary
+    format next to ``path``, with a ``.bin`` extension, instead of as JSON.
+    A JSON snapshot left at ``path`` is still read until the first binary one
+    replaces it.
+    """
+
+    def __init__(self, path, default, apply, encode=None, decode=None, codec=None,
+                 flush_interval=1.0, flush_size=256, compact_every=5000):
+        self.path = path
+        self.snapshot_path = path if codec is None else os.path.splitext(path)[0] + ".bin"
+        self.journal_path = path + ".log"
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.compact_every = compact_every
+        self._default = default
+        self._apply = apply
+        self._encode = encode or (lambda state: state)
+        self._decode = decode or (lambda data: data)
+        self._codec = codec
+        self._queue = queue.SimpleQueue()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._seq = 0
+        self._journal_ops = 0
+        # Ops recorded before loading finished, held back from the journal
+        self._early = []
+        # Journal lines of a batch that failed to write, retried first
+        self._unwritten = []
+
+    # Loading
+
+    def load(self):
+        """Rebuild the state from the snapshot and journal, then start the writer."""
+        state, seq, journal_ops = self._prepare()
+        self._start(state, seq, journal_ops)
+        return state
+
+    async def load_into(self, state):
+        """Load in a worker thread into ``state``, which handlers may already be using.
+
+        ``state`` is the empty container the caller created up front; it must
+        support ``clear`` and ``update``. Ops recorded before the load
+        finishes are applied to it as usual and replayed on top of what was
+        loaded, so nothing recorded early is lost.
+        """
+        loaded, seq, journal_ops = await asyncio.to_thread(self._prepare)
+        # Back on the event loop, so no handler sees the state half-replaced
+        state.clear()
+        state.update(loaded)
+        self._start(state, seq, journal_ops)
+        return state
+
+    def _prepare(self):
+        state, seq, journal_ops, good_size = self._read()
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > good_size:
+            # Drop the torn tail so new records do not get glued onto it
+            with open(self.journal_path, "r+b") as file:
+                file.truncate(good_size)
+        return state, seq, journal_ops
+
+    def _start(self, state, seq, journal_ops):
+        self._seq = seq
+        self._journal_ops = journal_ops
+        early, self._early = self._early, None
+        for op, args in early:
+            self._apply(state, op, *args)
+            self.append(op, *args)
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name=f"write-behind:{os.path.basename(self.path)}", daemon=True
+            )
+            self._thread.start()
+
+    def exists(self):
+        """Whether anything has been saved for this log yet."""
+        return any(os.path.exists(path) for path in (self.path, self.snapshot_path, self.journal_path))
+
+    def read(self):
+        """Rebuild the state from disk without starting the writer or changing any file."""
+        return self._read()[0]
+
+    def write_snapshot(self, state):
+        """Replace the snapshot with ``state`` and drop the journal; only valid before ``load``."""
+        self._write_snapshot(state, 0)
+        if os.path.exists(self.journal_path):
+            open(self.journal_path, "w").close()
+
+    def _read_snapshot(self):
+        if self._codec is not None and os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as file:
+                data = file.read()
+            magic, name, version, seq = _HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or name.rstrip(b"\0").decode() != self._codec.name:
+                raise ValueError(f"{self.snapshot_path} is not a {self._codec.name} snapshot")
+            return self._codec.decode(memoryview(data)[_HEADER.size:], version), seq
+        if not os.path.exists(self.path):
+            return None, 0
+        with open(self.path, "r") as file:
+            data = json.load(file)
+        # Files written before the journal existed hold the bare data.
+        if isinstance(data, dict) and data.get("version") == SNAPSHOT_VERSION and "data" in data:
+            return self._decode(data["data"]), data["seq"]
+        return self._decode(data), 0
+
+    def _read(self):
+        snapshot, seq = self._read_snapshot()
+        state = self._default() if snapshot is None else snapshot
+        replayed = 0
+        good_size = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb") as file:
+                for line in file:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("missing newline")
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn trailing line left by a crash mid-write; everything
+                        # before it is intact.
+                        logging.warning(f"Ignoring truncated record in {self.journal_path}")
+                        break
+                    good_size += len(line)
+                    # Ops already folded into the snapshot by an interrupted compaction.
+                    if record[0] <= seq:
+                        continue
+                    self._apply(state, *record[1:])
+                    seq = record[0]
+                    replayed += 1
+        return state, seq, replayed, good_size
+
+    # Writing
+
+    def record(self, state, op, *args):
+        """Apply an op to the in-memory state and queue it for the journal."""
+        self._apply(state, op, *args)
+        self.append(op, *args)
+
+    def append(self, op, *args):
+        """Queue an op for the journal without blocking."""
+        if self._early is not None:
+            # Sequence numbers are only known once the journal has been read
+            self._early.append((op, args))
+            return
+        self._seq += 1
+        self._queue.put((self._seq, op, args))
+        if self._thread is None:
+            # Closed, so nothing would write it later
+            self._drain()
+        elif self._queue.qsize() >= self.flush_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """Block until every op queued so far has been written."""
+        if self._thread is None or not self._thread.is_alive():
+            self._drain()
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        self._wakeup.set()
+        done.wait()
+
+    def close(self):
+        """Flush pending ops and stop the writer thread."""
+        if self._thread is None:
+            if self._early:
+                logging.warning(f"Dropping {len(self._early)} ops for {self.path}, which never finished loading")
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._stopping.clear()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self._drain()
+            except Exception as e:
+                logging.error(f"Error writing {self.journal_path}: {e}")
+        try:
+            self._drain()
+        except Exception as e:
+            logging.error(f"Error writing {self.journal_path}, {len(self._unwritten)} ops left unwritten: {e}")
+
+    def _drain(self):
+        # A failed batch goes back in front of what was queued since, and
+        # flush waiters are released either way so they never hang
+        lines, self._unwritten = self._unwritten, []
+        waiters = []
+        try:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    continue
+                seq, op, args = item
+                lines.append(json.dumps([seq, op, *args], default=str) + "\n")
+            if lines:
+                try:
+                    self._write_lines(lines)
+                except BaseException:
+                    self._unwritten = lines
+                    raise
+                self._journal_ops += len(lines)
+                if self._journal_ops >= self.compact_every:
+                    self._compact()
+        finally:
+            for waiter in waiters:
+                waiter.set()
+
+    def _write_lines(self, lines):
+        data = memoryview("".join(lines).encode())
+        # Unbuffered, so a failed write leaves nothing behind to be flushed on close
+        with open(self.journal_path, "ab", buffering=0) as file:
+            start = file.seek(0, os.SEEK_END)
+            try:
+                while data:
+                    data = data[file.write(data):]
+                os.fsync(file.fileno())
+            except OSError:
+                # Cut off the part that made it, so the retry does not follow a torn line
+                os.ftruncate(file.fileno(), start)
+                raise
+
+    def _compact(self):
+        # Rebuilt from disk rather than from the caller's state, which is owned by
+        # the event loop and may be mutated while we serialise.
+        state, seq, _, _ = self._read()
+        self._write_snapshot(state, seq)
+        # Only this thread writes the journal, so every line in it is now covered
+        # by the snapshot. A crash before truncation is handled by the seq check.
+        open(self.journal_path, "w").close()
+        self._journal_ops = 0
+        logging.info(f"Compacted {self.path} at seq {seq}")
+
+    def _write_snapshot(self, state, seq):
+        tmp_path = self.snapshot_path + ".tmp"
+        if self._codec is None:
+            with open(tmp_path, "w") as file:
+                json.dump({"version": SNAPSHOT_VERSION, "seq": seq, "data": self._encode(state)}, file, default=str)
+                file.flush()
+                os.fsync(file.fileno())
+        else:
+            with open(tmp_path, "wb") as file:
+                file.write(_HEADER.pack(SNAPSHOT_MAGIC, self._codec.name.encode(), self._codec.version, seq))
+                file.write(self._codec.encode(state))
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if self.snapshot_path != self.path and os.path.exists(self.path):
+            # The JSON snapshot this one replaces
+            os.remove(self.path)
+
+
+class PartitionedLog:
+    """Keyed state split across one ``WriteBehindLog`` per partition.
+
+    For state that is a dict keyed by something that decides its partition,
+    such as guild-keyed state split by gateway shard. Every op must take the
+    key as its first argument. All partitions are applied to one shared
+    in-memory dict, so callers use it exactly like a single ``WriteBehindLog``;
+    only the journal the op is written to depends on the key.
+
+    ``path_for(partition)`` gives each partition's file. A partition with no
+    file yet is seeded from the unpartitioned file at ``path``, if any, so
+    moving an existing deployment to partitions keeps its history.
+    """
+
+    def __init__(self, path, partitions, partition_of, path_for, default, apply, encode=None, decode=None,
+                 **options):
+        self.path = path
+        self.partition_of = partition_of
+        self._default = default
+        self._options = (default, apply, encode, decode, options.get("codec"))
+        self._logs = {}
+        for partition in partitions:
+            partition_path = path_for(partition)
+            os.makedirs(os.path.dirname(partition_path) or ".", exist_ok=True)
+            self._logs[partition] = WriteBehindLog(partition_path, default, apply, encode, decode, **options)
+
+    def load(self):
+        state, prepared = self._prepare()
+        for log, seq, journal_ops in prepared:
+            log._start(state, seq, journal_ops)
+        return state
+
+    async def load_into(self, state):
+        """Like ``WriteBehindLog.load_into``, for every partition at once."""
+        loaded, prepared = await asyncio.to_thread(self._prepare)
+        state.clear()
+        state.update(loaded)
+        for log, seq, journal_ops in prepared:
+            log._start(state, seq, journal_ops)
+        return state
+
+    def _prepare(self):
+        state = self._default()
+        prepared = []
+        legacy = None
+        unpartitioned = WriteBehindLog(self.path, *self._options)
+        for partition, log in self._logs.items():
+            if not log.exists() and unpartitioned.exists():
+                if legacy is None:
+                    legacy = unpartitioned.read()
+                seed = self._default()
+                seed.update((key, value) for key, value in legacy.items() if self.partition_of(key) == partition)
+                log.write_snapshot(seed)
+                logging.info(f"Seeded {log.path} with {len(seed)} keys from {self.path}")
+            loaded, seq, journal_ops = log._prepare()
+            state.update(loaded)
+            prepared.append((log, seq, journal_ops))
+        return state, prepared
+
+    def record(self, state, op, key, *args):
+        self._logs[self.partition_of(key)].record(state, op, key, *args)
+
+    def append(self, op, key, *args):
+        self._logs[self.partition_of(key)].append(op, key, *args)
+
+    def flush(self):
+        for log in self._logs.values():
+            log.flush()
+
+    def close(self):
+        for log in self._logs.values():
+            log.close()
+
+
+def _benchmark(guilds=2000, entries=250, partitions=4):
+    import shutil
+    import tempfile
+    import time
+    from collections import defaultdict
+
+    def apply(state, op, guild_id, entry):
+        state[guild_id].append(entry)
+
+    def decode(data):
+        return defaultdict(list, {int(guild_id): items for guild_id, items in data.items()})
+
+    def stores(folder):
+        return [
+            WriteBehindLog(os.path.join(folder, f"state-{i}.json"), lambda: defaultdict(list), apply, decode=decode)
+            for i in range(partitions)
+        ]
+
+    folder = tempfile.mkdtemp(prefix="logstore-")
+    try:
+        for i, log in enumerate(stores(folder)):
+            log.write_snapshot({str(1094926261459111936 + g): [f"Mass role creation detected! ({n})" for n in range(entries)]
+                                for g in range(i, guilds, partitions)})
+        size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+        print(f"{partitions} snapshots, {guilds:,} guilds x {entries} entries, {size / 1e6:.1f} MB")
+
+        # Before: every store is loaded at import, before the gateway connects
+        started = time.perf_counter()
+        for log in stores(folder):
+            log.load()
+            log.close()
+        blocking = time.perf_counter() - started
+        print(f"load() at import      gateway connects after {blocking:6.2f}s")
+
+        # After: the loop is free at once and the stores load in worker threads
+        async def background():
+            loop = asyncio.get_running_loop()
+            states = [defaultdict(list) for _ in range(partitions)]
+            logs = stores(folder)
+            started = loop.time()
+            task = asyncio.gather(*(log.load_into(state) for log, state in zip(logs, states)))
+            free = loop.time() - started
+            stall = 0.0
+            while not task.done():
+                tick = loop.time()
+                await asyncio.sleep(0.001)
+                stall = max(stall, loop.time() - tick - 0.001)
+            await task
+            total = loop.time() - started
+            for log in logs:
+                log.close()
+            return free, total, stall
+
+        free, total, stall = asyncio.run(background())
+        print(f"load_into() on start  gateway connects after {free:6.2f}s, "
+              f"state ready after {total:.2f}s, longest event loop stall {stall * 1000:.0f} ms")
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    _benchmark()
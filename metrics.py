@@ -0,0 +1,347 @@
+import asyncio
+import functools
+import json
+import logging
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds, from 50µs (a filter miss) to 10s (a stuck REST call)
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+
+    def labels(self, *values):
+        """Return the child for one combination of label values; keep it to skip the lookup."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} takes labels {self.label_names}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, *labels, amount=1):
+        self.labels(*labels).value += amount
+
+    def render(self):
+        lines = self.header()
+        for values, child in self._children.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}")
+        return lines
+
+    def snapshot(self):
+        return {",".join(map(str, values)): child.value for values, child in self._children.items()}
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        self.labels(*labels).value = value
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside the bucket that holds it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.bounds[i - 1] if i else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class Histogram(_Metric):
+    """Fixed-bucket histogram, cheap enough to observe on every event.
+
+    An observation is a bisect over the bucket bounds and three additions;
+    nothing is allocated. Quantiles are estimated from the buckets, which is
+    what Prometheus would do with them as well.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value, *labels):
+        self.labels(*labels).observe(value)
+
+    def time(self, *labels):
+        """Decorate a coroutine function to observe how long each call takes, errors included."""
+        child = self.labels(*labels)
+
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = self.header()
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), child.counts):
+                cumulative += count
+                le = _format_labels(self.label_names, values, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.label_names, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+    def snapshot(self):
+        return {
+            ",".join(map(str, values)): {
+                "count": child.count,
+                "sum": child.sum,
+                "p50": child.quantile(0.5),
+                "p95": child.quantile(0.95),
+                "p99": child.quantile(0.99),
+            }
+            for values, child in self._children.items()
+        }
+
+
+class Registry:
+    """Holds every metric of a process and renders them in Prometheus text format.
+
+    ``collector`` registers a function that is called at scrape time and
+    returns ``{label_values: value}``, for numbers that already live elsewhere
+    (queue depths, cache sizes) and would be wasteful to mirror on every change.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def collector(self, name, documentation, labels, collect, kind="gauge", replace=False):
+        # With replace, label values collect() no longer returns are dropped
+        # rather than keeping their last value
+        metric = Gauge(name, documentation, labels)
+        metric.kind = kind
+        metric.replace = replace
+        self._register(metric)
+        self._collectors.append((metric, collect))
+        return metric
+
+    def _collect(self):
+        for metric, collect in self._collectors:
+            try:
+                collected = collect()
+                if metric.replace:
+                    metric._children.clear()
+                for values, value in collected.items():
+                    metric.labels(*(values if isinstance(values, tuple) else (values,))).value = value
+            except Exception as e:
+                logging.error(f"Error collecting metric {metric.name}: {e}")
+
+    def render(self):
+        self._collect()
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        self._collect()
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def dump(self, path):
+        try:
+            with open(path, "w") as file:
+                json.dump({"time": time.time(), "metrics": self.snapshot()}, file, indent=2)
+        except Exception as e:
+            logging.error(f"Error dumping metrics to {path}: {e}")
+
+
+class RateLimitCounter(logging.Handler):
+    """Counts the rate-limit warnings the Discord library logs.
+
+    Neither hikari nor discord.py exposes a hook for 429 responses, but both
+    log a warning when they hit one, so attach this to their HTTP loggers.
+    """
+
+    def __init__(self, counter, *loggers):
+        super().__init__(logging.WARNING)
+        self.counter = counter
+        for name in loggers:
+            logging.getLogger(name).addHandler(self)
+
+    def emit(self, record):
+        if "rate limit" in record.getMessage().lower():
+            # Labelled by logger when the counter takes a label
+            self.counter.inc(*(record.name,)[:len(self.counter.label_names)])
+
+
+async def monitor_loop_lag(histogram, gauge=None, interval=0.25):
+    """Sample how late the event loop wakes a sleeping task, forever.
+
+    Anything that blocks the loop (a slow handler, a sync file write) delays
+    every gateway event by the same amount and shows up here first.
+    """
+    child = histogram.labels()
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        child.observe(lag)
+        if gauge is not None:
+            gauge.set(lag)
+
+
+async def serve(registry, host="127.0.0.1", port=9100):
+    """Serve ``GET /metrics`` (Prometheus text) and ``GET /metrics.json`` on a local port.
+
+    Deliberately minimal HTTP/1.0 so the bots need no web framework; it is
+    meant for a scraper on the same host, not for the internet.
+    """
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Drain the headers; nothing in them matters here
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request.decode("latin-1").split()
+            path = parts[1].split("?", 1)[0] if len(parts) > 1 else ""
+            if parts[:1] != ["GET"]:
+                status, content_type, body = "405 Method Not Allowed", "text/plain", "method not allowed\n"
+            elif path == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", registry.render()
+            elif path == "/metrics.json":
+                status, content_type, body = "200 OK", "application/json", json.dumps(registry.snapshot())
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+            data = body.encode()
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+            await writer.drain()
+        except Exception as e:
+            logging.error(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def _benchmark(events=1_000_000):
+    registry = Registry()
+    histogram = registry.histogram("handler_seconds", "Handler latency.", ("handler",))
+
+    async def handler():
+        pass
+
+    timed = histogram.time("handler")(handler)
+
+    async def run(func):
+        started = time.perf_counter()
+        for _ in range(events):
+            await func()
+        return time.perf_counter() - started
+
+    bare = asyncio.run(run(handler))
+    instrumented = asyncio.run(run(timed))
+    print(f"bare handler:         {bare / events * 1e9:6.0f} ns/call")
+    print(f"instrumented handler: {instrumented / events * 1e9:6.0f} ns/call "
+          f"(+{(instrumented - bare) / events * 1e9:.0f} ns)")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+ModLogEntry = namedtuple("ModLogEntry", "id guild_id created_at action actor_id target_id reason")
+
+_COLUMNS = ", ".join(ModLogEntry._fields)
+
+# Every index leads with the guild and ends in created_at, with the rowid
+# implied after it, so each filter combination is a range scan in page order.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mod_logs (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    action TEXT NOT NULL,
+    actor_id INTEGER,
+    target_id INTEGER,
+    reason TEXT
+);
+CREATE INDEX IF NOT EXISTS mod_logs_guild_time ON mod_logs (guild_id, created_at);
+CREATE INDEX IF NOT EXISTS mod_logs_guild_actor ON mod_logs (guild_id, actor_id, created_at);
+CREATE INDEX IF NOT EXISTS mod_logs_guild_action ON mod_logs (guild_id, action, created_at);
+CREATE TABLE IF NOT EXISTS mod_log_imports (
+    source TEXT PRIMARY KEY,
+    imported_at REAL NOT NULL
+);
+"""
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL keeps the database consistent on a crash without an fsync per commit
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class ModLogStore:
+    """Structured moderation log in a local SQLite database in WAL mode.
+
+    ``record`` never blocks the event loop: rows are queued and inserted in
+    batches by a writer thread, the same way ``WriteBehindLog`` journals ops.
+    Queries run in a worker thread on a separate connection, which WAL lets
+    read while the writer commits. Pages are fetched with a keyset cursor
+    (the id of the last entry shown), so reaching page 1000 costs the same
+    index seek as page 1. Several worker processes may share one database.
+    A batch that fails to insert is kept and inserted first on the next round.
+    """
+
+    def __init__(self, path, flush_interval=1.0, flush_size=256):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = _connect(path)
+        with conn:
+            conn.executescript(SCHEMA)
+        conn.close()
+        self._reader = None
+        self._read_lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+        # Rows of a batch that failed to insert, retried first
+        self._unwritten = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"mod-log:{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    # Writing
+
+    def record(self, guild_id, action, reason, actor_id=None, target_id=None, created_at=None):
+        """Queue one entry without blocking."""
+        self._queue.put((guild_id, time.time() if created_at is None else created_at, action, actor_id, target_id,
+                         reason))
+        if self._queue.qsize() >= self.flush_size:
+            self._wakeup.set()
+
+    def import_rows(self, source, rows):
+        """Insert ``rows`` once per ``source``, for migrating older logs; blocks.
+
+        Returns False if ``source`` was already imported, possibly by another
+        worker process sharing the database.
+        """
+        conn = _connect(self.path)
+        try:
+            with conn:
+                # Take the write lock first so two processes cannot both import
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("SELECT 1 FROM mod_log_imports WHERE source = ?", (source,)).fetchone():
+                    return False
+                conn.executemany(
+                    "INSERT INTO mod_logs (guild_id, created_at, action, actor_id, target_id, reason) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+                conn.execute("INSERT INTO mod_log_imports VALUES (?, ?)", (source, time.time()))
+            return True
+        finally:
+            conn.close()
+
+    def flush(self):
+        """Block until every entry queued so far has been written."""
+        if not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        self._wakeup.set()
+        done.wait()
+
+    def close(self):
+        """Write pending entries and stop the writer thread."""
+        if self._thread.is_alive():
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+        with self._read_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    def _run(self):
+        conn = _connect(self.path)
+        try:
+            while not self._stopping.is_set():
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                try:
+                    self._drain(conn)
+                except Exception as e:
+                    logging.error(f"Error writing {self.path}: {e}")
+            try:
+                self._drain(conn)
+            except Exception as e:
+                logging.error(f"Error writing {self.path}, {len(self._unwritten)} entries left unwritten: {e}")
+        finally:
+            conn.close()
+
+    def _drain(self, conn):
+        # A failed batch goes back in front of what was queued since; the
+        # transaction rolls it back whole, so retrying cannot duplicate rows
+        rows, self._unwritten = self._unwritten, []
+        waiters = []
+        try:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    rows.append(item)
+            if rows:
+                try:
+                    with conn:
+                        conn.executemany(
+                            "INSERT INTO mod_logs (guild_id, created_at, action, actor_id, target_id, reason) "
+                            "VALUES (?, ?, ?, ?, ?, ?)", rows
+                        )
+                except BaseException:
+                    self._unwritten = rows
+                    raise
+        finally:
+            for waiter in waiters:
+                waiter.set()
+
+    # Reading
+
+    async def query(self, guild_id, actor_id=None, action=None, since=None, cursor=None, limit=10):
+        """Return one page of a guild's entries, newest first, and the cursor for the next page.
+
+        The cursor is None on the last page. Entries recorded in the last
+        ``flush_interval`` seconds may not be visible yet.
+        """
+        return await asyncio.to_thread(self._query, guild_id, actor_id, action, since, cursor, limit)
+
+    def _query(self, guild_id, actor_id, action, since, cursor, limit):
+        sql = f"SELECT {_COLUMNS} FROM mod_logs WHERE guild_id = ?"
+        params = [guild_id]
+        if actor_id is not None:
+            sql += " AND actor_id = ?"
+            params.append(actor_id)
+        if action is not None:
+            sql += " AND action = ?"
+            params.append(action)
+        if since is not None:
+            sql += " AND created_at >= ?"
+            params.append(since)
+        if cursor is not None:
+            sql += " AND (created_at, id) < (SELECT created_at, id FROM mod_logs WHERE id = ?)"
+            params.append(cursor)
+        sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        # One extra row tells whether there is a next page
+        params.append(limit + 1)
+        with self._read_lock:
+            if self._reader is None:
+                self._reader = _connect(self.path)
+            rows = [ModLogEntry(*row) for row in self._reader.execute(sql, params)]
+        if len(rows) > limit:
+            return rows[:limit], rows[limit - 1].id
+        return rows, None
+
+
+def _benchmark(entries=1_000_000, guilds=1000, actors=500, pages=200):
+    import random
+    import shutil
+    import tempfile
+
+    folder = tempfile.mkdtemp(prefix="modlog-")
+    try:
+        store = ModLogStore(os.path.join(folder, "mod_logs.sqlite3"), flush_size=10000)
+        actions = ("message_deletes", "channel_creates", "role_creates", "role_deletes", "member_bans",
+                   "invite_deleted")
+        rng = random.Random(1)
+        guild_ids = [1094926261459111936 + i * 4194304 for i in range(guilds)]
+        started = time.perf_counter()
+        now = time.time() - entries
+        for i in range(entries):
+            # Half of the log belongs to one busy guild, the one paged through below
+            store.record(guild_ids[i % 2 and rng.randrange(guilds)], rng.choice(actions), "Mass role deletion detected!",
+                         actor_id=rng.randrange(actors), target_id=i, created_at=now + i)
+        queued = time.perf_counter() - started
+        store.flush()
+        written = time.perf_counter() - started
+        print(f"{entries:,} entries: record() {queued / entries * 1e6:.1f} µs each on the caller, "
+              f"all written after {written:.1f}s ({entries / written:,.0f}/s)")
+
+        guild_id = guild_ids[0]
+        per_guild = entries // 2
+
+        async def walk(**filters):
+            timings = []
+            cursor = None
+            for _ in range(pages):
+                page_started = time.perf_counter()
+                rows, cursor = await store.query(guild_id, cursor=cursor, **filters)
+                timings.append(time.perf_counter() - page_started)
+                if cursor is None:
+                    break
+            timings.sort()
+            return len(timings), timings[len(timings) // 2], timings[-1]
+
+        for name, filters in (("all entries", {}), ("one action", {"action": "role_creates"}),
+                              ("one actor", {"actor_id": 7}), ("last 2 days", {"since": time.time() - 172800})):
+            count, median, worst = asyncio.run(walk(**filters))
+            print(f"{name:12} {count:4} pages of 10 from ~{per_guild:,} guild entries: "
+                  f"median {median * 1000:.2f} ms, worst {worst * 1000:.2f} ms")
+
+        # What the in-memory list offered: a linear scan for every filter
+        legacy = [(rng.choice(actions), rng.randrange(actors)) for _ in range(entries)]
+        started = time.perf_counter()
+        matches = [entry for entry in legacy if entry[1] == 7][-10:]
+        print(f"linear scan of {entries:,} entries for one actor: {(time.perf_counter() - started) * 1000:.0f} ms "
+              f"({len(matches)} shown)")
+        store.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    _benchmark()
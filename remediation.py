@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+
+# Concurrent requests allowed per route. Punishments get their own lane so a
+# backlog of deletions never delays stopping the actor.
+ROUTE_LIMITS = {
+    "punish": 2,
+    "unban": 2,
+    "channel_delete": 5,
+    "role_delete": 5,
+    "message_delete": 5,
+}
+
+
+class _Job:
+    __slots__ = ("key", "run", "args", "future", "enqueued")
+
+    def __init__(self, key, run, args, future):
+        self.key = key
+        self.run = run
+        self.args = args
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class RemediationExecutor:
+    """Queues punishments and cleanup so a burst of events becomes a few requests.
+
+    Repeated punishments for the same (guild, actor) within ``cooldown`` are
+    coalesced into the first one, and repeated cleanup of the same target is
+    dropped. Cleanup for an actor waits until that actor has been punished,
+    and each route is served by at most ``ROUTE_LIMITS[route]`` concurrent
+    requests so deletions do not starve each other of rate-limit budget.
+    """
+
+    def __init__(self, punish, route_limits=None, cooldown=30.0, latency_samples=1000):
+        self._punish = punish
+        self.route_limits = dict(ROUTE_LIMITS, **(route_limits or {}))
+        self.cooldown = cooldown
+        self._queues = {}
+        self._workers = {}
+        self._pending = {}
+        self._punished = {}
+        self.latencies = {route: deque(maxlen=latency_samples) for route in self.route_limits}
+        self.completed = Counter()
+        self.failed = Counter()
+        self.coalesced = Counter()
+
+    def punish(self, guild, member):
+        """Queue a punishment unless the actor is already being or was just punished."""
+        key = (guild.id, member.id)
+        now = time.monotonic()
+        existing = self._punished.get(key)
+        if existing is not None and (not existing[0].done() or existing[1] > now):
+            self.coalesced["punish"] += 1
+            return existing[0]
+        if len(self._punished) > 1024:
+            self._punished = {k: v for k, v in self._punished.items() if not v[0].done() or v[1] > now}
+        future = self._submit("punish", ("punish",) + key, self._punish, guild, member)
+        self._punished[key] = (future, now + self.cooldown)
+        return future
+
+    def cleanup(self, route, guild, actor, target, action, *args):
+        """Queue ``action(*args)`` to undo what ``actor`` did to ``target``."""
+        key = (route, target.id)
+        if key in self._pending:
+            self.coalesced[route] += 1
+            return self._pending[key]
+        punished = self._punished.get((guild.id, actor.id))
+        return self._submit(route, key, self._after_punishment, punished and punished[0], action, *args)
+
+    @staticmethod
+    async def _after_punishment(punishment, action, *args):
+        if punishment is not None:
+            await asyncio.wait([punishment])
+        await action(*args)
+
+    def _submit(self, route, key, run, *args):
+        queue = self._queues.get(route)
+        if queue is None:
+            queue = self._queues[route] = asyncio.Queue()
+            self.latencies.setdefault(route, deque(maxlen=1000))
+            self._workers[route] = [
+                asyncio.create_task(self._worker(route, queue)) for _ in range(self.route_limits.get(route, 1))
+            ]
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        queue.put_nowait(_Job(key, run, args, future))
+        return future
+
+    async def _worker(self, route, queue):
+        while True:
+            job = await queue.get()
+            ok = False
+            try:
+                await job.run(*job.args)
+                ok = True
+                self.completed[route] += 1
+            except Exception as e:
+                self.failed[route] += 1
+                logging.error(f"Error running {route} for {job.key}: {e}")
+            finally:
+                self.latencies[route].append(time.monotonic() - job.enqueued)
+                if self._pending.get(job.key) is job.future:
+                    del self._pending[job.key]
+                if not job.future.done():
+                    job.future.set_result(ok)
+                queue.task_done()
+
+    def stats(self):
+        """Queue depth and enqueue-to-completion latency per route."""
+        stats = {}
+        for route, samples in self.latencies.items():
+            ordered = sorted(samples)
+            queue = self._queues.get(route)
+            stats[route] = {
+                "depth": queue.qsize() if queue else 0,
+                "completed": self.completed[route],
+                "failed": self.failed[route],
+                "coalesced": self.coalesced[route],
+                "p50": ordered[len(ordered) // 2] if ordered else 0.0,
+                "p99": ordered[int(len(ordered) * 0.99)] if ordered else 0.0,
+            }
+        return stats
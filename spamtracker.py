@@ -0,0 +1,176 @@
+import time
+from array import array
+
+
+class SpamTracker:
+    """Per-(guild, user) message rate tracking with bounded memory.
+
+    Each tracked user costs one dict slot plus a fixed row in a few typed
+    arrays: the start of the current window, the message counts for the
+    current and previous window, and when they were last seen. The rate is
+    the usual sliding-window-counter estimate, so thresholds are read on
+    every call and changes apply to everyone immediately.
+
+    Users idle for ``idle_timeout`` seconds are dropped by a timing wheel
+    with one bucket per ``tick``. Each user has exactly one entry in the
+    wheel; when their bucket comes due, a user seen since is moved to the
+    bucket of the tick they were last seen in rather than dropped, so busy
+    users cost no more than quiet ones. If ``max_entries`` is reached the
+    longest-idle users are dropped early.
+    """
+
+    def __init__(self, idle_timeout=300.0, tick=1.0, max_entries=2_000_000, clock=time.monotonic):
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self.max_entries = max_entries
+        self.clock = clock
+        self.evicted = 0
+        self._slots = {}
+        self._free = []
+        self._start = array("d")
+        self._prev = array("I")
+        self._cur = array("I")
+        self._seen = array("q")
+        self._wheel = [[] for _ in range(int(idle_timeout / tick) + 1)]
+        self._tick = int(clock() / tick)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def hit(self, guild_id, user_id, threshold, timeframe, now=None):
+        """Count one message and return True if the user is over ``threshold`` per ``timeframe``."""
+        if now is None:
+            now = self.clock()
+        tick = int(now / self.tick)
+        if tick != self._tick:
+            self._advance(tick)
+        key = guild_id << 64 | user_id
+        idx = self._slots.get(key)
+        if idx is None:
+            idx = self._allocate(key, now)
+        self._seen[idx] = tick
+
+        start = self._start[idx]
+        if now - start >= timeframe:
+            windows = int((now - start) // timeframe)
+            self._prev[idx] = self._cur[idx] if windows == 1 else 0
+            self._cur[idx] = 0
+            start += windows * timeframe
+            self._start[idx] = start
+        cur = self._cur[idx] + 1
+        self._cur[idx] = cur
+        # Weight the previous window by how much of it still overlaps the sliding window
+        estimate = self._prev[idx] * (timeframe - (now - start)) / timeframe + cur
+        return estimate >= threshold
+
+    def reset(self, guild_id, user_id):
+        idx = self._slots.get(guild_id << 64 | user_id)
+        if idx is not None:
+            self._prev[idx] = 0
+            self._cur[idx] = 0
+
+    def _allocate(self, key, now):
+        if len(self._slots) >= self.max_entries:
+            self._evict_oldest()
+        tick = int(now / self.tick)
+        if self._free:
+            idx = self._free.pop()
+            self._start[idx] = now
+            self._prev[idx] = 0
+            self._cur[idx] = 0
+        else:
+            idx = len(self._start)
+            self._start.append(now)
+            self._prev.append(0)
+            self._cur.append(0)
+            self._seen.append(tick)
+        self._slots[key] = idx
+        self._wheel[tick % len(self._wheel)].append(key)
+        return idx
+
+    def _advance(self, tick):
+        size = len(self._wheel)
+        # Every bucket is due once a full revolution has passed
+        first = max(self._tick + 1, tick - size + 1)
+        for t in range(first, tick + 1):
+            self._expire(t % size, t - size)
+        self._tick = tick
+
+    def _expire(self, bucket, stale_tick):
+        keys = self._wheel[bucket]
+        self._wheel[bucket] = []
+        slots = self._slots
+        seen = self._seen
+        wheel = self._wheel
+        size = len(wheel)
+        for key in keys:
+            idx = slots.get(key)
+            if idx is None:
+                continue
+            last = seen[idx]
+            if last <= stale_tick:
+                del slots[key]
+                self._free.append(idx)
+                self.evicted += 1
+            else:
+                # Seen since it was queued: due again a full revolution after that
+                wheel[last % size].append(key)
+
+    def _evict_oldest(self):
+        size = len(self._wheel)
+        for offset in range(1, size + 1):
+            t = self._tick + offset
+            self._expire(t % size, t - size)
+            if len(self._slots) < self.max_entries:
+                return
+
+
+def _benchmark(users=1_000_000, guilds=1000, messages=3_000_000):
+    import random
+    import tracemalloc
+    from collections import defaultdict, deque
+
+    random.seed(0)
+    authors = [(1094926261459111936 + i % guilds, 800000000000000000 + i) for i in range(users)]
+    stream = [authors[random.randrange(users)] for _ in range(messages)]
+
+    # The per-author deques this module replaced (keyed by author only, never evicted)
+    tracemalloc.start()
+    recent_messages = defaultdict(lambda: deque(maxlen=5))
+    for _, user_id in authors:
+        recent_messages[user_id].append(time.monotonic())
+    legacy_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del recent_messages
+
+    tracemalloc.start()
+    tracker = SpamTracker()
+    for guild_id, user_id in authors:
+        tracker.hit(guild_id, user_id, 5, 10)
+    tracker_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"{users:,} users: deque per user {legacy_bytes / users:.0f} B/user, "
+          f"SpamTracker {tracker_bytes / users:.0f} B/user")
+
+    start = time.perf_counter()
+    for guild_id, user_id in stream:
+        tracker.hit(guild_id, user_id, 5, 10)
+    elapsed = time.perf_counter() - start
+    print(f"SpamTracker.hit: {messages / elapsed:,.0f} messages/sec with {len(tracker):,} tracked users")
+
+    # A few busy users post every tick for several idle timeouts; each keeps one wheel entry
+    busy = SpamTracker(clock=lambda: 0.0)
+    for t in range(int(3 * busy.idle_timeout / busy.tick)):
+        for user_id in range(1000):
+            busy.hit(1, user_id, 5, 10, now=t * busy.tick)
+    print(f"1,000 users active for {3 * busy.idle_timeout:.0f}s: "
+          f"{sum(len(bucket) for bucket in busy._wheel):,} wheel entries")
+
+    # Everyone goes quiet: one pass of the wheel empties the tracker
+    tracker.hit(0, 0, 5, 10, now=time.monotonic() + tracker.idle_timeout + tracker.tick)
+    print(f"after idle timeout: {len(tracker):,} tracked users, {tracker.evicted:,} evicted")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,229 @@
+import struct
+from array import array
+from collections import defaultdict
+from itertools import accumulate
+
+# Snapshot codecs for WriteBehindLog. Each turns one shape of bot state into
+# bytes and back, keeping snowflakes as integers and timestamps as epoch
+# floats, and rebuilding the same containers (defaultdicts, sets) the bot
+# uses. Everything is column-oriented: ids, counts and floats go into typed
+# arrays that are copied in one call, so encoding and decoding do not walk
+# the data value by value the way JSON does.
+
+_COUNTS = struct.Struct("<III")
+
+
+def _array(typecode, data, offset, count):
+    values = array(typecode)
+    end = offset + values.itemsize * count
+    values.frombytes(data[offset:end])
+    return values, end
+
+
+def _check_version(codec, version):
+    if version != codec.version:
+        raise ValueError(f"{codec.name} snapshots of version {version} are not supported (expected {codec.version})")
+
+
+class GuildListCodec:
+    """``{guild_id: [str, ...]}``, such as the mod logs.
+
+    Log entries repeat a handful of messages, so each distinct string is
+    stored once and entries refer to it by index. Decoded lists share those
+    string objects, which also keeps the loaded state small.
+    """
+
+    name = "guild-list"
+    version = 1
+
+    def encode(self, state):
+        guild_ids = array("Q", state.keys())
+        counts = array("I", map(len, state.values()))
+        table = {}
+        indexes = array("I", [table.setdefault(entry, len(table)) for entries in state.values() for entry in entries])
+        # Lengths in characters, so decoding can slice one big str
+        lengths = array("I", map(len, table))
+        text = "".join(table).encode("utf-8", "surrogatepass")
+        return b"".join((_COUNTS.pack(len(guild_ids), len(table), len(indexes)), struct.pack("<I", len(text)),
+                         guild_ids.tobytes(), counts.tobytes(), lengths.tobytes(), indexes.tobytes(), text))
+
+    def decode(self, data, version):
+        _check_version(self, version)
+        guilds, strings, total = _COUNTS.unpack_from(data)
+        size, = struct.unpack_from("<I", data, _COUNTS.size)
+        guild_ids, offset = _array("Q", data, _COUNTS.size + 4, guilds)
+        counts, offset = _array("I", data, offset, guilds)
+        lengths, offset = _array("I", data, offset, strings)
+        indexes, offset = _array("I", data, offset, total)
+        text = bytes(data[offset:offset + size]).decode("utf-8", "surrogatepass")
+        ends = list(accumulate(lengths))
+        table = [text[start:end] for start, end in zip([0] + ends, ends)]
+        entries = list(map(table.__getitem__, indexes))
+        state = defaultdict(list)
+        position = 0
+        for guild_id, count in zip(guild_ids, counts):
+            state[guild_id] = entries[position:position + count]
+            position += count
+        return state
+
+
+class GuildKindCodec:
+    """``{guild_id: {kind: value}}`` where every value has the same fixed layout.
+
+    ``"times"`` values are lists of epoch floats, such as the recent-action
+    rings; ``"threshold"`` values are ``[count, window]`` pairs.
+    """
+
+    name = "guild-kind"
+    version = 1
+
+    def __init__(self, value):
+        if value not in ("times", "threshold"):
+            raise ValueError(f"Unknown value layout {value!r}")
+        self.value = value
+
+    def encode(self, state):
+        kinds = sorted({kind for kinds in state.values() for kind in kinds})
+        index = {kind: i for i, kind in enumerate(kinds)}
+        guild_ids = array("Q")
+        kind_ids = array("B")
+        counts = array("I")
+        floats = array("d")
+        for guild_id, values in state.items():
+            for kind, value in values.items():
+                guild_ids.append(guild_id)
+                kind_ids.append(index[kind])
+                if self.value == "times":
+                    counts.append(len(value))
+                    floats.extend(value)
+                else:
+                    counts.append(value[0])
+                    floats.append(value[1])
+        names = "\n".join(kinds).encode()
+        return b"".join((_COUNTS.pack(len(guild_ids), len(floats), len(names)), names, guild_ids.tobytes(),
+                         kind_ids.tobytes(), counts.tobytes(), floats.tobytes()))
+
+    def decode(self, data, version):
+        _check_version(self, version)
+        rows, total, size = _COUNTS.unpack_from(data)
+        offset = _COUNTS.size + size
+        kinds = bytes(data[_COUNTS.size:offset]).decode().split("\n")
+        guild_ids, offset = _array("Q", data, offset, rows)
+        kind_ids, offset = _array("B", data, offset, rows)
+        counts, offset = _array("I", data, offset, rows)
+        floats = _array("d", data, offset, total)[0].tolist()
+        state = defaultdict(dict)
+        if self.value == "times":
+            position = 0
+            for guild_id, kind_id, count in zip(guild_ids, kind_ids, counts):
+                state[guild_id][kinds[kind_id]] = floats[position:position + count]
+                position += count
+        else:
+            for guild_id, kind_id, count, window in zip(guild_ids, kind_ids, counts, floats):
+                state[guild_id][kinds[kind_id]] = [count, window]
+        return state
+
+
+class IdSetCodec:
+    """A set of snowflakes, such as the bypass list."""
+
+    name = "id-set"
+    version = 1
+
+    def encode(self, state):
+        return array("Q", state).tobytes()
+
+    def decode(self, data, version):
+        _check_version(self, version)
+        return set(_array("Q", data, 0, len(data) // 8)[0])
+
+
+class TimerCodec:
+    """``{(kind, guild_id, target_id): [due, reason]}``, the scheduler's pending actions.
+
+    Kinds and reasons repeat a lot, so both go through string tables as in
+    ``GuildListCodec``.
+    """
+
+    name = "timers"
+    version = 1
+
+    def encode(self, state):
+        kinds = {}
+        reasons = {}
+        kind_ids = array("B", [kinds.setdefault(kind, len(kinds)) for kind, _, _ in state])
+        guild_ids = array("Q", [guild_id for _, guild_id, _ in state])
+        target_ids = array("Q", [target_id for _, _, target_id in state])
+        dues = array("d", [due for due, _ in state.values()])
+        reason_ids = array("I", [reasons.setdefault(reason, len(reasons)) for _, reason in state.values()])
+        lengths = array("I", map(len, reasons))
+        names = "\n".join(kinds).encode()
+        text = "".join(reasons).encode("utf-8", "surrogatepass")
+        return b"".join((_COUNTS.pack(len(dues), len(reasons), len(names)), struct.pack("<I", len(text)), names,
+                         kind_ids.tobytes(), guild_ids.tobytes(), target_ids.tobytes(), dues.tobytes(),
+                         reason_ids.tobytes(), lengths.tobytes(), text))
+
+    def decode(self, data, version):
+        _check_version(self, version)
+        rows, strings, size = _COUNTS.unpack_from(data)
+        text_size, = struct.unpack_from("<I", data, _COUNTS.size)
+        offset = _COUNTS.size + 4 + size
+        kinds = bytes(data[_COUNTS.size + 4:offset]).decode().split("\n")
+        kind_ids, offset = _array("B", data, offset, rows)
+        guild_ids, offset = _array("Q", data, offset, rows)
+        target_ids, offset = _array("Q", data, offset, rows)
+        dues, offset = _array("d", data, offset, rows)
+        reason_ids, offset = _array("I", data, offset, rows)
+        lengths, offset = _array("I", data, offset, strings)
+        text = bytes(data[offset:offset + text_size]).decode("utf-8", "surrogatepass")
+        ends = list(accumulate(lengths))
+        table = [text[start:end] for start, end in zip([0] + ends, ends)]
+        return {(kinds[kind_id], guild_id, target_id): [due, table[reason_id]]
+                for kind_id, guild_id, target_id, due, reason_id
+                in zip(kind_ids, guild_ids, target_ids, dues.tolist(), reason_ids)}
+
+
+def _benchmark(guilds=20000, entries=50, ring=5, repeat=3):
+    import json
+    import time
+
+    guild_ids = [1094926261459111936 + i * 4194304 for i in range(guilds)]
+    now = time.time()
+    kinds = ("message_deletes", "channel_creates", "role_creates", "role_deletes", "member_bans")
+    cases = (
+        ("mod_logs", GuildListCodec(),
+         defaultdict(list, {g: [f"Mass role deletion detected! ({n})" for n in range(entries)] for g in guild_ids}),
+         lambda data: defaultdict(list, {int(g): items for g, items in data.items()})),
+        ("recent_actions", GuildKindCodec("times"),
+         defaultdict(dict, {g: {kind: [now - n * 1.5 for n in range(ring)] for kind in kinds} for g in guild_ids}),
+         lambda data: defaultdict(dict, {int(g): kinds for g, kinds in data.items()})),
+        ("thresholds", GuildKindCodec("threshold"),
+         defaultdict(dict, {g: {"role_creates": [3, 10.0]} for g in guild_ids}),
+         lambda data: defaultdict(dict, {int(g): kinds for g, kinds in data.items()})),
+        ("bypass_users", IdSetCodec(), set(guild_ids), lambda data: set(data)),
+    )
+
+    def best(func):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - started)
+        return min(timings), result
+
+    print(f"{guilds:,} guilds, {entries} mod log entries and {ring}-slot rings per guild")
+    print(f"{'':16} {'format':10} {'size MB':>8} {'encode ms':>10} {'decode ms':>10}")
+    for name, codec, state, from_json in cases:
+        encodable = list(state) if isinstance(state, set) else state
+        encode_json, text = best(lambda: json.dumps(encodable))
+        decode_json, _ = best(lambda: from_json(json.loads(text)))
+        encode_binary, data = best(lambda: codec.encode(state))
+        decode_binary, decoded = best(lambda: codec.decode(data, codec.version))
+        assert decoded == state and type(decoded) is type(state)
+        for label, size, encode, decode in (("json", len(text), encode_json, decode_json),
+                                            (codec.name, len(data), encode_binary, decode_binary)):
+            print(f"{name:16} {label:10} {size / 1e6:8.2f} {encode * 1000:10.1f} {decode * 1000:10.1f}")
+
+
+if __name__ == "__main__":
+    _benchmark()
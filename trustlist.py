@@ -0,0 +1,332 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+USER = "user"
+ROLE = "role"
+# Entries under this guild id apply in every guild. Only the old global
+# bypass list and whitelist.json are kept there, after migrating them.
+GLOBAL = 0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trust (
+    guild_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    entity_id INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, kind, entity_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trust_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trust_imports (
+    source TEXT PRIMARY KEY,
+    imported_at REAL NOT NULL
+);
+"""
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class _GuildTrust:
+    __slots__ = ("users", "roles", "member_roles", "trusted", "version")
+
+    def __init__(self, users, roles):
+        self.users = users
+        self.roles = roles
+        # Role ids of members seen so far; only kept while the guild trusts a role
+        self.member_roles = {}
+        # Everyone a check should let through, precomputed
+        self.trusted = set()
+        # Bumped on every local change, so a reload that raced one is dropped
+        self.version = 0
+
+    def rebuild(self, global_users):
+        self.trusted = self.users | global_users
+        if self.roles:
+            self.trusted.update(user_id for user_id, role_ids in self.member_roles.items()
+                                if not self.roles.isdisjoint(role_ids))
+        else:
+            self.member_roles.clear()
+
+
+class TrustList:
+    """Per-guild trusted users and roles, in one SQLite file both bots share.
+
+    A guild's entries are read the first time it is checked. Members who
+    hold a trusted role are resolved ahead of time: the bots report the roles
+    of members they see through ``observe_member``, and the guild's
+    ``trusted`` set is kept up to date from that index, so ``is_trusted`` is
+    one dict lookup and one set probe and never calls the REST API. Guilds
+    that trust no role keep no index.
+
+    ``resolve_role(guild_id, role_id)`` may return ``(user_id, role_ids)``
+    pairs for the members holding a role, from the library's member cache,
+    to seed the index when a role becomes trusted. Without it, members are
+    picked up as they are next seen; a caller that must not wait for that
+    checks ``needs_roles`` and reports the member's roles itself first.
+
+    Changes are applied in memory at once and written by a background
+    thread. ``watch`` picks up changes made by other processes.
+    """
+
+    def __init__(self, path, resolve_role=None):
+        self.path = path
+        self.resolve_role = resolve_role
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = _connect(path)
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+        self._last_seq = self._conn.execute("SELECT coalesce(max(seq), 0) FROM trust_changes").fetchone()[0]
+        self._global = self._read(GLOBAL)[0]
+        self._guilds = {}
+        self._stale = set()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trust-list")
+        self._writer_conn = None
+
+    # Checks
+
+    def is_trusted(self, guild_id, user_id):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._load(guild_id)
+        return user_id in guild.trusted
+
+    def observe_member(self, guild_id, user_id, role_ids):
+        """Record the roles a member currently has, from a gateway event."""
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._load(guild_id)
+        if not guild.roles:
+            return
+        role_ids = frozenset(role_ids)
+        if guild.member_roles.get(user_id) == role_ids:
+            return
+        guild.member_roles[user_id] = role_ids
+        if user_id in guild.users or user_id in self._global or not guild.roles.isdisjoint(role_ids):
+            guild.trusted.add(user_id)
+        else:
+            guild.trusted.discard(user_id)
+
+    def needs_roles(self, guild_id, user_id):
+        """Whether the guild trusts a role and the roles of ``user_id`` have not been observed."""
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._load(guild_id)
+        return bool(guild.roles) and user_id not in guild.member_roles and user_id not in guild.trusted
+
+    def forget_member(self, guild_id, user_id):
+        """Drop a member who left the guild from the role index."""
+        guild = self._guilds.get(guild_id)
+        if guild is not None and guild.member_roles.pop(user_id, None) is not None:
+            if user_id not in guild.users and user_id not in self._global:
+                guild.trusted.discard(user_id)
+
+    def entries(self, guild_id):
+        """Return the guild's trusted user ids and role ids."""
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._load(guild_id)
+        return set(guild.users), set(guild.roles)
+
+    def _read(self, guild_id):
+        users, roles = set(), set()
+        for kind, entity_id in self._conn.execute("SELECT kind, entity_id FROM trust WHERE guild_id = ?", (guild_id,)):
+            (users if kind == USER else roles).add(entity_id)
+        return users, roles
+
+    def _load(self, guild_id):
+        guild = self._guilds[guild_id] = _GuildTrust(*self._read(guild_id))
+        for role_id in guild.roles:
+            self._seed(guild_id, role_id)
+        guild.rebuild(self._global)
+        return guild
+
+    def _seed(self, guild_id, role_id):
+        if self.resolve_role is None:
+            return
+        try:
+            members = self.resolve_role(guild_id, role_id) or ()
+        except Exception as e:
+            logging.error(f"Error resolving members of role {role_id} in guild {guild_id}: {e}")
+            return
+        guild = self._guilds[guild_id]
+        for user_id, role_ids in members:
+            guild.member_roles[user_id] = frozenset(role_ids)
+
+    # Changes
+
+    def add(self, guild_id, kind, entity_id):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._load(guild_id)
+        (guild.users if kind == USER else guild.roles).add(entity_id)
+        if kind == ROLE:
+            self._seed(guild_id, entity_id)
+        guild.version += 1
+        guild.rebuild(self._global)
+        self._writer.submit(self._write, "INSERT OR IGNORE INTO trust VALUES (?, ?, ?)", guild_id, kind, entity_id)
+
+    def remove(self, guild_id, kind, entity_id):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._load(guild_id)
+        (guild.users if kind == USER else guild.roles).discard(entity_id)
+        guild.version += 1
+        guild.rebuild(self._global)
+        self._writer.submit(self._write, "DELETE FROM trust WHERE guild_id = ? AND kind = ? AND entity_id = ?",
+                            guild_id, kind, entity_id)
+
+    def import_entries(self, source, entries):
+        """Insert ``(guild_id, kind, entity_id)`` entries once per ``source``; blocks.
+
+        For migrating the lists this store replaces. Returns False if
+        ``source`` was already imported, possibly by the other bot.
+        """
+        conn = _connect(self.path)
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("SELECT 1 FROM trust_imports WHERE source = ?", (source,)).fetchone():
+                    return False
+                conn.executemany("INSERT OR IGNORE INTO trust VALUES (?, ?, ?)", entries)
+                conn.executemany("INSERT INTO trust_changes (guild_id) VALUES (?)",
+                                 [(guild_id,) for guild_id in {entry[0] for entry in entries}])
+                conn.execute("INSERT INTO trust_imports VALUES (?, ?)", (source, time.time()))
+        finally:
+            conn.close()
+        # Imports happen before the bot is busy, so apply them right here
+        self._global = self._read(GLOBAL)[0]
+        for guild_id in {entry[0] for entry in entries} & set(self._guilds):
+            self._refresh(guild_id, *self._read(guild_id))
+        for guild in self._guilds.values():
+            guild.rebuild(self._global)
+        return True
+
+    def _write(self, sql, guild_id, *args):
+        try:
+            if self._writer_conn is None:
+                self._writer_conn = _connect(self.path)
+            with self._writer_conn:
+                self._writer_conn.execute(sql, (guild_id, *args))
+                self._writer_conn.execute("INSERT INTO trust_changes (guild_id) VALUES (?)", (guild_id,))
+        except Exception as e:
+            logging.error(f"Error writing {self.path}: {e}")
+
+    # Changes from other processes
+
+    async def watch(self, interval=5.0):
+        """Reload guilds that other processes changed, forever.
+
+        Reads go through the writer thread, after any of this process's
+        queued writes, so a reload never undoes a change made here.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changed, self._last_seq = await loop.run_in_executor(self._writer, self._changes, self._last_seq)
+                self._stale.update(changed)
+                for guild_id in list(self._stale):
+                    guild = self._guilds.get(guild_id) if guild_id != GLOBAL else None
+                    if guild_id != GLOBAL and guild is None:
+                        self._stale.discard(guild_id)
+                        continue
+                    version = guild.version if guild else None
+                    users, roles = await loop.run_in_executor(self._writer, self._read_for_writer, guild_id)
+                    if guild_id == GLOBAL:
+                        self._global = users
+                        for other in self._guilds.values():
+                            other.rebuild(self._global)
+                    elif self._guilds.get(guild_id) is guild and guild.version == version:
+                        self._refresh(guild_id, users, roles)
+                    else:
+                        # Changed here while reading; try again on the next round
+                        continue
+                    self._stale.discard(guild_id)
+            except Exception as e:
+                logging.error(f"Error checking {self.path} for changes: {e}")
+
+    def _changes(self, last_seq):
+        if self._writer_conn is None:
+            self._writer_conn = _connect(self.path)
+        rows = self._writer_conn.execute("SELECT seq, guild_id FROM trust_changes WHERE seq > ?", (last_seq,)).fetchall()
+        return {guild_id for _, guild_id in rows}, max((seq for seq, _ in rows), default=last_seq)
+
+    def _read_for_writer(self, guild_id):
+        users, roles = set(), set()
+        for kind, entity_id in self._writer_conn.execute("SELECT kind, entity_id FROM trust WHERE guild_id = ?",
+                                                         (guild_id,)):
+            (users if kind == USER else roles).add(entity_id)
+        return users, roles
+
+    def _refresh(self, guild_id, users, roles):
+        guild = self._guilds[guild_id]
+        added = roles - guild.roles
+        guild.users, guild.roles = users, roles
+        for role_id in added:
+            self._seed(guild_id, role_id)
+        guild.rebuild(self._global)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        if self._writer_conn is not None:
+            self._writer_conn.close()
+        self._conn.close()
+
+
+def _benchmark(guilds=1000, checks=1_000_000, members=2000):
+    import random
+    import shutil
+    import tempfile
+
+    folder = tempfile.mkdtemp(prefix="trust-")
+    try:
+        rng = random.Random(1)
+        guild_ids = [1094926261459111936 + i * 4194304 for i in range(guilds)]
+        trust = TrustList(os.path.join(folder, "trust.sqlite3"))
+        for guild_id in guild_ids:
+            for n in range(5):
+                trust.add(guild_id, USER, guild_id + n)
+            trust.add(guild_id, ROLE, guild_id + 100)
+        trust._writer.submit(lambda: None).result()
+        # Every member is seen once, as their first message would report them
+        for guild_id in guild_ids[:10]:
+            for n in range(members):
+                trust.observe_member(guild_id, guild_id + 1000 + n, [guild_id + 100 + n % 20])
+        probes = [(rng.choice(guild_ids[:10]), rng.randrange(members)) for _ in range(checks)]
+        probes = [(guild_id, guild_id + 1000 + n) for guild_id, n in probes]
+
+        started = time.perf_counter()
+        hits = sum(trust.is_trusted(guild_id, user_id) for guild_id, user_id in probes)
+        elapsed = time.perf_counter() - started
+        print(f"is_trusted: {elapsed / checks * 1e9:.0f} ns per check ({hits:,} of {checks:,} trusted through a role)")
+
+        started = time.perf_counter()
+        for guild_id, user_id in probes:
+            trust.observe_member(guild_id, user_id, [guild_id + 100 + (user_id - guild_id - 1000) % 20])
+        elapsed = time.perf_counter() - started
+        print(f"observe_member, roles unchanged: {elapsed / checks * 1e9:.0f} ns per event")
+
+        started = time.perf_counter()
+        fresh = TrustList(os.path.join(folder, "trust.sqlite3"))
+        for guild_id in guild_ids:
+            fresh.is_trusted(guild_id, 1)
+        elapsed = time.perf_counter() - started
+        print(f"lazy load: {elapsed / guilds * 1e6:.0f} µs per guild on first check")
+        fresh.close()
+        trust.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    _benchmark()